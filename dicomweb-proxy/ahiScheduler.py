@@ -0,0 +1,139 @@
+"""
+ahiScheduler Module : Shares the AHI GetImageFrame concurrency and bandwidth between the frames requested by the clients and the frames prefetched by the frame fetchers.
+
+The foreground class ( client requests ) has priority over the background class ( prefetch ) : a background fetch only starts when no foreground
+fetch is waiting, and cannot take the last foreground_reserve slots, so that a client request finds a free slot without waiting for the prefetch
+downloads in progress to complete. The bandwidth is shared with a token bucket charged with the size of each frame once downloaded.
+
+The state lives in shared memory so that the scheduler can be passed to the frame fetcher processes. Each class waits on its own condition, and
+a released slot wakes up a single waiting fetch, foreground first, rather than all the waiting threads of all the processes.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import time
+import multiprocessing
+
+
+FOREGROUND = 0
+BACKGROUND = 1
+SCHEDULING_CLASSES = ["foreground" , "background"]
+
+# shared state slots
+_ACTIVE = 0
+_TOKENS = 1
+_REFILLED = 2
+_WAITING = 3 # one slot per class
+# shared statistics, per class
+_REQUESTS = 0
+_WAIT_TOTAL = 1
+_WAIT_MAX = 2
+_BYTES = 3
+_STAT_COUNT = 4
+_MAX_WAIT_STEP = 1.0 # seconds : the waiting fetches check the state at least this often.
+
+
+class ahiScheduler:
+
+    def __init__(self, max_concurrency : int = 64 , bandwidth_mbps : int = 0 , foreground_reserve : int = 8):
+        """
+        max_concurrency : maximum number of GetImageFrame calls in progress, over the service and the frame fetcher processes.
+        bandwidth_mbps : maximum download rate in MB/s, 0 for unlimited.
+        foreground_reserve : number of slots the background fetches cannot use.
+        """
+        ctx = multiprocessing.get_context('spawn')
+        self.max_concurrency = max_concurrency
+        self.background_concurrency = max(1, max_concurrency - foreground_reserve)
+        self.rate = bandwidth_mbps*1024*1024
+        self.burst = max(self.rate, 8*1024*1024) # bytes downloadable at once after an idle period.
+        self.lock = ctx.Lock()
+        self.conditions = [ ctx.Condition(self.lock) for scheduling_class in SCHEDULING_CLASSES ]
+        self.state = ctx.Array('d', [0, self.burst, time.monotonic()] + [0]*len(SCHEDULING_CLASSES), lock=False)
+        self.stats = ctx.Array('d', [0]*_STAT_COUNT*len(SCHEDULING_CLASSES), lock=False)
+
+    def _refill(self, now : float):
+        if self.rate > 0:
+            self.state[_TOKENS] = min(self.burst, self.state[_TOKENS] + (now - self.state[_REFILLED]) * self.rate)
+        self.state[_REFILLED] = now
+
+    def _blocked(self, scheduling_class : int):
+        """Returns None if a fetch of the class can start, else the longest time to wait before checking again."""
+        if scheduling_class == BACKGROUND:
+            if self.state[_WAITING+FOREGROUND] > 0 or self.state[_ACTIVE] >= self.background_concurrency:
+                return _MAX_WAIT_STEP
+        elif self.state[_ACTIVE] >= self.max_concurrency:
+            return _MAX_WAIT_STEP
+        if self.rate > 0 and self.state[_TOKENS] < 0:
+            return min(_MAX_WAIT_STEP, -self.state[_TOKENS] / self.rate)
+        return None
+
+    def _notify(self):
+        """Wakes up one waiting fetch, of the foreground class if any. The lock must be held."""
+        for scheduling_class in (FOREGROUND , BACKGROUND):
+            if self.state[_WAITING+scheduling_class] > 0:
+                self.conditions[scheduling_class].notify()
+                return
+
+    def acquire(self, scheduling_class : int):
+        """Waits for a slot of the class. Returns the time waited in seconds."""
+        start = time.monotonic()
+        with self.lock:
+            self.state[_WAITING+scheduling_class] += 1
+            waited_once = False
+            try:
+                while True:
+                    self._refill(time.monotonic())
+                    timeout = self._blocked(scheduling_class)
+                    if timeout is None:
+                        break
+                    self.conditions[scheduling_class].wait(timeout)
+                    waited_once = True
+                self.state[_ACTIVE] += 1
+            finally:
+                self.state[_WAITING+scheduling_class] -= 1
+            if waited_once and self.state[_ACTIVE] < self.max_concurrency: # several slots may have been released while this fetch was waking up.
+                self._notify()
+            waited = time.monotonic() - start
+            stats = _STAT_COUNT*scheduling_class
+            self.stats[stats+_REQUESTS] += 1
+            self.stats[stats+_WAIT_TOTAL] += waited
+            self.stats[stats+_WAIT_MAX] = max(self.stats[stats+_WAIT_MAX], waited)
+        return waited
+
+    def release(self, scheduling_class : int , nbytes : int = 0):
+        """Frees the slot, charging the bandwidth with the nbytes downloaded."""
+        with self.lock:
+            self.state[_ACTIVE] -= 1
+            self._refill(time.monotonic())
+            self.state[_TOKENS] -= nbytes
+            self.stats[_STAT_COUNT*scheduling_class+_BYTES] += nbytes
+            self._notify()
+
+    def run(self, scheduling_class : int , fetch , *args):
+        """Runs the fetch function in a slot of the class, and charges the bandwidth with the length of its result."""
+        self.acquire(scheduling_class)
+        result = None
+        try:
+            result = fetch(*args)
+            return result
+        finally:
+            self.release(scheduling_class , len(result) if result is not None else 0)
+
+    def getStats(self):
+        with self.lock:
+            resp = {
+                "active" : int(self.state[_ACTIVE]),
+                "max_concurrency" : self.max_concurrency,
+                "background_concurrency" : self.background_concurrency,
+                "bandwidth_mbps" : self.rate // (1024*1024)
+            }
+            for scheduling_class , name in enumerate(SCHEDULING_CLASSES):
+                stats = _STAT_COUNT*scheduling_class
+                requests = int(self.stats[stats+_REQUESTS])
+                resp[name] = {
+                    "waiting" : int(self.state[_WAITING+scheduling_class]),
+                    "requests" : requests,
+                    "bytes" : int(self.stats[stats+_BYTES]),
+                    "mean_wait_ms" : round(self.stats[stats+_WAIT_TOTAL] * 1000 / requests, 3) if requests > 0 else 0,
+                    "max_wait_ms" : round(self.stats[stats+_WAIT_MAX] * 1000, 3)
+                }
+            return resp
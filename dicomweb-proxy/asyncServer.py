@@ -0,0 +1,578 @@
+"""
+asyncServer Module : asyncio serving mode of the proxy, selected with SERVING_MODE=asyncio.
+
+The QIDO-RS and WADO-RS routes are served by aiohttp on a single event loop. The frames are retrieved from AHI with an asynchronous SigV4 signed client
+and the database is queried with aiomysql, so a request waiting on I/O does not hold a thread. The decoding, rendering and serialization run in a
+thread pool executor, sharing the caches, the frame store and the helpers of the threaded server.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import asyncio
+import contextlib
+import ssl
+import zlib
+import gzip
+import itertools
+import logging
+import time
+import concurrent.futures
+from collections import deque
+from uuid import uuid4
+import aiohttp
+from aiohttp import web
+import aiomysql
+import boto3
+import orjson
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from pydicom import uid
+import renderer
+from ahiScheduler import FOREGROUND
+import sql_queries
+
+
+class asyncAHIClient:
+
+    MAX_ATTEMPTS = 3 # attempts of a request throttled or failed by AHI.
+
+    def __init__(self, region : str = None , max_connections : int = 1000):
+        self.logger = logging.getLogger(__name__)
+        session = boto3.session.Session()
+        self.region = region if region is not None else session.region_name
+        self.credentials = session.get_credentials()
+        self.max_connections = max_connections
+        self.session = None
+
+    async def start(self):
+        """Creates the HTTP session, which must be done in the event loop it is used from."""
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections , ttl_dns_cache=300))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def getImageFrame(self, datastore_id : str , imageset_id : str , imageframe_id : str):
+        """Returns the frame as stored by AHI, or None."""
+        url = f"https://runtime-medical-imaging.{self.region}.amazonaws.com/datastore/{datastore_id}/imageSet/{imageset_id}/getImageFrame"
+        body = orjson.dumps({"imageFrameId" : imageframe_id})
+        for attempt in range(asyncAHIClient.MAX_ATTEMPTS):
+            # Signed for each attempt, the credentials may have been refreshed and the signature is time bound.
+            aws_request = AWSRequest(method="POST" , url=url , data=body , headers={"Content-Type" : "application/json"})
+            SigV4Auth(self.credentials.get_frozen_credentials(), "medical-imaging", self.region).add_auth(aws_request)
+            try:
+                async with self.session.post(url , data=body , headers=dict(aws_request.headers)) as response:
+                    if response.status == 200:
+                        return await response.read()
+                    error = await response.text()
+                    if response.status != 429 and response.status < 500:
+                        self.logger.error(f"[getImageFrame] - {datastore_id}/{imageset_id}/{imageframe_id} : {response.status} {error}")
+                        return None
+            except aiohttp.ClientError as err:
+                error = str(err)
+            await asyncio.sleep(0.1 * 2**attempt)
+        self.logger.error(f"[getImageFrame] - {datastore_id}/{imageset_id}/{imageframe_id} : {error}")
+        return None
+
+
+class asyncServer:
+
+    CORS_HEADERS = {
+        "Access-Control-Allow-Origin" : "*",
+        "Access-Control-Allow-Methods" : "GET, DELETE, OPTIONS",
+        "Access-Control-Allow-Headers" : "*"
+    }
+
+    def __init__(self, proxy , db_secret : dict , executor_threads : int = 32 , pool_size : int = 100):
+        """
+        proxy : the main module, whose caches, frame store and helpers are shared with this server.
+        db_secret : database connection settings, as stored in Secrets Manager.
+        executor_threads : threads of the executor running the decoding, rendering and serialization.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.proxy = proxy
+        self.db_secret = db_secret
+        self.pool_size = pool_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=executor_threads , thread_name_prefix="asyncServer")
+        self.ahi = asyncAHIClient()
+        self.sql_pool = None
+        self.downloads = set() # tasks of the frame downloads shared by the requests, referenced until they complete.
+
+    def createApp(self):
+        app = web.Application(middlewares=[self.corsMiddleware])
+        app.on_startup.append(self.startup)
+        app.on_cleanup.append(self.cleanup)
+        routes = [
+            ("/" , self.healthcheck),
+            ("/aetitle/health" , self.healthcheck),
+            ("/aetitle/metrics" , self.metrics),
+            ("/aetitle/studies" , self.qido("STUDY")),
+            ("/aetitle/studies/{StudyInstanceUID}/series" , self.qido("STUDY.SERIES")),
+            ("/aetitle/studies/{StudyInstanceUID}/instances" , self.qido("STUDY.INSTANCE")),
+            ("/aetitle/series" , self.qido("SERIES")),
+            ("/aetitle/studies/{StudyInstanceUID}/series/{SeriesInstanceUID}/instances" , self.qido("STUDY.SERIES.INSTANCE")),
+            ("/aetitle/instances" , self.qido("INSTANCE")),
+            ("/aetitle/studies/{StudyInstanceUID}" , self.retrieveStudies),
+            ("/aetitle/studies/{StudyInstanceUID}/metadata" , self.metadata("STUDY" , sql_queries.WADO_STUDIES_METADATA , "StudyInstanceUID")),
+            ("/aetitle/studies/{StudyInstanceUID}/rendered" , self.rendered),
+            ("/aetitle/studies/{StudyInstanceUID}/series/{SeriesInstanceUID}" , self.retrieveSeries),
+            ("/aetitle/studies/{StudyInstanceUID}/series/{SeriesInstanceUID}/rendered" , self.rendered),
+            ("/aetitle/studies/{StudyInstanceUID}/series/{SeriesInstanceUID}/metadata" , self.metadata("SERIES" , sql_queries.WADO_SERIES_METADATA , "SeriesInstanceUID")),
+            ("/aetitle/studies/{StudyInstanceUID}/series/{SeriesInstanceUID}/instances/{InstanceUID}" , self.retrieveInstance),
+            ("/aetitle/studies/{StudyInstanceUID}/series/{SeriesInstanceUID}/instances/{InstanceUID}/rendered" , self.rendered),
+            ("/aetitle/studies/{StudyInstanceUID}/series/{SeriesInstanceUID}/instances/{InstanceUID}/metadata" , self.metadata("INSTANCE" , sql_queries.WADO_INSTANCE_METADATA , "InstanceUID")),
+            ("/aetitle/studies/{StudyInstanceUID}/series/{SeriesInstanceUID}/instances/{InstanceUID}/frames/{Frames}" , self.frames),
+            ("/aetitle/studies/{StudyInstanceUID}/series/{SeriesInstanceUID}/instances/{InstanceUID}/frames/{Frames}/rendered" , self.rendered),
+            ("/aetitle/{BulkDataURIReference}" , self.bulkData),
+        ]
+        for path , handler in routes:
+            app.router.add_get(path , handler)
+        app.router.add_delete("/aetitle/cache/studies/{StudyInstanceUID}" , self.invalidateStudy)
+        return app
+
+    async def startup(self, app):
+        await self.ahi.start()
+        # Same TLS settings as the threaded server connection pool.
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+        self.sql_pool = await aiomysql.create_pool(host=self.db_secret['host'], port=int(self.db_secret['port']), user=self.db_secret['username'], password=self.db_secret['password'], db=self.db_secret['dbname'],
+                                                   minsize=1, maxsize=self.pool_size, autocommit=True, ssl=ssl_context,
+                                                   init_command="SET SESSION TRANSACTION ISOLATION LEVEL READ UNCOMMITTED")
+        self.logger.info("QIDO/WADO-RS asyncio service started.")
+
+    async def cleanup(self, app):
+        await self.ahi.close()
+        if self.sql_pool is not None:
+            self.sql_pool.close()
+            await self.sql_pool.wait_closed()
+        self.executor.shutdown(wait=False)
+
+    @web.middleware
+    async def corsMiddleware(self, request , handler):
+        if request.method == "OPTIONS":
+            return web.Response(headers=asyncServer.CORS_HEADERS)
+        response = await handler(request)
+        response.headers.update(asyncServer.CORS_HEADERS)
+        return response
+
+    async def run(self, function , *args , **kwargs):
+        """Runs a blocking or CPU bound function in the executor."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor , lambda: function(*args , **kwargs))
+
+    async def executeQuery(self, query : str , query_parameters):
+        start = time.perf_counter()
+        async with self.sql_pool.acquire() as sql_conn:
+            self.proxy.database_stats.record("checkout" , time.perf_counter() - start)
+            async with sql_conn.cursor() as cursor:
+                start = time.perf_counter()
+                await cursor.execute(query , query_parameters)
+                db_results = await cursor.fetchall()
+                self.proxy.database_stats.record(self.proxy.PREPARED_STATEMENTS.get(query) or "qido" , time.perf_counter() - start)
+                field_names = [i[0] for i in cursor.description] if cursor.description is not None else []
+        return field_names , db_results
+
+    def jsonResponse(self, status : int , payload):
+        return web.Response(status=status , body=orjson.dumps(payload) , content_type="application/dicom+json")
+
+    async def streamChunks(self, response : web.StreamResponse , chunks):
+        """Writes the chunks of a blocking generator to the response, each chunk being produced in the executor."""
+        while True:
+            chunk = await self.run(next , chunks , None)
+            if chunk is None:
+                break
+            await response.write(chunk)
+
+    ### Frames ###
+
+    async def getFrame(self, datastore_id : str , imageset_id : str , imageframe_id : str):
+        frame = None
+        if self.proxy.prefetch_policy is not None:
+            self.proxy.prefetch_policy.recordRequest(datastore_id , imageset_id , imageframe_id)
+        if self.proxy.frame_store is not None:
+            frame = await self.run(self.proxy.frame_store.read , datastore_id , imageset_id , imageframe_id)
+        if frame is not None:
+            self.proxy.cCleaner.recordAccess(datastore_id , imageset_id)
+            return frame
+        if self.proxy.frame_registry is None or self.proxy.frame_store is None:
+            return await self.fetchFrame(datastore_id , imageset_id , imageframe_id)
+        return await self.fetchFrameOnce(datastore_id , imageset_id , imageframe_id)
+
+    async def fetchFrameOnce(self, datastore_id : str , imageset_id : str , imageframe_id : str):
+        """Downloads the frame once for all the concurrent requests, as _fetchFrameOnce does in the threaded serving mode."""
+        registry = self.proxy.frame_registry
+        frame_store = self.proxy.frame_store
+        key = f"{datastore_id}/{imageset_id}/{imageframe_id}"
+        future , owner = registry.joinLocal(key)
+        if not owner:
+            return await asyncio.shield(asyncio.wrap_future(future)) # a cancelled request does not cancel the download shared with the others.
+        # the download runs in its own task : a cancelled owner request neither cancels it nor fails the requests which joined it.
+        download = asyncio.ensure_future(self.downloadFrameOnce(key , future , datastore_id , imageset_id , imageframe_id))
+        self.downloads.add(download)
+        download.add_done_callback(self.downloads.discard)
+        return await asyncio.shield(download)
+
+    async def downloadFrameOnce(self, key : str , future : concurrent.futures.Future , datastore_id : str , imageset_id : str , imageframe_id : str):
+        """Downloads the frame for the requests of this process, and resolves their future with it."""
+        registry = self.proxy.frame_registry
+        frame_store = self.proxy.frame_store
+        frame = None
+        try:
+            inflight_owner , registered = registry.begin(key , FOREGROUND)
+            if inflight_owner is not None: # joins the download of the frame fetcher.
+                if await self.run(registry.wait , key , self.proxy.FRAME_JOIN_TIMEOUT):
+                    frame = await self.run(frame_store.read , datastore_id , imageset_id , imageframe_id)
+                    if frame is not None:
+                        registry.recordJoin()
+                        return frame
+                frame = await self.fetchFrame(datastore_id , imageset_id , imageframe_id) # the other download failed, or did not store the frame.
+                return frame
+            try:
+                frame = await self.run(frame_store.read , datastore_id , imageset_id , imageframe_id) # a frame fetcher may have stored it since the cache was checked.
+                if frame is not None:
+                    return frame
+                frame = await self.fetchFrame(datastore_id , imageset_id , imageframe_id)
+                if frame is not None:
+                    await self.run(self.proxy._promoteFrame , datastore_id , imageset_id , imageframe_id , frame)
+            finally:
+                if registered:
+                    registry.end(key)
+            return frame
+        finally:
+            registry.resolveLocal(key , future , frame)
+
+    async def fetchFrame(self, datastore_id : str , imageset_id : str , imageframe_id : str):
+        """Reads the frame from the shared frame backend, or downloads it from AHI and stores it there."""
+        key = f"{datastore_id}/{imageset_id}/{imageframe_id}"
+        backend = self.proxy.frame_backend
+        if backend is not None:
+            frame = await self.run(backend.get , key)
+            if frame is not None:
+                return frame
+        frame = await self.scheduledFetch(datastore_id , imageset_id , imageframe_id)
+        if frame is not None and backend is not None:
+            await self.run(backend.put , key , frame)
+        return frame
+
+    async def scheduledFetch(self, datastore_id : str , imageset_id : str , imageframe_id : str):
+        scheduler = self.proxy.ahi_scheduler
+        if scheduler is None:
+            return await self.ahi.getImageFrame(datastore_id , imageset_id , imageframe_id)
+        # the slot is waited for in the executor, the scheduler state being shared with the frame fetcher processes.
+        acquiring = asyncio.get_running_loop().run_in_executor(self.executor , scheduler.acquire , FOREGROUND)
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError: # the executor thread still takes the slot : it is released once taken.
+            acquiring.add_done_callback(lambda acquired: scheduler.release(FOREGROUND) if not acquired.cancelled() and acquired.exception() is None else None)
+            raise
+        frame = None
+        try:
+            frame = await self.ahi.getImageFrame(datastore_id , imageset_id , imageframe_id)
+        finally:
+            scheduler.release(FOREGROUND , len(frame) if frame is not None else 0)
+        return frame
+
+    async def getDecodedFrame(self, datastore_id : str , imageset_id : str , imageframe_id : str):
+        frame_key = f"{datastore_id}/{imageset_id}/{imageframe_id}"
+        decoded_cache = self.proxy.decoded_cache
+        if decoded_cache is not None:
+            decoded = decoded_cache.get(frame_key)
+            if decoded is not None:
+                return decoded
+        frame = await self.getFrame(datastore_id , imageset_id , imageframe_id)
+        try:
+            decoded = await self.run(self.proxy.decode_engine.decode , frame)
+        except Exception as err:
+            self.logger.error(f"[getDecodedFrame] - {frame_key} could not be decoded : {err}")
+            return None
+        if decoded_cache is not None:
+            decoded_cache.recordDecode(frame_key , **decoded)
+        return decoded
+
+    async def getFramePixels(self, datastore_id : str , imageset_id : str , imageframe_id : str):
+        decoded = await self.getDecodedFrame(datastore_id , imageset_id , imageframe_id)
+        return decoded["pixels"] if decoded is not None else None
+
+    async def orderedResults(self, coroutine_function , items , window : int):
+        """Runs coroutine_function on the items with at most window of them in flight, and yields the results in the items order."""
+        pending = deque()
+        items = iter(items)
+        for item in itertools.islice(items , window):
+            pending.append(asyncio.ensure_future(coroutine_function(*item)))
+        try:
+            while len(pending) > 0:
+                result = await pending.popleft()
+                for item in itertools.islice(items , 1):
+                    pending.append(asyncio.ensure_future(coroutine_function(*item)))
+                yield result
+        finally:
+            for task in pending: # the client went away, or the response was truncated.
+                task.cancel()
+
+    ### Routes ###
+
+    async def healthcheck(self, request):
+        return self.jsonResponse(200 , "OK")
+
+    async def metrics(self, request):
+        return web.Response(status=200 , body=orjson.dumps(self.proxy._getMetrics()) , content_type="application/json")
+
+    def qido(self, level : str):
+        async def handler(request):
+            args = { key : request.query.get(key) for key in request.query.keys() }
+            parameters = self.proxy._processParameters(level=level , args=args)
+            if "StudyInstanceUID" in request.match_info:
+                parameters["StudyInstanceUID"] = request.match_info["StudyInstanceUID"]
+            if "SeriesInstanceUID" in request.match_info:
+                parameters["SeriesInstanceUID"] = request.match_info["SeriesInstanceUID"]
+            return await self.qidoResponse(request , parameters)
+        return handler
+
+    async def qidoResponse(self, request , parameters : dict):
+        """Same representation, caching and pagination as the QIDO-RS resources of the threaded server."""
+        qido_cache = self.proxy.qido_cache
+        cached = qido_cache.get(parameters) if qido_cache is not None else None
+        headers = {}
+        if cached is not None:
+            if cached["continuation_token"] is not None:
+                headers = {"X-Continuation-Token" : cached["continuation_token"] , "Access-Control-Expose-Headers" : "X-Continuation-Token"}
+            return web.Response(status=200 , body=cached["content"] , content_type="application/dicom+json" , headers=headers)
+        try:
+            query , query_parameters = self.proxy._constructQuery(parameters)
+        except ValueError as err:
+            return self.jsonResponse(400 , str(err))
+        continuation_token = None
+        if self.proxy._usesKeysetPagination(parameters):
+            field_names , db_results = await self.executeQuery(query , query_parameters)
+            continuation_token = self.proxy._nextContinuationToken(parameters , field_names , db_results)
+            if continuation_token is not None:
+                headers = {"X-Continuation-Token" : continuation_token , "Access-Control-Expose-Headers" : "X-Continuation-Token"}
+            json_chunks = self.proxy.jsonArrayYield(self.proxy._convertToJSON(field_names , db_results , parameters))
+            body = await self.run(lambda: b"".join(self.proxy.qidoResponseYield(json_chunks , parameters , continuation_token)))
+            return web.Response(status=200 , body=body , content_type="application/dicom+json" , headers=headers)
+        response = web.StreamResponse(status=200 , headers={"Content-Type" : "application/dicom+json"})
+        response.headers.update(asyncServer.CORS_HEADERS)
+        await response.prepare(request)
+        await self.streamQuery(response , query , query_parameters , parameters)
+        await response.write_eof()
+        return response
+
+    async def streamQuery(self, response : web.StreamResponse , query : str , query_parameters , parameters : dict , batch_size : int = 1000):
+        """Streams the results of an unlimited QIDO-RS query as a JSON array, fetched in batches from an unbuffered server side cursor and converted in the executor."""
+        content = [] if self.proxy.qido_cache is not None else None
+        content_size = 0
+        async with self.sql_pool.acquire() as sql_conn:
+            async with sql_conn.cursor(aiomysql.SSCursor) as cursor:
+                await cursor.execute(query , query_parameters)
+                field_names = [i[0] for i in cursor.description]
+                prefix = b"["
+                while True:
+                    batch = await cursor.fetchmany(batch_size)
+                    if len(batch) == 0:
+                        break
+                    chunk = prefix + await self.run(lambda: b",".join( orjson.dumps(item) for item in self.proxy._convertToJSON(field_names , batch , parameters) ))
+                    prefix = b","
+                    if content is not None:
+                        content.append(chunk)
+                        content_size += len(chunk)
+                        if content_size > self.proxy.qido_cache.cache.max_bytes:
+                            content = None
+                    await response.write(chunk)
+        tail = b"]" if prefix == b"," else b"[]"
+        await response.write(tail)
+        if content is not None:
+            content.append(tail)
+            self.proxy.qido_cache.put(parameters , b"".join(content))
+
+    async def invalidateStudy(self, request):
+        qido_cache = self.proxy.qido_cache
+        invalidated = qido_cache.invalidateStudy(request.match_info["StudyInstanceUID"]) if qido_cache is not None else 0
+        return web.Response(status=200 , body=orjson.dumps({"invalidated" : invalidated}) , content_type="application/json")
+
+    async def retrieveStudies(self, request):
+        StudyInstanceUID = request.match_info["StudyInstanceUID"]
+        args = { key : request.query.get(key) for key in request.query.keys() }
+        parameters = self.proxy._processParameters(level="STUDY" , args=args)
+        parameters["StudyInstanceUID"] = StudyInstanceUID
+        parameters["wherefields"]["0020000D"] = StudyInstanceUID
+        return await self.qidoResponse(request , parameters)
+
+    def metadata(self, level : str , query : str , uid_key : str):
+        async def handler(request):
+            return await self.metadataResponse(request , level , query , request.match_info[uid_key])
+        return handler
+
+    async def metadataResponse(self, request , level : str , query : str , UID : str):
+        """Same representation and caching as the metadata resources of the threaded server."""
+        gzip_response = 'gzip' in request.headers.get('Accept-Encoding','').lower()
+        cache_key = f"{level}/{UID}"
+        metadata_responses = self.proxy.metadata_responses
+        cached = metadata_responses.get(cache_key) if metadata_responses is not None else None
+        if cached is not None:
+            headers = {"ETag" : cached["etag"]}
+            if cached["etag"] in request.headers.get('If-None-Match',''):
+                return web.Response(status=304 , headers=headers)
+            if gzip_response:
+                headers["Content-Encoding"] = "gzip"
+                return web.Response(status=200 , body=cached["content"] , content_type="application/dicom+json" , headers=headers)
+            body = await self.run(gzip.decompress , cached["content"])
+            return web.Response(status=200 , body=body , content_type="application/dicom+json" , headers=headers)
+        fields , results = await self.executeQuery(query , (UID,))
+        instances = self.proxy.metadataYield(query , UID , results=results)
+        first_instance = await self.run(next , instances , None)
+        if first_instance is None:
+            return self.jsonResponse(400 , [])
+        etag = f'W/"{uuid4().hex}"'
+        response = web.StreamResponse(status=200 , headers={"Content-Type" : "application/dicom+json"})
+        if gzip_response:
+            response.headers["Content-Encoding"] = "gzip"
+        if metadata_responses is not None:
+            response.headers["ETag"] = etag
+        response.headers.update(asyncServer.CORS_HEADERS)
+        await response.prepare(request)
+        json_chunks = self.proxy.jsonArrayYield(itertools.chain([first_instance] , instances))
+        await self.streamChunks(response , self.proxy.metadataResponseYield(json_chunks , cache_key , etag , gzip_response))
+        await response.write_eof()
+        return response
+
+    async def frames(self, request):
+        SeriesInstanceUID = request.match_info["SeriesInstanceUID"]
+        InstanceUID = request.match_info["InstanceUID"]
+        Frames = request.match_info["Frames"]
+        try:
+            frame_list = [int(i) for i in Frames.split(",")]
+        except ValueError:
+            return self.jsonResponse(400 , f"Invalid frame list : {Frames}")
+        frame_index = self.proxy.metadataCache.frame_index
+        frame_refs = frame_index.getFrames(InstanceUID , frame_list , read_through=False)
+        if frame_refs is None and frame_index.loader is not None and frame_index.needsLoad(InstanceUID):
+            fields , rows = await self.executeQuery(sql_queries.WADO_INSTANCE_FRAMES , (InstanceUID,))
+            if frame_index.putRows(InstanceUID , rows):
+                frame_refs = frame_index.getFrames(InstanceUID , frame_list , read_through=False)
+        if frame_refs is not None:
+            self.proxy._prefetchFromIndex("frames" , InstanceUID , frame_refs)
+        else: # the metadata path applies the prefetch policy itself.
+            fields , results = await self.executeQuery(sql_queries.WADO_INSTANCE_METADATA , (InstanceUID,))
+            frame_refs = await self.run(self.proxy._ResolveFrameReferences , sql_queries.WADO_INSTANCE_METADATA , SeriesInstanceUID , InstanceUID , frame_list , results=results , read_through=False)
+        if frame_refs is None:
+            return self.jsonResponse(404 , f"Frames {Frames} of instance {InstanceUID} not found")
+        passthrough_transfer_syntax = self.proxy._passthroughTransferSyntax(frame_refs[0][3], self.proxy._acceptedTransferSyntaxes(request.headers.get('Accept','')))
+        if passthrough_transfer_syntax is not None:
+            fetch = self.getFrame
+            transfer_syntax = passthrough_transfer_syntax
+        else:
+            fetch = self.getFramePixels
+            transfer_syntax = uid.ExplicitVRLittleEndian
+        boundary = self.proxy.multipart_boundary()
+        response = web.StreamResponse(status=200 , headers={"Content-Type" : 'multipart/related; type="'+self.proxy.get_content_type(transfer_syntax)+'"; boundary='+boundary})
+        compressor = None
+        if 'gzip' in request.headers.get('Accept-Encoding','').lower() and passthrough_transfer_syntax is None:
+            compressor = zlib.compressobj(5 , zlib.DEFLATED , 31)
+            response.headers["Content-Encoding"] = "gzip"
+        response.headers.update(asyncServer.CORS_HEADERS)
+        await response.prepare(request)
+        async with contextlib.aclosing(self.orderedResults(fetch , [ frame_ref[:3] for frame_ref in frame_refs ] , self.proxy.FRAME_FETCH_WORKERS*2)) as frames:
+            async for frame in frames:
+                if frame is None:
+                    self.logger.error("[frames] - A frame could not be retrieved, the response is truncated.")
+                    return response # the multipart response is left unterminated so that the client does not mistake it for a complete one.
+                part = self.proxy.multipart_part(transfer_syntax , frame , boundary)
+                await response.write(compressor.compress(part) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor is not None else part)
+        footer = ('--' + boundary + '--').encode()
+        await response.write(compressor.compress(footer) + compressor.flush() if compressor is not None else footer)
+        await response.write_eof()
+        return response
+
+    async def rendered(self, request):
+        StudyInstanceUID = request.match_info["StudyInstanceUID"]
+        SeriesInstanceUID = request.match_info.get("SeriesInstanceUID")
+        InstanceUID = request.match_info.get("InstanceUID")
+        frame_list = None
+        try:
+            if "Frames" in request.match_info:
+                frame_list = [int(i) for i in request.match_info["Frames"].split(",")]
+            rendering = {
+                "window" : renderer.parseWindow(request.query.get("window")),
+                "viewport" : renderer.parseViewport(request.query.get("viewport")),
+                "quality" : renderer.parseQuality(request.query.get("quality")),
+                "media_type" : renderer.acceptedMediaType(request.headers.get('Accept'))
+            }
+        except ValueError as err:
+            return self.jsonResponse(400 , str(err))
+        if rendering["media_type"] is None:
+            return self.jsonResponse(406 , f"Supported media types : {list(renderer.RENDERED_MEDIA_TYPES.keys())}")
+        if InstanceUID is not None:
+            query , UID = sql_queries.WADO_INSTANCE_METADATA , InstanceUID
+        elif SeriesInstanceUID is not None:
+            query , UID = sql_queries.WADO_SERIES_METADATA , SeriesInstanceUID
+        else:
+            query , UID = sql_queries.WADO_STUDIES_METADATA , StudyInstanceUID
+        fields , results = await self.executeQuery(query , (UID,))
+        targets = await self.run(self.proxy._ResolveRenderingTargets , query , UID , SeriesInstanceUID , InstanceUID , frame_list , results=results)
+        if targets is None or len(targets) == 0:
+            return self.jsonResponse(404 , f"{UID} not found")
+        if InstanceUID is not None and len(targets) == 1:
+            rendered = await self.renderFrame(rendering , *targets[0])
+            if rendered is None:
+                return self.jsonResponse(500 , f"{InstanceUID} could not be rendered")
+            return web.Response(status=200 , body=rendered , content_type=rendering["media_type"])
+        boundary = self.proxy.multipart_boundary()
+        response = web.StreamResponse(status=200 , headers={"Content-Type" : 'multipart/related; type="'+rendering["media_type"]+'"; boundary='+boundary})
+        response.headers.update(asyncServer.CORS_HEADERS)
+        await response.prepare(request)
+        async with contextlib.aclosing(self.orderedResults(self.renderFrame , [ (rendering , *target) for target in targets ] , self.proxy.FRAME_FETCH_WORKERS*2)) as renders:
+            async for rendered in renders:
+                if rendered is not None:
+                    await response.write(self.proxy.multipartEncapsulate(boundary=boundary , content_type=rendering["media_type"] , payload=rendered))
+        await response.write(('--' + boundary + '--').encode())
+        await response.write_eof()
+        return response
+
+    async def renderFrame(self, rendering : dict , datastore_id : str , imageset_id : str , imageframe_id : str , instance_uid : str , frame_number : int , attributes : dict):
+        rendered_cache = self.proxy.rendered_cache
+        cache_key = f"{instance_uid}/{frame_number}/{rendering['window']}/{rendering['viewport']}/{rendering['quality']}/{rendering['media_type']}"
+        if rendered_cache is not None:
+            rendered = rendered_cache.get(cache_key)
+            if rendered is not None:
+                return rendered
+        decoded = await self.getDecodedFrame(datastore_id , imageset_id , imageframe_id)
+        if decoded is None:
+            return None
+        try:
+            rendered = await self.run(renderer.renderFrame , decoded , attributes , window=rendering["window"] , viewport=rendering["viewport"] , quality=rendering["quality"] , media_type=rendering["media_type"])
+        except Exception as err:
+            self.logger.error(f"[renderFrame] - {instance_uid} frame {frame_number} could not be rendered : {err}")
+            return None
+        if rendered_cache is not None:
+            rendered_cache.put(cache_key , rendered , len(rendered))
+        return rendered
+
+    async def retrieveInstance(self, request):
+        return await self.instancesResponse(request , [request.match_info["InstanceUID"]])
+
+    async def retrieveSeries(self, request):
+        fields , results = await self.executeQuery(sql_queries.WADO_INSTANCE_IN_SERIES , (request.match_info["SeriesInstanceUID"],))
+        return await self.instancesResponse(request , [ res[0] for res in results ])
+
+    async def instancesResponse(self, request , instance_uids : list):
+        """Streams the instances as multipart parts. The instances are DICOMized in the executor, as by the threaded server."""
+        boundary = self.proxy.multipart_boundary()
+        response = web.StreamResponse(status=200 , headers={"Content-Type" : 'multipart/related; type="application/dicom"; boundary='+boundary})
+        response.headers.update(asyncServer.CORS_HEADERS)
+        await response.prepare(request)
+        async def retrieve(instance_uid):
+            return await self.run(self.proxy.RetrieveInstance , sql_queries.WADO_INSTANCE_METADATA , instance_uid)
+        async with contextlib.aclosing(self.orderedResults(retrieve , [ (instance_uid,) for instance_uid in instance_uids ] , self.proxy.INSTANCE_FETCH_WORKERS)) as payloads:
+            async for payload in payloads:
+                if payload is not None:
+                    await response.write(self.proxy.multipartEncapsulate(boundary=boundary , content_type="application/dicom" , payload=payload))
+        await response.write(("--"+boundary+"--").encode())
+        await response.write_eof()
+        return response
+
+    async def bulkData(self, request):
+        return web.Response(status=200 , body=b"" , content_type="application/dicom+json")
+
+
+def serve(proxy , db_secret : dict , host : str , port : int , executor_threads : int = 32):
+    server = asyncServer(proxy , db_secret , executor_threads=executor_threads)
+    web.run_app(server.createApp() , host=host , port=port , access_log=None)
@@ -0,0 +1,130 @@
+"""
+Microbenchmark of the AHI metadata to DICOM JSON conversion done by metadataCache for the WADO-RS metadata resources.
+
+Compares the precompiled keyword table conversion with the previous per keyword pydicom dictionary lookups, on a synthetic CT image set.
+
+usage : python benchmarks/metadataConversionBenchmark.py [number of instances]
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import sys
+import time
+import collections.abc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pydicom import datadict
+from metadataCache import metadataCache
+
+
+def legacyGetJSONKeys(tagblock : object):
+    dicom_set = dict()
+    for key in tagblock.keys():
+        try:
+            tag = datadict.tag_for_keyword(key)
+            vr = datadict.dictionary_VR(key)
+        except Exception as err:
+            continue
+        hex_tag = metadataCache.get8CharTag(hex(tag))
+        value = tagblock[key]
+        if vr == "IS" and isinstance(value , str):
+            value = int(value)
+        if vr == "SQ":
+            dicom_set[hex_tag] = { "vr" : vr , "Value" : [legacyGetJSONKeys(subelement) for subelement in value]}
+        elif value is None:
+            dicom_set[hex_tag] = { "vr" : vr }
+        elif isinstance(value , collections.abc.Sequence) and not isinstance(value,str):
+            dicom_set[hex_tag] = { "vr" : vr , "Value" : value}
+        else:
+            dicom_set[hex_tag] = { "vr" : vr , "Value" : [value]}
+    return dicom_set
+
+
+def syntheticImageSet(instance_count : int):
+    instances = {}
+    for number in range(1, instance_count+1):
+        sop_uid = f"1.2.826.0.1.3680043.8.498.{number}"
+        instances[sop_uid] = {
+            "DICOM" : {
+                "SOPClassUID" : "1.2.840.10008.5.1.4.1.1.2",
+                "SOPInstanceUID" : sop_uid,
+                "InstanceNumber" : str(number),
+                "ImageType" : ["ORIGINAL", "PRIMARY", "AXIAL"],
+                "ImagePositionPatient" : [-250.0, -250.0, -0.625*number],
+                "ImageOrientationPatient" : [1.0, 0.0, 0.0, 0.0, 1.0, 0.0],
+                "SliceLocation" : -0.625*number,
+                "SliceThickness" : 0.625,
+                "PixelSpacing" : [0.48828125, 0.48828125],
+                "Rows" : 512,
+                "Columns" : 512,
+                "BitsAllocated" : 16,
+                "BitsStored" : 16,
+                "HighBit" : 15,
+                "PixelRepresentation" : 1,
+                "SamplesPerPixel" : 1,
+                "PhotometricInterpretation" : "MONOCHROME2",
+                "RescaleIntercept" : -1024.0,
+                "RescaleSlope" : 1.0,
+                "WindowCenter" : [40.0, 400.0],
+                "WindowWidth" : [400.0, 1500.0],
+                "AcquisitionNumber" : "1",
+                "ContentDate" : "20240101",
+                "ContentTime" : "101010",
+                "KVP" : 120.0,
+                "ReferencedImageSequence" : [{ "ReferencedSOPClassUID" : "1.2.840.10008.5.1.4.1.1.2" , "ReferencedSOPInstanceUID" : "1.2.826.0.1.3680043.8.498.0" }],
+            },
+            "ImageFrames" : [{ "ID" : f"{number:032x}" }]
+        }
+    return {
+        "DatastoreID" : "0"*32,
+        "ImageSetID" : "1"*32,
+        "Patient" : { "DICOM" : { "PatientName" : "DOE^JOHN" , "PatientID" : "123456" , "PatientBirthDate" : "19700101" , "PatientSex" : "M" } },
+        "Study" : {
+            "DICOM" : { "StudyInstanceUID" : "1.2.826.0.1.3680043.8.498.1000" , "StudyDate" : "20240101" , "StudyTime" : "101010" , "AccessionNumber" : "ACC1" , "StudyDescription" : "CT CHEST" , "StudyID" : "1" },
+            "Series" : {
+                "1.2.826.0.1.3680043.8.498.2000" : {
+                    "DICOM" : { "SeriesInstanceUID" : "1.2.826.0.1.3680043.8.498.2000" , "Modality" : "CT" , "SeriesNumber" : "2" , "SeriesDescription" : "AXIAL 0.625" , "FrameOfReferenceUID" : "1.2.826.0.1.3680043.8.498.3000" },
+                    "Instances" : instances
+                }
+            }
+        }
+    }
+
+
+def legacyConversion(metadata : object):
+    series_uid = next(iter(metadata["Study"]["Series"].keys()))
+    patient_dict = legacyGetJSONKeys(metadata["Patient"]["DICOM"])
+    study_dict = legacyGetJSONKeys(metadata["Study"]["DICOM"])
+    series_dict = legacyGetJSONKeys(metadata["Study"]["Series"][series_uid]["DICOM"])
+    result = []
+    for instance in metadata["Study"]["Series"][series_uid]["Instances"].values():
+        complete_instance = { **patient_dict , **study_dict , **series_dict , **legacyGetJSONKeys(instance["DICOM"]) }
+        result.append(dict(sorted(complete_instance.items())))
+    return result
+
+
+def currentConversion(metadata : object):
+    series_uid = next(iter(metadata["Study"]["Series"].keys()))
+    patient_dict , study_dict , series_dict = metadataCache.getJSONBlocks(metadata)
+    return [ metadataCache.getInstancedDict(instance_uid=instance_uid , metadata=metadata , patient_dict=patient_dict , study_dict=study_dict , series_dict=series_dict) for instance_uid in metadata["Study"]["Series"][series_uid]["Instances"].keys() ]
+
+
+def timeIt(function , metadata : object , rounds : int = 5):
+    best = None
+    for round in range(rounds):
+        start = time.perf_counter()
+        result = function(metadata)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best , result
+
+
+if __name__ == '__main__':
+    instance_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    metadata = syntheticImageSet(instance_count)
+    legacy_time , legacy_result = timeIt(legacyConversion , metadata)
+    current_time , current_result = timeIt(currentConversion , metadata)
+    assert legacy_result == current_result , "the conversions differ"
+    print(f"{instance_count} instances")
+    print(f"legacy   : {legacy_time*1000:8.1f} ms  {legacy_time*1000000/instance_count:6.1f} us/instance")
+    print(f"current  : {current_time*1000:8.1f} ms  {current_time*1000000/instance_count:6.1f} us/instance")
+    print(f"speed-up : {legacy_time/current_time:8.1f}x")
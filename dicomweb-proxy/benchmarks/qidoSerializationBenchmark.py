@@ -0,0 +1,73 @@
+"""
+Microbenchmark of the database rows to DICOM JSON conversion of the QIDO-RS responses.
+
+Compares the compiled serialization plan of _convertToJSON with the previous per row pydicom Dataset conversion, on synthetic instance level rows.
+
+usage : python benchmarks/qidoSerializationBenchmark.py [number of rows]
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pydicom
+from pydicom import Dataset , DataElement
+import main
+from db_mappings import *
+
+
+def legacyConvertToJSON(column_index , db_results , params: dict):
+    tagDict = instanceTagsTofields if "INSTANCE" in params["queryLevel"] else seriesTagsTofields if "SERIES" in params["queryLevel"] else studyTagsTofields
+    json_array = []
+    for result in db_results:
+        ds = Dataset()
+        for tag in tagDict:
+            try:
+                index = column_index.index(tagDict[tag].lower())
+                tagvalue = main._serializeValue(result[index])
+                if ( pydicom.datadict.dictionary_VR(tag) == "CS" ) and ( "/" in tagvalue):
+                    tagvalue = tagvalue.split("/")
+                ds.add(DataElement(tag, pydicom.datadict.dictionary_VR(tag) , tagvalue))
+            except BaseException as err:
+                pass
+        for tag in params["includefield"]:
+            try:
+                index = column_index.index(tagDict[tag].lower())
+                tagvalue = main._serializeValue(result[index])
+                ds.add(DataElement(tag, pydicom.datadict.dictionary_VR(tag) , tagvalue))
+            except BaseException as err:
+                pass
+        json_array.append(ds.to_json_dict())
+    return json_array
+
+
+def syntheticRows(row_count : int):
+    column_index = ["instance_pkey" , "series_pkey" , "sopinstanceuid" , "sopclassuid" , "instancenumber" , "modality" , "d00080056" , "d00080201" , "d00081190" , "rows" , "columns" , "bitallocated" , "numberofframes" , "studyinstanceuid" , "seriesinstanceuid"]
+    rows = []
+    for number in range(row_count):
+        rows.append((number , 1 , f"1.2.826.0.1.3680043.8.498.{number}" , "1.2.840.10008.5.1.4.1.1.2" , number+1 , "CT/SEG" if number % 10 == 0 else "CT" , "ONLINE" , "" , None , 512 , 512 , 16 , None , "1.2.826.0.1.3680043.8.498.1000" , "1.2.826.0.1.3680043.8.498.2000"))
+    return column_index , rows
+
+
+def timeIt(function , rounds : int = 5):
+    best = None
+    for round in range(rounds):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best , result
+
+
+if __name__ == '__main__':
+    row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    column_index , rows = syntheticRows(row_count)
+    params = { "queryLevel" : "STUDY.SERIES.INSTANCE" , "includefield" : ["00080060"] }
+    legacy_time , legacy_result = timeIt(lambda: legacyConvertToJSON(column_index , rows , params))
+    current_time , current_result = timeIt(lambda: list(main._convertToJSON(column_index , rows , params)))
+    assert legacy_result == current_result , "the conversions differ"
+    print(f"{row_count} rows")
+    print(f"legacy   : {legacy_time*1000:8.1f} ms  {legacy_time*1000000/row_count:6.1f} us/row")
+    print(f"current  : {current_time*1000:8.1f} ms  {current_time*1000000/row_count:6.1f} us/row")
+    print(f"speed-up : {legacy_time/current_time:8.1f}x")
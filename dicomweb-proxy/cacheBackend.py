@@ -0,0 +1,283 @@
+"""
+cacheBackend Module : Key value stores of the compressed image set metadata and of the image frames, shared by the service tasks of a deployment.
+
+Backends :
+    memory : an LRU cache in the memory of the service process.
+    disk : one file per key under a folder, which can be a network file system mounted by all the service tasks.
+    redis : one or more Redis protocol servers ( Redis, Valkey, ElastiCache ... ). The keys are spread over the servers with consistent hashing, so
+            that adding or removing a server only moves the keys of that server. A server which does not respond is skipped for RETRY_AFTER seconds,
+            its keys going to the next server of the ring meanwhile.
+
+The backends are configured with a specification string : "none", "memory", "disk", "disk:/path/to/folder" or "redis://host:port,host:port/db".
+The values larger than the maximum object size are not stored. A backend failure is logged and counted, and behaves as a cache miss.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import bisect
+import hashlib
+import threading
+import logging
+import time
+import redis
+from redis.retry import Retry
+from redis.backoff import NoBackoff
+from lruCache import lruCache
+
+
+CACHE_BACKENDS = ["none" , "memory" , "disk" , "redis"]
+VIRTUAL_NODES = 160 # points of each server on the hash ring, evening out the share of the keys of each server.
+RETRY_AFTER = 5 # seconds a server which failed is skipped for.
+
+
+def getCacheBackend(spec : str , name : str , default_root : str = None , max_object_size_mb : int = 64 , memory_size_mb : int = 1024 , ttl : int = 86400 , timeout : float = 0.5):
+    """Returns the backend described by spec, None for "none".
+    name : namespace of the keys, so that several backends can share the same servers.
+    default_root : folder of the "disk" backend when spec does not give one.
+    ttl : time to live of the values in seconds, for the memory and redis backends. 0 disables the expiration.
+    timeout : socket timeout in seconds of the redis backend."""
+    max_object_size = max_object_size_mb*1024*1024
+    kind , _ , location = spec.partition(":")
+    match kind.lower():
+        case "none":
+            return None
+        case "memory":
+            return memoryCacheBackend(name , max_object_size , memory_size_mb , ttl)
+        case "disk":
+            root = location if location != "" else default_root
+            if root is None:
+                raise ValueError(f"the {name} disk cache backend requires a folder : disk:/path/to/folder")
+            return diskCacheBackend(name , max_object_size , root)
+        case "redis":
+            return redisCacheBackend(name , max_object_size , _parseNodes(location) , ttl , timeout)
+        case _:
+            raise ValueError(f"unknown cache backend {spec} for {name}, expected one of {CACHE_BACKENDS}")
+
+
+def _parseNodes(location : str):
+    """Parses //host:port,host:port/db in a list of (host, port, db) tuples."""
+    location = location.removeprefix("//")
+    hosts , _ , db = location.partition("/")
+    db = int(db) if db != "" else 0
+    nodes = []
+    for address in hosts.split(","):
+        host , _ , port = address.strip().partition(":")
+        if host == "":
+            raise ValueError(f"invalid redis server address in {location}")
+        nodes.append((host , int(port) if port != "" else 6379 , db))
+    return nodes
+
+
+class cacheBackend:
+    """Common part of the backends : the object size limit and the statistics."""
+
+    shared = False # True when the values are visible to the other processes and tasks.
+
+    def __init__(self, name : str , max_object_size : int):
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.max_object_size = max_object_size
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.oversized = 0
+        self.errors = 0
+        self.lock = threading.Lock() # the backends are used by the threads of the executors.
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _count(self, counter : str):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key : str):
+        """Returns the bytes stored under key, None if not found."""
+        try:
+            value = self._get(key)
+        except Exception as err:
+            self._count("errors")
+            self.logger.warning(f"[{self.name}] - {key} could not be read from the cache backend : {err}")
+            value = None
+        self._count("misses" if value is None else "hits")
+        return value
+
+    def put(self, key : str , value : bytes):
+        """Stores the value under key. Returns False if it was not stored."""
+        if len(value) > self.max_object_size:
+            self._count("oversized")
+            self.logger.debug(f"[{self.name}] - {key} is {len(value)} bytes, larger than the maximum object size of {self.max_object_size} bytes. Not cached.")
+            return False
+        try:
+            self._put(key , value)
+            self._count("puts")
+            return True
+        except Exception as err:
+            self._count("errors")
+            self.logger.warning(f"[{self.name}] - {key} could not be written to the cache backend : {err}")
+            return False
+
+    def delete(self, key : str):
+        try:
+            self._delete(key)
+        except Exception as err:
+            self._count("errors")
+            self.logger.warning(f"[{self.name}] - {key} could not be deleted from the cache backend : {err}")
+
+    def getStats(self):
+        with self.lock:
+            hits , misses , puts , oversized , errors = self.hits , self.misses , self.puts , self.oversized , self.errors
+        lookups = hits + misses
+        return {
+            "backend" : self.kind,
+            "hits" : hits,
+            "misses" : misses,
+            "hit_rate" : round(hits / lookups, 4) if lookups > 0 else None,
+            "puts" : puts,
+            "oversized" : oversized,
+            "errors" : errors,
+            "max_object_size" : self.max_object_size
+        }
+
+
+class memoryCacheBackend(cacheBackend):
+
+    kind = "memory"
+
+    def __init__(self, name : str , max_object_size : int , memory_size_mb : int , ttl : int):
+        super().__init__(name , max_object_size)
+        self.cache = lruCache(max_bytes=memory_size_mb*1024*1024 , ttl=ttl , name=name)
+
+    def _get(self, key : str):
+        return self.cache.get(key)
+
+    def _put(self, key : str , value : bytes):
+        self.cache.put(key , value , len(value))
+
+    def _delete(self, key : str):
+        self.cache.delete(key)
+
+    def getStats(self):
+        stats = super().getStats()
+        stats["bytes"] = self.cache.current_bytes
+        return stats
+
+
+class diskCacheBackend(cacheBackend):
+    """Stores each value in {root}/{key}, the / of the key making sub folders."""
+
+    kind = "disk"
+    shared = True
+
+    def __init__(self, name : str , max_object_size : int , root : str):
+        super().__init__(name , max_object_size)
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key : str):
+        if ".." in key.split("/"):
+            raise ValueError(f"invalid key {key}")
+        return f"{self.root}/{key}"
+
+    def _get(self, key : str):
+        try:
+            with open(self._path(key), 'rb') as value_file:
+                return value_file.read()
+        except FileNotFoundError:
+            return None
+
+    def _put(self, key : str , value : bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so that a concurrent reader, possibly in another task, never sees a partial value.
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as value_file:
+            value_file.write(value)
+        os.replace(tmp_path, path)
+
+    def _delete(self, key : str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class redisCacheBackend(cacheBackend):
+
+    kind = "redis"
+    shared = True
+
+    def __init__(self, name : str , max_object_size : int , nodes : list , ttl : int = 86400 , timeout : float = 0.5):
+        """
+        nodes : (host, port, db) of the servers.
+        """
+        super().__init__(name , max_object_size)
+        self.nodes = nodes
+        self.ttl = ttl
+        self.timeout = timeout
+        self.prefix = f"dicomweb-proxy:{name}:"
+        self.ring = sorted( (_ringHash(f"{host}:{port}/{db}#{point}") , node) for node , (host , port , db) in enumerate(nodes) for point in range(VIRTUAL_NODES) )
+        self.ring_hashes = [ ring_hash for ring_hash , node in self.ring ]
+        self._initLocal()
+
+    def _initLocal(self):
+        # redis.Redis is thread safe, each client has its own connection pool. A failed call is not retried : it is a cache miss, and the server is skipped.
+        self.clients = [ redis.Redis(host=host , port=port , db=db , socket_timeout=self.timeout , socket_connect_timeout=self.timeout , retry=Retry(NoBackoff() , 0)) for host , port , db in self.nodes ]
+        self.down_until = [0.0]*len(self.nodes)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        del state["clients"]
+        del state["down_until"]
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._initLocal()
+
+    def nodeFor(self, key : str):
+        """Returns the index of the server holding the key : the first server up after the key on the ring. None if all the servers are down."""
+        now = time.monotonic()
+        start = bisect.bisect(self.ring_hashes , _ringHash(key))
+        for point in range(len(self.ring)):
+            node = self.ring[(start + point) % len(self.ring)][1]
+            if self.down_until[node] <= now:
+                return node
+        return None
+
+    def _call(self, key : str , operation):
+        node = self.nodeFor(key)
+        if node is None:
+            raise ConnectionError("no cache server available")
+        try:
+            return operation(self.clients[node] , self.prefix+key)
+        except (redis.ConnectionError , redis.TimeoutError):
+            self.down_until[node] = time.monotonic() + RETRY_AFTER
+            self.logger.warning(f"[{self.name}] - cache server {self.nodes[node][0]}:{self.nodes[node][1]} skipped for {RETRY_AFTER} seconds.")
+            raise
+
+    def _get(self, key : str):
+        return self._call(key , lambda client , server_key : client.get(server_key))
+
+    def _put(self, key : str , value : bytes):
+        self._call(key , lambda client , server_key : client.set(server_key , value , ex=self.ttl if self.ttl > 0 else None))
+
+    def _delete(self, key : str):
+        self._call(key , lambda client , server_key : client.delete(server_key))
+
+    def getStats(self):
+        stats = super().getStats()
+        now = time.monotonic()
+        stats["servers"] = len(self.nodes)
+        stats["servers_down"] = sum( 1 for down_until in self.down_until if down_until > now )
+        return stats
+
+
+def _ringHash(value : str):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "little")
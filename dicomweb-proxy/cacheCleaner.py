@@ -3,60 +3,123 @@ import shutil
 import time
 import threading
 import logging
+import queue
+import multiprocessing
+from collections import OrderedDict
 
 
 
 class cacheCleaner:
 
-    
+    MAX_EVENTS_PER_DRAIN = 10000
 
-    def __init__(self, cached_items , cache_root : set, low_watermark : int = None, high_watermark : int = None) :
+    def __init__(self, cache_index , cache_root : set, low_watermark : int = None, high_watermark : int = None , frame_store = None) :
         self.logger = logging.getLogger(__name__)
         if low_watermark is None:
             low_watermark = 5 #Cache cleaner will trigger when 5Gb of space remains on the cache volume.
         if high_watermark is None: #Once triggered Cache Cleaner will stop removing files when there is 15GB of free space.
             high_watermark = 15
-        self.cacheProcessor = threading.Thread(target=self.chekAndClean, args=(cached_items,cache_root, low_watermark*1024, high_watermark*1024))
+        self.cache_root = cache_root
+        self.cache_index = cache_index # cacheIndex of the frames queued or cached, None if not used.
+        self.frame_store = frame_store # lists the frames already on disk at startup, to fill the cache index.
+        self.index = OrderedDict() # "datastore_id/imageset_id" -> cached bytes, least recently accessed first.
+        self.index_lock = threading.Lock()
+        self.indexed_bytes = 0
+        self.evicted_imagesets = 0
+        self.evicted_bytes = 0
+        self.cacheEvents = multiprocessing.get_context('spawn').Queue() # (datastore_id, imageset_id, size) tuples sent by the frame fetcher processes when a frame is stored.
+        self.indexBuilder = threading.Thread(target=self.rebuildIndex, args=(cache_root,), daemon=True)
+        self.indexBuilder.start()
+        self.cacheProcessor = threading.Thread(target=self.chekAndClean, args=(cache_root, low_watermark*1024, high_watermark*1024))
         self.cacheProcessor.start()
-    
 
-    def chekAndClean(self, cached_items : set, cache_root, low_watermark , high_watermark):
+    def recordAccess(self, datastore_id : str , imageset_id : str , size : int = 0):
+        """Marks the image set as most recently used, and adds size bytes to its cached size."""
+        key = datastore_id+"/"+imageset_id
+        with self.index_lock:
+            self.index[key] = self.index.get(key, 0) + size
+            self.index.move_to_end(key)
+            self.indexed_bytes += size
+
+    def rebuildIndex(self, cache_root):
+        """Indexes the image sets already on disk at startup, oldest modified first, ahead of the ones accessed since."""
+        try:
+            for datastore in os.scandir(cache_root):
+                if not datastore.is_dir() or datastore.name == "metadata":
+                    continue
+                imagesets = sorted(( entry for entry in os.scandir(datastore.path) if entry.is_dir() ), key=lambda entry: entry.stat().st_mtime, reverse=True)
+                for imageset in imagesets:
+                    size = sum( entry.stat().st_size for entry in os.scandir(imageset.path) if entry.is_file() )
+                    key = datastore.name+"/"+imageset.name
+                    if self.cache_index is not None and self.frame_store is not None and not self.cache_index.hasImageset(key):
+                        self.cache_index.markCached(key, self.frame_store.listFrames(datastore.name, imageset.name))
+                    with self.index_lock:
+                        if key in self.index: # accessed since the startup : keeps its recency, with the size found on disk.
+                            self.index[key] += size
+                        else:
+                            self.index[key] = size
+                            self.index.move_to_end(key, last=False)
+                        self.indexed_bytes += size
+            self.logger.info(f"Cache index rebuilt with {len(self.index)} image sets.")
+        except Exception as err:
+            self.logger.error(f"Cache index could not be rebuilt : {err}")
+
+    def chekAndClean(self, cache_root, low_watermark , high_watermark):
         while(True):
-            try: 
+            try:
+                self.drainEvents(timeout=5)
                 freespace = self.getFreeSpace(cache_root)
-                while(freespace < low_watermark) :
+                if freespace < low_watermark:
                     self.logger.warning("Low watermark reached. Starting clean-up.")
-                    paths = sorted( [x[0] for x in os.walk(cache_root)], key=os.path.getctime)
-                    path=paths[1] # [0] is the cache root itself.
-                    for path in paths:
-                        try:
-                            for file in os.listdir(path):
-                                # check only text files
-                                if file.endswith('.cache'):
-                                    try:
-                                        try:
-                                            cached_items.remove(os.path.join(path[len(cache_root)+1:],file[:-6]))
-                                        except:
-                                            pass #entry is not in the cache ( could be the case if the service has rebooted)
-                                        os.remove(os.path.join(path,file))
-                                    except Exception as err:
-                                        print(err)
-                            try:
-                                os.removedirs(path)
-                            except:
-                                pass #some files could have spawned in the folder in-between, unlikely...
-                        except Exception as err:
-                            print(err)
-                        if (self.getFreeSpace(cache_root) >  high_watermark) :
-                            self.logger.warning("High watermark reached. stoping clean-up.")
-                            break 
-                    freespace = self.getFreeSpace(cache_root)
-                time.sleep(5)
+                    while freespace < high_watermark:
+                        if not self.evictOldest(cache_root):
+                            break
+                        freespace = self.getFreeSpace(cache_root)
+                    if freespace < high_watermark:
+                        self.logger.warning("No cached image set left to evict before the high watermark. stoping clean-up.")
+                    else:
+                        self.logger.warning("High watermark reached. stoping clean-up.")
             except:
                 #catching the thread if it falls
                 self.logger.error("Cache Cleaner thread encountered an issue and will be restored in 5 seconds.")
                 time.sleep(5)
-                self.chekAndClean(cached_items , cache_root, low_watermark , high_watermark)
+
+    def drainEvents(self, timeout : int):
+        """Applies the frame store events sent by the fetcher processes, waiting up to timeout seconds for the first one."""
+        try:
+            event = self.cacheEvents.get(timeout=timeout)
+            for drained in range(cacheCleaner.MAX_EVENTS_PER_DRAIN): # bounded, so that the free space is checked regularly under sustained prefetch.
+                self.recordAccess(*event)
+                event = self.cacheEvents.get_nowait()
+        except queue.Empty:
+            pass
+
+    def evictOldest(self, cache_root):
+        with self.index_lock:
+            if len(self.index) == 0:
+                return False
+            key , size = self.index.popitem(last=False)
+            self.indexed_bytes -= size
+        if self.cache_index is not None:
+            self.cache_index.evictImageset(key)
+        shutil.rmtree(os.path.join(cache_root, key), ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(os.path.join(cache_root, key))) # datastore folder, if empty.
+        except OSError:
+            pass
+        self.evicted_imagesets += 1
+        self.evicted_bytes += size
+        self.logger.debug(f"Evicted {key} , {size} bytes.")
+        return True
+
+    def getStats(self):
+        with self.index_lock:
+            return {
+                "imagesets" : len(self.index),
+                "bytes" : self.indexed_bytes,
+                "evicted_imagesets" : self.evicted_imagesets,
+                "evicted_bytes" : self.evicted_bytes
+            }
 
     def getFreeSpace(self, directory):
         stat = shutil.disk_usage(directory)
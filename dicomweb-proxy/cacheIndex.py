@@ -0,0 +1,155 @@
+"""
+cacheIndex Module : Persistent index of the frames queued for prefetch or stored in the frame cache.
+
+The index is a SQLite database in WAL mode stored in the cache root, so that it survives restarts and is shared by the service, the frame fetcher
+processes, the cache cleaner, and the other services using the same cache root. Each thread uses its own connection.
+
+A frame is either queued, by the process which will fetch it, or cached. A queued frame which was not stored within QUEUED_TTL, e.g. because the
+process queuing it stopped, can be queued again.
+
+The frame fetcher threads record the frames they store with markCachedLater : a writer thread of the process records them every FLUSH_INTERVAL in a
+single transaction, so that the download threads do not each wait for the database write lock.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import time
+import sqlite3
+import threading
+import logging
+
+
+QUEUED = 0
+CACHED = 1
+QUEUED_TTL = 600 # seconds
+FLUSH_INTERVAL = 0.2 # seconds
+QUERY_CHUNK = 500 # frame ids per query, under the SQLite limit of bound parameters.
+
+
+class cacheIndex:
+
+    def __init__(self, db_path : str):
+        """
+        db_path : path of the SQLite database, created if it does not exist.
+        """
+        self.db_path = db_path
+        self._initLocal()
+        with self._connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS frames (imageset TEXT NOT NULL, frame TEXT NOT NULL, state INTEGER NOT NULL, size INTEGER NOT NULL, updated REAL NOT NULL, PRIMARY KEY (imageset, frame)) WITHOUT ROWID")
+
+    def _initLocal(self):
+        self.logger = logging.getLogger(__name__)
+        self.local = threading.local()
+        self.pending = [] # (imageset_key, frame_id, size) of the frames stored, not recorded yet.
+        self.pending_lock = threading.Lock()
+        self.writer = None
+
+    def __getstate__(self):
+        return {"db_path" : self.db_path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._initLocal()
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None) # autocommit, the multi statement updates use explicit transactions.
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL") # the index can lose the last updates on power loss, the frames are then fetched again.
+            self.local.connection = connection
+        return connection
+
+    def claim(self, imageset_key : str , frame_ids : list):
+        """Marks the frames as queued, unless they are already cached or queued. Returns the frame ids marked, which the caller has to fetch."""
+        now = time.time()
+        claimed = []
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for frame_id in frame_ids:
+                cursor = connection.execute("INSERT INTO frames VALUES (?, ?, ?, 0, ?) ON CONFLICT (imageset, frame) DO UPDATE SET updated = excluded.updated WHERE state = ? AND updated < ?",
+                                            (imageset_key , frame_id , QUEUED , now , QUEUED , now - QUEUED_TTL))
+                if cursor.rowcount > 0:
+                    claimed.append(frame_id)
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        return claimed
+
+    def contains(self, imageset_key : str , frame_id : str):
+        """True if the frame is cached or queued."""
+        row = self._connection().execute("SELECT state, updated FROM frames WHERE imageset = ? AND frame = ?", (imageset_key , frame_id)).fetchone()
+        return row is not None and (row[0] == CACHED or row[1] >= time.time() - QUEUED_TTL)
+
+    def containing(self, imageset_key : str , frame_ids : list):
+        """Returns the set of the frame ids which are cached or queued."""
+        found = set()
+        expired = time.time() - QUEUED_TTL
+        connection = self._connection()
+        for start in range(0, len(frame_ids), QUERY_CHUNK):
+            chunk = frame_ids[start:start+QUERY_CHUNK]
+            rows = connection.execute(f"SELECT frame FROM frames WHERE imageset = ? AND frame IN ({','.join('?'*len(chunk))}) AND (state = ? OR updated >= ?)",
+                                      (imageset_key , *chunk , CACHED , expired)).fetchall()
+            found.update( row[0] for row in rows )
+        return found
+
+    def isCached(self, imageset_key : str , frame_id : str):
+        row = self._connection().execute("SELECT state FROM frames WHERE imageset = ? AND frame = ?", (imageset_key , frame_id)).fetchone()
+        return row is not None and row[0] == CACHED
+
+    def markCached(self, imageset_key : str , frames : list):
+        """Records the (frame_id, size) frames as stored in the frame cache."""
+        self._writeCached([ (imageset_key , frame_id , size) for frame_id , size in frames ])
+
+    def markCachedLater(self, imageset_key : str , frame_id : str , size : int):
+        """Records the frame as stored within FLUSH_INTERVAL, in a transaction shared with the frames stored meanwhile by the other threads of the process."""
+        with self.pending_lock:
+            self.pending.append((imageset_key , frame_id , size))
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._writePending, daemon=True)
+                self.writer.start()
+
+    def _writePending(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        """Records the frames passed to markCachedLater."""
+        with self.pending_lock:
+            rows , self.pending = self.pending , []
+        if len(rows) == 0:
+            return
+        try:
+            self._writeCached(rows)
+        except Exception as err:
+            self.logger.error(f"[flush] - {len(rows)} frames could not be recorded as cached : {err}")
+
+    def _writeCached(self, rows : list):
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany("INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?, ?)", [ (imageset_key , frame_id , CACHED , size , now) for imageset_key , frame_id , size in rows ])
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+
+    def forget(self, imageset_key : str , frame_id : str):
+        """Removes a queued frame which could not be fetched, so that it can be queued again."""
+        self._connection().execute("DELETE FROM frames WHERE imageset = ? AND frame = ? AND state = ?", (imageset_key , frame_id , QUEUED))
+
+    def hasImageset(self, imageset_key : str):
+        return self._connection().execute("SELECT 1 FROM frames WHERE imageset = ? AND state = ? LIMIT 1", (imageset_key , CACHED)).fetchone() is not None
+
+    def evictImageset(self, imageset_key : str):
+        self._connection().execute("DELETE FROM frames WHERE imageset = ?", (imageset_key ,))
+
+    def getStats(self):
+        counts = dict(self._connection().execute("SELECT state, COUNT(*) FROM frames GROUP BY state").fetchall())
+        return {
+            "queued_frames" : counts.get(QUEUED, 0),
+            "cached_frames" : counts.get(CACHED, 0)
+        }
@@ -0,0 +1,127 @@
+"""
+decodeEngine Module : Decodes the frames returned by AHI in a pool of worker processes, so that the decoding is not bound to one core by the GIL of the request threads.
+
+The compressed and decoded buffers are exchanged with the workers through shared memory blocks, only their names and sizes are pickled.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import io
+import threading
+import logging
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from openjpeg import decode
+from PIL import Image
+from pydicom import uid
+
+
+def decodeFrame(frame : bytes):
+    """Decodes an HTJ2K frame to its raw pixels. Frames that openjpeg cannot decode are converted to JPEG baseline with PIL.
+    Returns a dict with the pixels, rows, columns, bits and transfer_syntax of the decoded frame."""
+    if not frame:
+        raise ValueError("empty frame")
+    b = io.BytesIO(frame)
+    try:
+        d = decode(b)
+        return {"pixels" : d.tobytes() , "rows" : d.shape[0] , "columns" : d.shape[1] , "bits" : d.dtype.itemsize*8 , "transfer_syntax" : uid.ExplicitVRLittleEndian}
+    except Exception:
+        b.seek(0)
+        with Image.open(b) as img:
+            output = io.BytesIO()
+            img.save(output, format='JPEG')
+            return {"pixels" : output.getvalue() , "rows" : img.height , "columns" : img.width , "bits" : 8 , "transfer_syntax" : uid.JPEGBaseline8Bit}
+
+
+def _decodeShared(source_name : str , source_size : int):
+    """Runs in the worker processes : decodes the frame held in the source shared memory block, and returns the name of a new block holding the pixels."""
+    source = shared_memory.SharedMemory(name=source_name)
+    try:
+        decoded = decodeFrame(bytes(source.buf[:source_size]))
+    finally:
+        source.close()
+    pixels = decoded.pop("pixels")
+    output = shared_memory.SharedMemory(create=True, size=max(len(pixels), 1))
+    output.buf[:len(pixels)] = pixels
+    output.close() # unlinked by the parent once copied.
+    return output.name , len(pixels) , decoded
+
+
+class decodeEngine:
+
+    def __init__(self, workers : int = None):
+        """
+        workers : number of decoder processes. 0 decodes synchronously in the calling thread. Defaults to the number of CPUs.
+        """
+        self.logger = logging.getLogger(__name__)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.pool_decodes = 0
+        self.sync_decodes = 0
+        self.failures = 0
+        self.pool = None
+        if self.workers > 0:
+            self.pool = self._startPool()
+
+    def _startPool(self):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def decode(self, frame : bytes):
+        """Returns a dict with the pixels, rows, columns, bits and transfer_syntax of the decoded frame. Raises if the frame cannot be decoded."""
+        pool = self.pool
+        if pool is None or not frame:
+            with self.lock:
+                self.sync_decodes += 1
+            return decodeFrame(frame)
+        with self.lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        source = shared_memory.SharedMemory(create=True, size=len(frame))
+        try:
+            source.buf[:len(frame)] = frame
+            output_name , output_size , decoded = pool.submit(_decodeShared, source.name, len(frame)).result()
+            output = shared_memory.SharedMemory(name=output_name)
+            try:
+                decoded["pixels"] = bytes(output.buf[:output_size])
+            finally:
+                output.close()
+                output.unlink()
+            with self.lock:
+                self.pool_decodes += 1
+            return decoded
+        except BrokenProcessPool:
+            self.logger.error("Decoder pool stopped unexpectedly, it is restarted and the frame is decoded in the request thread.")
+            with self.lock:
+                if self.pool is pool:
+                    self.pool = self._startPool()
+                self.sync_decodes += 1
+            return decodeFrame(frame)
+        except Exception:
+            with self.lock:
+                self.failures += 1
+            raise
+        finally:
+            source.close()
+            source.unlink()
+            with self.lock:
+                self.queue_depth -= 1
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def getStats(self):
+        with self.lock:
+            return {
+                "workers" : self.workers,
+                "queue_depth" : self.queue_depth,
+                "max_queue_depth" : self.max_queue_depth,
+                "pool_decodes" : self.pool_decodes,
+                "sync_decodes" : self.sync_decodes,
+                "failures" : self.failures
+            }
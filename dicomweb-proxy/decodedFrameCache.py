@@ -0,0 +1,48 @@
+"""
+decodedFrameCache Module : Memory tier holding the decoded pixels of the most frequently requested frames, so they are not decoded again on each request.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+from collections import OrderedDict
+import threading
+import logging
+from lruCache import lruCache
+
+
+class decodedFrameCache:
+
+    MAX_TRACKED_FRAMES = 100000 # number of frames for which the request count is tracked before promotion.
+
+    def __init__(self, max_size_mb : int , promote_after : int = 2):
+        """
+        max_size_mb : memory budget of the decoded pixels, in MB.
+        promote_after : number of decodes of a frame after which its decoded pixels are kept in the cache.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.cache = lruCache(max_bytes=max_size_mb*1024*1024 , name="decodedFrameCache")
+        self.promote_after = promote_after
+        self.request_counts = OrderedDict()
+        self.lock = threading.Lock()
+        self.promotions = 0
+
+    def get(self, frame_key : str):
+        """Returns a dict with the pixels, rows, columns, bits and transfer_syntax of the decoded frame, or None."""
+        return self.cache.get(frame_key)
+
+    def recordDecode(self, frame_key : str , pixels : bytes , rows : int , columns : int , bits : int , transfer_syntax : str):
+        with self.lock:
+            count = self.request_counts.pop(frame_key, 0) + 1
+            if count < self.promote_after:
+                self.request_counts[frame_key] = count
+                if len(self.request_counts) > decodedFrameCache.MAX_TRACKED_FRAMES:
+                    self.request_counts.popitem(last=False)
+                return
+            self.promotions += 1
+        self.cache.put(frame_key , {"pixels" : pixels , "rows" : rows , "columns" : columns , "bits" : bits , "transfer_syntax" : transfer_syntax} , len(pixels))
+
+    def getStats(self):
+        stats = self.cache.getStats()
+        with self.lock:
+            stats["promotions"] = self.promotions
+            stats["tracked_frames"] = len(self.request_counts)
+        return stats
@@ -2,7 +2,6 @@ import gzip
 import orjson
 import concurrent.futures
 from concurrent.futures import wait
-import os
 import io
 import sys
 import logging
@@ -13,22 +12,26 @@ from collections import deque
 import threading
 import multiprocessing
 from multiprocessing import Queue , set_start_method , Manager
-import time
+import queue
+import frameStore
+from ahiScheduler import BACKGROUND
 
 
 class frameFetcher:
         
-    cached_items = set()
+    cache_index = None # cacheIndex of the frames queued or cached, shared with the fetcher processes and the cacheCleaner. Set at startup.
+    BATCH_SIZE = 64 # maximum number of frames dequeued at once by a fetcher process.
+    MAX_INFLIGHT = 200 # maximum number of frames submitted to the download threads and not completed yet, per fetcher process.
 
-    def __init__(self , frameFetcherName, getFramePixels , cache_root : str):
+    def __init__(self , frameFetcherName, getFramePixels , cache_root : str , cache_engine : str = "files" , cache_events : Queue = None , scheduler = None , registry = None , shared_frames = None):
         self.logger = logging.getLogger(__name__)
         self.status = 1
+        self.frameFetcherName = frameFetcherName # set before the process is started : the spawned process gets a pickled copy of self.
         multiprocessing.set_start_method("spawn", force=True)
         self.ctx = multiprocessing.get_context('spawn')
         self.cacheQueue = self.ctx.Queue()
-        self.cacheProcessor = self.ctx.Process(target=self.ProcessRunner, args=(self.cacheQueue, frameFetcher.fetchAndStore ,getFramePixels  , cache_root ))
+        self.cacheProcessor = self.ctx.Process(target=self.ProcessRunner, args=(self.cacheQueue, frameFetcher.fetchAndStore ,getFramePixels  , cache_root , cache_engine , cache_events , scheduler , registry , frameFetcher.cache_index , shared_frames ))
         self.cacheProcessor.start()
-        self.frameFetcherName = frameFetcherName
 
 
     def addToCacheByMetadata(self, metadata : object):
@@ -41,13 +44,11 @@ class frameFetcher:
         try:
             datastore_id = metadata["DatastoreID"]
             imageset_id = metadata["ImageSetID"]
-            series_uid = next(iter(metadata["Study"]["Series"].keys()))
-            instances = iter(metadata["Study"]["Series"][series_uid]["Instances"].keys())
-            for instance in instances:
-                for frame in metadata["Study"]["Series"][series_uid]["Instances"][instance]["ImageFrames"]:
-                    frame_id = frame["ID"]
-                    if not datastore_id+imageset_id+frame_id in frameFetcher.cached_items:
-                        self.addToCache({ "status" : 0 , "datastore_id" : datastore_id , "imageset_id" : imageset_id , "imageframe_id" : frame_id})
+            frame_ids = [ cache_object["imageframe_id"] for cache_object in frameFetcher.getFramesToCache(metadata) ]
+            if frameFetcher.cache_index is not None: # marked as queued in a single transaction.
+                frame_ids = frameFetcher.cache_index.claim(datastore_id+"/"+imageset_id, frame_ids)
+            for frame_id in frame_ids:
+                self.queue({ "status" : 0 , "datastore_id" : datastore_id , "imageset_id" : imageset_id , "imageframe_id" : frame_id})
         except Exception as err:
             self.logger.error("_addToCachebyMetadata Exception :")
             self.logger(err)
@@ -57,36 +58,84 @@ class frameFetcher:
         imageset_id = cache_object["imageset_id"]
         imageframe_id = cache_object["imageframe_id"]
         self.logger.debug(f"[{self.frameFetcherName}] - {datastore_id+imageset_id+imageframe_id } Evaluating cache need.")
-        if not datastore_id+"/"+imageset_id+"/"+imageframe_id in frameFetcher.cached_items: #let's not add it if this is already there...
-            frameFetcher.cached_items.add(datastore_id+"/"+imageset_id+"/"+imageframe_id ) #At this point this is not  hard disk cached yet... This merely prevent an exisiting item to re-enter the processing queue 
-            self.cacheQueue.put(cache_object)
-            self.logger.debug(f"[{self.frameFetcherName}] - {datastore_id+imageset_id+imageframe_id } Added to fetch queue.")
+        if frameFetcher.cache_index is None or len(frameFetcher.cache_index.claim(datastore_id+"/"+imageset_id, [imageframe_id])) > 0: #let's not add it if this is already queued or cached...
+            self.queue(cache_object)
 
-    def ProcessRunner(self , cacheQueue : Queue , fetchAndStore , getFramePixels , cache_root): 
+    def queue(self, cache_object : dict):
+        """Queues the frame for fetching, the caller having already marked it as queued in the cache index."""
+        self.cacheQueue.put(cache_object)
+        self.logger.debug(f"[{self.frameFetcherName}] - {cache_object['datastore_id']+cache_object['imageset_id']+cache_object['imageframe_id']} Added to fetch queue.")
+
+    def stop(self):
+        self.cacheQueue.put(None)
+
+    def ProcessRunner(self , cacheQueue : Queue , fetchAndStore , getFramePixels , cache_root , cache_engine , cache_events , scheduler = None , registry = None , cache_index = None , shared_frames = None): 
         client_config = botocore.config.Config(max_pool_connections=100,)
         ahi_client = boto3.client('medical-imaging', config=client_config)
+        frame_store = frameStore.getFrameStore(cache_engine, cache_root)
+        inflight = threading.BoundedSemaphore(frameFetcher.MAX_INFLIGHT)
+        def onDone(future):
+            inflight.release()
+            if future.exception() is not None:
+                self.logger.error(f"[{self.frameFetcherName}] - {future.exception()}")
         with concurrent.futures.ThreadPoolExecutor(max_workers=100) as executor:
-            while(self.status == 1):
-                if not cacheQueue.empty():
-                    futures = []
-                    while not cacheQueue.empty():
-                        cache_it = cacheQueue.get(block=True)
-                        datastore_id = cache_it["datastore_id"]
-                        imageset_id = cache_it["imageset_id"]
-                        imageframe_id = cache_it["imageframe_id"]
-                        futures.append(executor.submit(fetchAndStore, getFramePixels, datastore_id, imageset_id, imageframe_id , ahi_client , cache_root))
-                else:
-                    time.sleep(0.01)
+            while True:
+                batch = [cacheQueue.get(block=True)] # blocks while the fetcher is idle.
+                while len(batch) < frameFetcher.BATCH_SIZE:
+                    try:
+                        batch.append(cacheQueue.get_nowait())
+                    except queue.Empty:
+                        break
+                for cache_it in batch:
+                    if cache_it is None: # stop sentinel, see stop()
+                        executor.shutdown(wait=True)
+                        if cache_index is not None: # the frames stored by the last downloads.
+                            cache_index.flush()
+                        return
+                    inflight.acquire() # blocks when MAX_INFLIGHT frames are already being downloaded.
+                    future = executor.submit(fetchAndStore, getFramePixels, cache_it["datastore_id"], cache_it["imageset_id"], cache_it["imageframe_id"] , ahi_client , frame_store , cache_events , scheduler , registry , cache_index , shared_frames)
+                    future.add_done_callback(onDone)
     
     @staticmethod
-    def fetchAndStore(getFramePixels, datastore_id, imageset_id, imageframe_id , ahi_client, cache_root):
-        frame_file_path =f"{cache_root}/{datastore_id}/{imageset_id}/{imageframe_id}.cache"
-        if not os.path.isfile(frame_file_path):
-            frame = getFramePixels(datastore_id, imageset_id, imageframe_id , ahi_client)
-            os.makedirs(f"{cache_root}/{datastore_id}/{imageset_id}",exist_ok=True)
-            frame_file = open(frame_file_path,'wb')
-            frame_file.write(frame)
-            frame_file.close()
+    def fetchAndStore(getFramePixels, datastore_id, imageset_id, imageframe_id , ahi_client, frame_store , cache_events = None , scheduler = None , registry = None , cache_index = None , shared_frames = None):
+        if cache_index is not None:
+            cached = cache_index.isCached(datastore_id+"/"+imageset_id, imageframe_id)
+        else:
+            cached = frame_store.contains(datastore_id, imageset_id, imageframe_id)
+        if not cached:
+            key = f"{datastore_id}/{imageset_id}/{imageframe_id}"
+            registered = False
+            try:
+                frame = None
+                if shared_frames is not None: # another service task may have downloaded it already.
+                    frame = shared_frames.get(key)
+                if frame is None:
+                    if scheduler is not None: # the prefetch yields the AHI slots and bandwidth to the client requests.
+                        scheduler.acquire(BACKGROUND)
+                    try:
+                        # registered once the slot is acquired : a client request does not wait for a download queued behind the prefetch.
+                        if registry is not None:
+                            inflight_owner , registered = registry.begin(key, BACKGROUND)
+                            if inflight_owner is not None: # a client request is downloading it, and stores it.
+                                registry.recordSkip()
+                                return
+                        frame = getFramePixels(datastore_id, imageset_id, imageframe_id , ahi_client)
+                    finally:
+                        if scheduler is not None:
+                            scheduler.release(BACKGROUND, len(frame) if frame is not None else 0)
+                    if frame is not None and shared_frames is not None:
+                        shared_frames.put(key, frame)
+                if frame is not None:
+                    frame_store.write(datastore_id, imageset_id, imageframe_id, frame)
+                    if cache_index is not None:
+                        cache_index.markCachedLater(datastore_id+"/"+imageset_id, imageframe_id, len(frame))
+                    if cache_events is not None:
+                        cache_events.put((datastore_id, imageset_id, len(frame)))
+                elif cache_index is not None: # not fetched : it can be queued again.
+                    cache_index.forget(datastore_id+"/"+imageset_id, imageframe_id)
+            finally:
+                if registered:
+                    registry.end(key) # after the write : the client requests waiting for the frame read it from the store.
 
     @staticmethod
     def getFramesToCache(metadata : object):
@@ -0,0 +1,232 @@
+"""
+frameIndex Module : Compact index of the AHI frame references of the instances, used to resolve the WADO-RS frame requests without the image set metadata.
+
+The image set references are interned per instance and the 32 hexadecimal characters frame ids are packed in 16 bytes, in arrays shared by all the
+instances. The index is bounded with two generations : when the current one reaches half of the budget it becomes the previous one, and the instances
+found in the previous one are copied back to the current one, so the instances not requested during a whole generation are dropped.
+
+On a miss the index reads through to the metadata-index frame table, populated when the metadata-index is deployed with populate_frame_level. The instances
+not found in the frame table are not looked up again for MISS_TTL seconds, the frame table being populated when the instance is indexed.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import sys
+import array
+import threading
+import logging
+import time
+
+# Approximate memory of an instance entry besides its frame ids : the instance uid, its dictionary slot and its array cells.
+INSTANCE_OVERHEAD = 120
+REFERENCE_OVERHEAD = 250
+MISS_TTL = 300 # seconds an instance not found in the frame table is not looked up again for.
+MAX_MISSES = 100000 # instances remembered as not found in the frame table.
+
+
+class _frameTable:
+    """One generation of the index."""
+
+    def __init__(self):
+        self.rows = {} # instance uid -> row
+        self.references = [] # interned (datastore_id, imageset_id, stored_transfer_syntax) tuples
+        self.reference_ids = {}
+        self.reference = array.array('I') # per row : index of the reference
+        self.first_frame = array.array('I') # per row : index of the first frame id in frame_ids, or in irregular_ids when frame_count is 0
+        self.frame_count = array.array('I')
+        self.frame_ids = bytearray() # 16 bytes per frame
+        self.irregular_ids = [] # frame id lists of the instances whose ids cannot be packed
+        self.nbytes = 0
+
+    def add(self, instance_uid : str , reference : tuple , frame_ids : list):
+        reference_id = self.reference_ids.get(reference)
+        if reference_id is None:
+            reference_id = self.reference_ids[reference] = len(self.references)
+            self.references.append(reference)
+            self.nbytes += REFERENCE_OVERHEAD
+        packed = frame_ids.packed if isinstance(frame_ids, _packedIds) else _pack(frame_ids)
+        self.rows[instance_uid] = len(self.reference)
+        self.reference.append(reference_id)
+        if packed is not None:
+            self.first_frame.append(len(self.frame_ids) // 16)
+            self.frame_count.append(len(frame_ids))
+            self.frame_ids += packed
+            self.nbytes += len(packed)
+        else:
+            self.first_frame.append(len(self.irregular_ids))
+            self.frame_count.append(0)
+            self.irregular_ids.append(list(frame_ids))
+            self.nbytes += sum(sys.getsizeof(frame_id) + 8 for frame_id in frame_ids)
+        self.nbytes += sys.getsizeof(instance_uid) + INSTANCE_OVERHEAD
+
+    def find(self, instance_uid : str):
+        """Returns the reference and the frame ids of the instance, None if not indexed."""
+        row = self.rows.get(instance_uid)
+        if row is None:
+            return None
+        reference = self.references[self.reference[row]]
+        first , count = self.first_frame[row] , self.frame_count[row]
+        if count == 0:
+            return reference , self.irregular_ids[first]
+        return reference , _packedIds(self.frame_ids[first*16:(first+count)*16])
+
+    def frameCount(self):
+        return len(self.frame_ids) // 16 + sum(len(frame_ids) for frame_ids in self.irregular_ids)
+
+
+class _packedIds:
+    """Read only sequence of packed frame ids, unpacked on access only."""
+
+    def __init__(self, packed : bytes):
+        self.packed = packed
+
+    def __len__(self):
+        return len(self.packed) // 16
+
+    def __getitem__(self, index : int):
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        return self.packed[index*16:index*16+16].hex()
+
+
+def _pack(frame_ids):
+    """Packs the frame ids in 16 bytes each, None if any is not 32 lower case hexadecimal characters."""
+    try:
+        packed = bytes.fromhex("".join(frame_ids))
+    except ValueError:
+        return None
+    if len(packed) != 16*len(frame_ids) or packed.hex() != "".join(frame_ids):
+        return None
+    return packed
+
+
+class frameIndex:
+
+    def __init__(self, max_size_mb : int = 64 , loader = None):
+        """
+        max_size_mb : memory budget of the index.
+        loader : function returning the (datastoreid, imagesetid, framenumber, frameid) rows of the frame table for an instance uid, ordered by image set
+        and frame number. None disables the read through.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.max_bytes = max_size_mb*1024*1024
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.current = _frameTable()
+        self.previous = _frameTable()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_misses = 0
+        self.promotions = 0
+        self.rotations = 0
+        self.skipped_loads = 0
+        self.missing = {} # instance uid -> time until which it is not looked up in the frame table again.
+
+    def _add(self, instance_uid : str , reference : tuple , frame_ids : list):
+        if self.current.nbytes >= self.max_bytes // 2:
+            self.previous = self.current
+            self.current = _frameTable()
+            self.rotations += 1
+        self.current.add(instance_uid , reference , frame_ids)
+
+    def put(self, instance_uid : str , datastore_id : str , imageset_id : str , frame_ids : list , stored_transfer_syntax : str = None):
+        """Indexes the frame ids of the instance, in frame number order. stored_transfer_syntax is None when unknown."""
+        reference = (datastore_id , imageset_id , stored_transfer_syntax)
+        with self.lock:
+            found = self.current.find(instance_uid)
+            if found is not None and found[0] == reference and len(found[1]) == len(frame_ids):
+                return
+            self._add(instance_uid , reference , frame_ids)
+
+    def putRows(self, instance_uid : str , rows : list):
+        """Indexes the instance from its rows of the frame table. Only the frames of the first image set are kept. Returns False if the rows are not usable."""
+        with self.lock:
+            self.loads += 1
+            if len(rows) == 0:
+                self.load_misses += 1
+                if len(self.missing) >= MAX_MISSES:
+                    now = time.monotonic()
+                    self.missing = { uid : until for uid , until in self.missing.items() if until > now }
+                    if len(self.missing) >= MAX_MISSES:
+                        self.missing.clear()
+                self.missing[instance_uid] = time.monotonic() + MISS_TTL
+            else:
+                self.missing.pop(instance_uid , None)
+        if len(rows) == 0:
+            return False
+        datastore_id , imageset_id = rows[0][0] , rows[0][1]
+        frame_ids = []
+        for row in rows:
+            if row[0] != datastore_id or row[1] != imageset_id:
+                break
+            if row[2] != len(frame_ids) + 1:
+                self.logger.warning(f"[putRows] - the frames of {instance_uid} are not numbered contiguously in the frame table")
+                return False
+            frame_ids.append(row[3])
+        reference = (datastore_id , imageset_id , None) # the frame table does not hold the stored transfer syntax.
+        with self.lock:
+            if self.current.find(instance_uid) is None:
+                self._add(instance_uid , reference , frame_ids)
+        return True
+
+    def needsLoad(self, instance_uid : str):
+        """Returns False if the instance was not found in the frame table less than MISS_TTL seconds ago."""
+        with self.lock:
+            until = self.missing.get(instance_uid)
+            if until is None:
+                return True
+            if until > time.monotonic():
+                self.skipped_loads += 1
+                return False
+            del self.missing[instance_uid]
+            return True
+
+    def _find(self, instance_uid : str):
+        with self.lock:
+            found = self.current.find(instance_uid)
+            if found is None:
+                found = self.previous.find(instance_uid)
+                if found is not None:
+                    self._add(instance_uid , found[0] , found[1])
+                    self.promotions += 1
+            if found is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return found
+
+    def getFrames(self, instance_uid : str , frame_list : list , read_through : bool = True):
+        """Returns the (datastore_id, imageset_id, imageframe_id, stored_transfer_syntax) of each requested frame number, in the requested order.
+        None if the instance is not indexed, or a frame number is out of range."""
+        found = self._find(instance_uid)
+        if found is None and read_through and self.loader is not None and self.needsLoad(instance_uid):
+            try:
+                rows = self.loader(instance_uid)
+            except Exception as err:
+                self.logger.error(f"[getFrames] - frame table lookup of {instance_uid} failed : {err}")
+                rows = []
+            if self.putRows(instance_uid , rows):
+                found = self._find(instance_uid)
+        if found is None:
+            return None
+        ( datastore_id , imageset_id , stored_transfer_syntax ) , frame_ids = found
+        if any( frame_number < 1 or frame_number > len(frame_ids) for frame_number in frame_list ):
+            return None
+        return [ (datastore_id , imageset_id , frame_ids[frame_number-1] , stored_transfer_syntax) for frame_number in frame_list ]
+
+    def getStats(self):
+        with self.lock:
+            return {
+                "instances" : len(self.current.rows),
+                "previous_instances" : len(self.previous.rows),
+                "frames" : self.current.frameCount() + self.previous.frameCount(),
+                "bytes" : self.current.nbytes + self.previous.nbytes,
+                "max_bytes" : self.max_bytes,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "loads" : self.loads,
+                "load_misses" : self.load_misses,
+                "skipped_loads" : self.skipped_loads,
+                "promotions" : self.promotions,
+                "rotations" : self.rotations
+            }
@@ -0,0 +1,153 @@
+"""
+frameRegistry Module : Registry of the AHI frame downloads in progress, shared by the service and the frame fetcher processes, so that a frame is
+downloaded once for all the requests needing it at the same time.
+
+    - a client request for a frame being prefetched waits for the frame fetcher to store it, instead of downloading it again.
+    - a client request for a frame queued for prefetch downloads it right away and stores it, the frame fetcher then skips it.
+    - concurrent client requests for the same frame in the service share a single download.
+
+The registry is a fixed size hash table in shared memory : each frame key hashes to a bucket of a few entries. When a bucket is full the frame is
+not registered and is downloaded as if no other download was in progress.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import time
+import hashlib
+import threading
+import multiprocessing
+import concurrent.futures
+
+
+BUCKET_SIZE = 8
+# shared counters
+_JOINED_BACKGROUND = 0 # client requests served by a frame fetcher download in progress.
+_JOINED_FOREGROUND = 1 # client requests served by the download of a concurrent client request.
+_PROMOTED = 2 # frames queued for prefetch downloaded by a client request, and skipped by the frame fetchers.
+_SKIPPED = 3 # frame fetcher downloads skipped because a client request was downloading the frame.
+_JOIN_TIMEOUTS = 4
+_COUNTER_COUNT = 5
+
+
+def _hash(key : str):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1 # 0 marks the free entries.
+
+
+class frameRegistry:
+
+    def __init__(self, buckets : int = 1024):
+        ctx = multiprocessing.get_context('spawn')
+        self.buckets = buckets
+        self.condition = ctx.Condition(ctx.Lock())
+        self.keys = ctx.Array('Q', buckets*BUCKET_SIZE, lock=False)
+        self.owners = ctx.Array('b', buckets*BUCKET_SIZE, lock=False)
+        self.counters = ctx.Array('q', _COUNTER_COUNT, lock=False)
+        self._initLocal()
+
+    def _initLocal(self):
+        self.local_lock = threading.Lock()
+        self.local_inflight = {} # key -> Future of the download of a client request, in this process.
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["local_lock"]
+        del state["local_inflight"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._initLocal()
+
+    def _find(self, key_hash : int , value : int = None):
+        """Returns the entry of the bucket of key_hash holding value, key_hash by default. None if not found."""
+        if value is None:
+            value = key_hash
+        start = (key_hash % self.buckets) * BUCKET_SIZE
+        for entry in range(start, start + BUCKET_SIZE):
+            if self.keys[entry] == value:
+                return entry
+        return None
+
+    def begin(self, key : str , owner : int):
+        """Registers the download of the frame by the owner class. Returns the class of the owner of the download in progress, None if the
+        caller should download the frame, and whether the download was registered : when the bucket is full the caller downloads the frame
+        without registering it, and must not call end."""
+        key_hash = _hash(key)
+        with self.condition:
+            entry = self._find(key_hash)
+            if entry is not None:
+                return self.owners[entry] , False
+            free = self._find(key_hash , 0)
+            if free is None:
+                return None , False
+            self.keys[free] = key_hash
+            self.owners[free] = owner
+            return None , True
+
+    def end(self, key : str):
+        """Unregisters the download of the frame, and wakes up the requests waiting for it."""
+        key_hash = _hash(key)
+        with self.condition:
+            entry = self._find(key_hash)
+            if entry is not None:
+                self.keys[entry] = 0
+                self.condition.notify_all()
+
+    def isInFlight(self, key : str):
+        key_hash = _hash(key)
+        with self.condition:
+            return self._find(key_hash) is not None
+
+    def wait(self, key : str , timeout : float):
+        """Waits for the download of the frame to end. Returns False on timeout."""
+        key_hash = _hash(key)
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self._find(key_hash) is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.counters[_JOIN_TIMEOUTS] += 1
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def joinLocal(self, key : str):
+        """Returns the Future of the download of the frame in this process, and True if the caller owns it and has to resolve it with resolveLocal."""
+        with self.local_lock:
+            future = self.local_inflight.get(key)
+            if future is not None:
+                self._count(_JOINED_FOREGROUND)
+                return future , False
+            future = self.local_inflight[key] = concurrent.futures.Future()
+            return future , True
+
+    def resolveLocal(self, key : str , future : concurrent.futures.Future , frame : bytes):
+        with self.local_lock:
+            self.local_inflight.pop(key, None)
+        future.set_result(frame)
+
+    def _count(self, counter : int):
+        with self.condition:
+            self.counters[counter] += 1
+
+    def recordJoin(self):
+        self._count(_JOINED_BACKGROUND)
+
+    def recordPromotion(self):
+        self._count(_PROMOTED)
+
+    def recordSkip(self):
+        self._count(_SKIPPED)
+
+    def getStats(self):
+        with self.condition:
+            counters = list(self.counters)
+            inflight = sum( 1 for key_hash in self.keys if key_hash != 0 )
+        return {
+            "inflight" : inflight,
+            "joined_background" : counters[_JOINED_BACKGROUND],
+            "joined_foreground" : counters[_JOINED_FOREGROUND],
+            "promoted" : counters[_PROMOTED],
+            "skipped_background" : counters[_SKIPPED],
+            "join_timeouts" : counters[_JOIN_TIMEOUTS],
+            "saved_ahi_calls" : counters[_JOINED_BACKGROUND] + counters[_JOINED_FOREGROUND] + counters[_PROMOTED]
+        }
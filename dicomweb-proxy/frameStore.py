@@ -0,0 +1,178 @@
+"""
+frameStore Module : Storage engines of the on-disk frame cache.
+
+fileFrameStore stores one file per frame : {cache_root}/{datastore}/{imageset}/{frame}.cache
+packFrameStore appends the frames of an image set into segment files with a fixed size record index :
+    {cache_root}/{datastore}/{imageset}/frames.idx
+    {cache_root}/{datastore}/{imageset}/segment-0000.pack
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import fcntl
+import struct
+import threading
+import zlib
+import logging
+from collections import OrderedDict
+
+
+def getFrameStore(engine : str , cache_root : str):
+    match engine:
+        case "pack":
+            return packFrameStore(cache_root)
+        case _:
+            return fileFrameStore(cache_root)
+
+
+class fileFrameStore:
+
+    def __init__(self, cache_root : str):
+        self.logger = logging.getLogger(__name__)
+        self.cache_root = cache_root
+
+    def contains(self, datastore_id : str , imageset_id : str , imageframe_id : str):
+        return os.path.isfile(f"{self.cache_root}/{datastore_id}/{imageset_id}/{imageframe_id}.cache")
+
+    def read(self, datastore_id : str , imageset_id : str , imageframe_id : str):
+        try:
+            with open(f"{self.cache_root}/{datastore_id}/{imageset_id}/{imageframe_id}.cache", 'rb') as frame_file:
+                return frame_file.read()
+        except FileNotFoundError:
+            return None
+
+    def listFrames(self, datastore_id : str , imageset_id : str):
+        """Returns the (frame id, size) of the frames of the image set in the store."""
+        try:
+            return [ (entry.name[:-len(".cache")] , entry.stat().st_size) for entry in os.scandir(f"{self.cache_root}/{datastore_id}/{imageset_id}") if entry.name.endswith(".cache") ]
+        except FileNotFoundError:
+            return []
+
+    def write(self, datastore_id : str , imageset_id : str , imageframe_id : str , frame : bytes):
+        os.makedirs(f"{self.cache_root}/{datastore_id}/{imageset_id}",exist_ok=True)
+        frame_file_path = f"{self.cache_root}/{datastore_id}/{imageset_id}/{imageframe_id}.cache"
+        # Written under a temporary name then renamed, so that a reader never sees a partially written frame.
+        tmp_path = f"{frame_file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as frame_file:
+            frame_file.write(frame)
+        os.replace(tmp_path, frame_file_path)
+
+
+class packFrameStore:
+
+    INDEX_FILE = "frames.idx"
+    RECORD = struct.Struct("<32sIQII") # frame id, segment number, offset, length, crc32
+    SEGMENT_MAX_BYTES = 256*1024*1024
+    MAX_OPEN_SEGMENTS = 256
+
+    def __init__(self, cache_root : str):
+        self.logger = logging.getLogger(__name__)
+        self.cache_root = cache_root
+        self.indexes = {} # imageset folder -> { "parsed" : bytes of the index file already parsed , "frames" : { frame id -> record } }
+        self.segments = OrderedDict() # segment path -> file descriptor, least recently used first.
+        self.lock = threading.Lock()
+
+    def contains(self, datastore_id : str , imageset_id : str , imageframe_id : str):
+        return self._lookup(f"{self.cache_root}/{datastore_id}/{imageset_id}", imageframe_id) is not None
+
+    def read(self, datastore_id : str , imageset_id : str , imageframe_id : str):
+        folder = f"{self.cache_root}/{datastore_id}/{imageset_id}"
+        record = self._lookup(folder, imageframe_id)
+        if record is None:
+            return None
+        segment , offset , length , crc = record
+        try:
+            segment_fd = self._segmentFd(f"{folder}/segment-{segment:04d}.pack")
+            try:
+                frame = os.pread(segment_fd, length, offset)
+            finally:
+                os.close(segment_fd)
+        except OSError:
+            frame = None
+        if frame is None or len(frame) != length or zlib.crc32(frame) != crc:
+            # The image set was evicted or re-written since the index was loaded.
+            self._forget(folder)
+            return None
+        return frame
+
+    def write(self, datastore_id : str , imageset_id : str , imageframe_id : str , frame : bytes):
+        folder = f"{self.cache_root}/{datastore_id}/{imageset_id}"
+        os.makedirs(folder, exist_ok=True)
+        index_fd = os.open(f"{folder}/{packFrameStore.INDEX_FILE}", os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            # The index lock serializes the writers of the image set, across threads and fetcher processes.
+            fcntl.flock(index_fd, fcntl.LOCK_EX)
+            index_size = os.fstat(index_fd).st_size
+            index_size -= index_size % packFrameStore.RECORD.size # ignore a record truncated by a crash.
+            segment = 0
+            if index_size > 0:
+                segment = packFrameStore.RECORD.unpack(os.pread(index_fd, packFrameStore.RECORD.size, index_size - packFrameStore.RECORD.size))[1]
+            segment_path = f"{folder}/segment-{segment:04d}.pack"
+            offset = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+            if offset > 0 and offset + len(frame) > packFrameStore.SEGMENT_MAX_BYTES:
+                segment += 1
+                segment_path = f"{folder}/segment-{segment:04d}.pack"
+                offset = 0
+            segment_fd = os.open(segment_path, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(segment_fd, frame, offset)
+            finally:
+                os.close(segment_fd)
+            # The frame becomes visible to the readers only once its index record is appended, after the data.
+            os.write(index_fd, packFrameStore.RECORD.pack(imageframe_id.encode(), segment, offset, len(frame), zlib.crc32(frame)))
+        finally:
+            os.close(index_fd) # also releases the lock.
+
+    def listFrames(self, datastore_id : str , imageset_id : str):
+        """Returns the (frame id, size) of the frames of the image set in the store."""
+        frames = self._refreshIndex(f"{self.cache_root}/{datastore_id}/{imageset_id}")
+        with self.lock:
+            return [ (frame_id.rstrip(b"\0").decode() , record[2]) for frame_id , record in frames.items() ]
+
+    def _lookup(self, folder : str , imageframe_id : str):
+        key = imageframe_id.encode().ljust(32, b"\0")
+        with self.lock:
+            index = self.indexes.get(folder)
+            if index is not None and key in index["frames"]:
+                return index["frames"][key]
+        return self._refreshIndex(folder).get(key)
+
+    def _refreshIndex(self, folder : str):
+        """Parses the records appended to the index file since the last refresh."""
+        try:
+            with open(f"{folder}/{packFrameStore.INDEX_FILE}", 'rb') as index_file:
+                with self.lock:
+                    index = self.indexes.setdefault(folder, {"parsed" : 0 , "frames" : {}})
+                    size = os.fstat(index_file.fileno()).st_size
+                    if size < index["parsed"]: # the index was deleted and re-created.
+                        index["parsed"] = 0
+                        index["frames"] = {}
+                    index_file.seek(index["parsed"])
+                    data = index_file.read(size - index["parsed"])
+                    data = data[:len(data) - len(data) % packFrameStore.RECORD.size]
+                    for frame_id , segment , offset , length , crc in packFrameStore.RECORD.iter_unpack(data):
+                        index["frames"][frame_id] = (segment , offset , length , crc)
+                    index["parsed"] += len(data)
+                    return index["frames"]
+        except FileNotFoundError:
+            self._forget(folder)
+            return {}
+
+    def _forget(self, folder : str):
+        with self.lock:
+            self.indexes.pop(folder, None)
+            for segment_path in [path for path in self.segments if path.startswith(folder+"/")]:
+                os.close(self.segments.pop(segment_path))
+
+    def _segmentFd(self, segment_path : str):
+        """Returns a duplicate of the cached segment descriptor, to be closed by the caller once read."""
+        with self.lock:
+            fd = self.segments.get(segment_path)
+            if fd is not None:
+                self.segments.move_to_end(segment_path)
+                return os.dup(fd)
+            fd = os.open(segment_path, os.O_RDONLY)
+            self.segments[segment_path] = fd
+            if len(self.segments) > packFrameStore.MAX_OPEN_SEGMENTS:
+                os.close(self.segments.popitem(last=False)[1])
+            return os.dup(fd)
@@ -0,0 +1,45 @@
+"""
+latencyStats Module : Thread safe latency statistics reported by the metrics endpoint.
+
+Each series keeps its count, mean and max since the start, and the percentiles over its most recent samples.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import threading
+import collections
+
+
+class latencyStats:
+
+    def __init__(self, window : int = 1024):
+        """
+        window : number of most recent samples of each series the percentiles are computed on.
+        """
+        self.window = window
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def record(self, name : str , seconds : float):
+        with self.lock:
+            serie = self.series.get(name)
+            if serie is None:
+                serie = self.series[name] = { "count" : 0 , "total" : 0.0 , "max" : 0.0 , "samples" : collections.deque(maxlen=self.window) }
+            serie["count"] += 1
+            serie["total"] += seconds
+            serie["max"] = max(serie["max"], seconds)
+            serie["samples"].append(seconds)
+
+    def getStats(self):
+        """Returns the statistics of each series, in milliseconds."""
+        with self.lock:
+            series = { name : (serie["count"] , serie["total"] , serie["max"] , sorted(serie["samples"])) for name , serie in self.series.items() }
+        stats = {}
+        for name , (count , total , maximum , samples) in series.items():
+            stats[name] = {
+                "count" : count,
+                "mean_ms" : round(total * 1000 / count, 3),
+                "p50_ms" : round(samples[len(samples) // 2] * 1000, 3),
+                "p99_ms" : round(samples[min(len(samples) - 1, len(samples) * 99 // 100)] * 1000, 3),
+                "max_ms" : round(maximum * 1000, 3)
+            }
+        return stats
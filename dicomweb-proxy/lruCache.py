@@ -0,0 +1,100 @@
+"""
+lruCache Module : Thread safe, byte accounted LRU cache with an optional time to live.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+from collections import OrderedDict
+import threading
+import datetime
+import logging
+
+
+class lruCache:
+
+    def __init__(self, max_bytes : int , ttl : int = None , name : str = "lruCache"):
+        """
+        max_bytes : total size budget of the cache in bytes. The least recently used entries are evicted when the budget is exceeded.
+        ttl : time to live of the entries in seconds. None or 0 disables the expiration.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if self.ttl and (datetime.datetime.now() - entry["dt"]).total_seconds() > self.ttl:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry["value"]
+
+    def put(self, key, value, size : int):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                self.logger.warning(f"[{self.name}] - {key} is {size} bytes, larger than the cache budget of {self.max_bytes} bytes. Not cached.")
+                return False
+            self.entries[key] = {"value" : value , "size" : size , "dt" : datetime.datetime.now()}
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                evicted_key , evicted = self.entries.popitem(last=False)
+                self.current_bytes -= evicted["size"]
+                self.evictions += 1
+                self.logger.debug(f"[{self.name}] - EVICTED : {evicted_key}")
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def deleteWhere(self, predicate):
+        """Removes the entries for which predicate(key, value) is true. Returns the number of entries removed."""
+        with self.lock:
+            keys = [ key for key , entry in self.entries.items() if predicate(key, entry["value"]) ]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.current_bytes -= entry["size"]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def getStats(self):
+        with self.lock:
+            return {
+                "entries" : len(self.entries),
+                "bytes" : self.current_bytes,
+                "max_bytes" : self.max_bytes,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "expirations" : self.expirations
+            }
@@ -4,12 +4,11 @@ wado service entrypoint. Contains the business logic to configure the service pe
 SPDX-License-Identifier: Apache 2.0
 """
 import numpy
-from PIL import Image
 import array
 import boto3
 import botocore
 import pydicom
-from pydicom import Dataset , DataElement , uid 
+from pydicom import DataElement , uid 
 from waitress import serve
 from flask import Flask, request, Response
 from flask_cors import CORS
@@ -17,15 +16,21 @@ import logging
 import mysqlConnectionFactory
 import datetime
 import os
+import sys
 import sql_queries
 from db_mappings import *
 from qido_search_tags import *
 from uuid import uuid4
 import gzip
-from openjpeg import decode
+import base64
+import zlib
+import itertools
+import functools
+from collections import deque
 import io
 from InstanceDICOMizer import InstanceDICOMizer
 from pydicom import config
+from pydicom.valuerep import validate_value
 config.settings.reading_validation_mode = config.RAISE
 import concurrent.futures
 from concurrent.futures import wait
@@ -34,11 +39,48 @@ from metadataCache import metadataCache
 from werkzeug.serving import WSGIRequestHandler
 from frameFetcher import frameFetcher
 from cacheCleaner import cacheCleaner
+import frameStore
+from decodedFrameCache import decodedFrameCache
+from decodeEngine import decodeEngine
+import renderer
+from lruCache import lruCache
+from qidoCache import qidoCache
+from frameIndex import frameIndex
+from prefetchPolicy import prefetchPolicy , PREFETCH_POLICIES
+from ahiScheduler import ahiScheduler , FOREGROUND
+from frameRegistry import frameRegistry
+from cacheIndex import cacheIndex
+from cacheBackend import getCacheBackend , CACHE_BACKENDS
+from latencyStats import latencyStats
 import multiprocessing
+import time
+import threading
+import weakref
 
 app = Flask(__name__)
 cors = CORS(app)
 sql_pool = None
+frame_store = None
+cCleaner = None
+decoded_cache = None
+decode_engine = None
+qido_cache = None
+rendered_cache = None # lruCache of the images rendered by the WADO-RS rendered resources.
+metadata_responses = None # lruCache of the gzip compressed WADO-RS metadata responses.
+prefetch_policy = None # selects the frames queued to the frame fetchers after each WADO-RS request.
+ahi_scheduler = None # shares the AHI frame fetches between the client requests and the frame fetchers.
+frame_registry = None # AHI frame downloads in progress, in the service and in the frame fetchers.
+prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4) # loads the metadata of the image sets to prefetch from, after the frame index hits.
+prefetch_pending = set() # (imageset_id, instance uid) submitted to prefetch_executor and not processed yet.
+prefetch_pending_lock = threading.Lock()
+frame_backend = None # cacheBackend of the frames shared by the service tasks, checked after the local frame store.
+CACHE_INDEX_FILE = "cache-index.db" # SQLite index of the frames queued or cached, in the cache root.
+FRAME_JOIN_TIMEOUT = 10 # seconds a client request waits for a frame fetcher download in progress before downloading the frame itself.
+FRAME_FETCH_WORKERS = 8 # frames of a multi-frame request fetched and decoded concurrently.
+INSTANCE_FETCH_WORKERS = 16 # instances of a series retrieval fetched concurrently.
+database_stats = latencyStats() # connection checkout and query latencies.
+PREPARED_STATEMENTS = { statement : name for name , statement in vars(sql_queries).items() if isinstance(statement, str) and "%s" in statement } # fixed queries executed as server side prepared statements, by their name.
+prepared_cursors = weakref.WeakKeyDictionary() # prepared cursors of each pooled connection, kept across checkouts since the pool does not reset the sessions.
 @app.before_request
 def handle_preflight():
     if request.method == "OPTIONS":
@@ -56,60 +98,76 @@ def healthcheck():
     http_response = Response(status = httpstatus , response=orjson.dumps("OK"), mimetype=mimetype , content_type=contentType )
     return http_response   
 
+### Metrics endpoint ###
+@app.route("/aetitle/metrics", methods=["GET" , "OPTIONS"])
+def metrics():
+    httpstatus = 200
+    mimetype = "text/json"
+    contentType = "application/json"
+    http_response = Response(status = httpstatus , response=orjson.dumps(_getMetrics()), mimetype=mimetype , content_type=contentType )
+    return http_response
+
+def _getMetrics():
+    resp = {
+        "metadataCache" : metadatacache.getStats(),
+        "frameCache" : cCleaner.getStats(),
+        "cacheIndex" : frameFetcher.cache_index.getStats(),
+        "frameIndex" : metadataCache.frame_index.getStats()
+    }
+    if decoded_cache is not None:
+        resp["decodedFrameCache"] = decoded_cache.getStats()
+    if decode_engine is not None:
+        resp["decodeEngine"] = decode_engine.getStats()
+    if metadata_responses is not None:
+        resp["metadataResponseCache"] = metadata_responses.getStats()
+    if rendered_cache is not None:
+        resp["renderedCache"] = rendered_cache.getStats()
+    if qido_cache is not None:
+        resp["qidoCache"] = qido_cache.getStats()
+    if prefetch_policy is not None:
+        resp["prefetch"] = prefetch_policy.getStats()
+    if ahi_scheduler is not None:
+        resp["ahiScheduler"] = ahi_scheduler.getStats()
+    if frame_registry is not None:
+        resp["frameRegistry"] = frame_registry.getStats()
+    if frame_backend is not None:
+        resp["frameBackend"] = frame_backend.getStats()
+    resp["database"] = database_stats.getStats()
+    return resp
+
+### Cache invalidation endpoint ###
+@app.route("/aetitle/cache/studies/<StudyInstanceUID>", methods=["DELETE" , "OPTIONS"])
+def InvalidateStudy(StudyInstanceUID : str):
+    """Called by the metadata index writers when a study is added, modified or deleted."""
+    invalidated = qido_cache.invalidateStudy(StudyInstanceUID) if qido_cache is not None else 0
+    return Response(status = 200 , response=orjson.dumps({"invalidated" : invalidated}), mimetype="text/json" , content_type="application/json")
+
 ### QIDO ENDPOINTS ###
 @app.route("/aetitle/studies", methods=["GET" , "OPTIONS"])
 def SearchForStudies():
     parameters = _processParameters(level="STUDY")
-    query , query_parameters = _constructQuery(parameters)
-    field_names, db_results = _executeQuery(query , query_parameters)
-    resp = _convertToJSON(field_names , db_results , parameters)
-    httpstatus = 200
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    http_response = Response(status = httpstatus , response=orjson.dumps(resp), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _qidoResponse(parameters)
 
 #resource Study's Series
 @app.route("/aetitle/studies/<studyInstanceUID>/series", methods=["GET" , "OPTIONS"])
 def SearchForStudySeries(studyInstanceUID : str):
     parameters = _processParameters(level="STUDY.SERIES")
     parameters["StudyInstanceUID"] = studyInstanceUID
-    query , query_parameters = _constructQuery(parameters)
-    field_names, db_results = _executeQuery(query , query_parameters)
-    resp = _convertToJSON(field_names , db_results , parameters)
-    httpstatus = 200
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    http_response = Response(status = httpstatus , response=orjson.dumps(resp), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _qidoResponse(parameters)
 
 #Study's Instances
 @app.route("/aetitle/studies/<studyInstanceUID>/instances", methods=["GET" , "OPTIONS"])
 def SearchForStudyInstances(studyInstanceUID: str):
     parameters = _processParameters(level="STUDY.INSTANCE")
     parameters["StudyInstanceUID"] = studyInstanceUID
-    query , query_parameters = _constructQuery(parameters)
-    field_names, db_results = _executeQuery(query , query_parameters)
-    resp = _convertToJSON(field_names , db_results , parameters)
-    httpstatus = 200
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    http_response = Response(status = httpstatus , response=orjson.dumps(resp), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _qidoResponse(parameters)
 
 #All Series
 @app.route("/aetitle/series", methods=["GET" , "OPTIONS"])
 def SearchForSeries():
     parameters = _processParameters(level="SERIES")
     logging.debug(parameters)
-    query , query_parameters = _constructQuery(parameters)
-    field_names, db_results = _executeQuery(query , query_parameters)
-    resp = _convertToJSON(field_names , db_results , parameters)
-    httpstatus = 200
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    http_response = Response(status = httpstatus , response=orjson.dumps(resp), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _qidoResponse(parameters)
 
 #Study's Series' Instances
 @app.route("/aetitle/studies/<studyInstanceUID>/series/<seriesInstanceUID>/instances", methods=["GET" , "OPTIONS"])
@@ -117,27 +175,13 @@ def SearchForStudySeriesInstances(studyInstanceUID: str, seriesInstanceUID: str)
     parameters = _processParameters(level="STUDY.SERIES.INSTANCE")
     parameters["StudyInstanceUID"] = studyInstanceUID
     parameters["SeriesInstanceUID"] = seriesInstanceUID
-    query , query_parameters = _constructQuery(parameters)
-    field_names, db_results = _executeQuery(query , query_parameters)
-    logging.debug(field_names)
-    resp = _convertToJSON(field_names , db_results , parameters)
-    httpstatus = 200
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    http_response = Response(status = httpstatus , response=orjson.dumps(resp), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _qidoResponse(parameters)
 
 #All Instances
 @app.route("/aetitle/instances", methods=["GET" , "OPTIONS"])
 def SearchForInstances():
     parameters = _processParameters(level="INSTANCE")
-    query , query_parameters = _constructQuery(parameters)
-    field_names, db_results = _executeQuery(query , query_parameters)
-    resp = _convertToJSON(field_names , db_results , parameters)
-    httpstatus = 200
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    http_response = Response(status = httpstatus , response=orjson.dumps(resp), mimetype=mimetype , content_type=contentType )
+    return _qidoResponse(parameters)
 
 ### WADO ENDPOINTS ###
 @app.route('/aetitle/studies/<StudyInstanceUID>', methods=['GET' , 'OPTIONS'])
@@ -146,75 +190,32 @@ def RetrieveStudies(StudyInstanceUID : str):
     parameters = _processParameters(level="STUDY")
     parameters["StudyInstanceUID"] = StudyInstanceUID
     parameters["wherefields"]["0020000D"] = StudyInstanceUID
-    query , query_parameters = _constructQuery(parameters)
-    field_names, db_results = _executeQuery(query , query_parameters)
-    resp = _convertToJSON(field_names , db_results , parameters)
-    httpstatus = 200
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    http_response = Response(status = httpstatus , response=orjson.dumps(resp), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _qidoResponse(parameters)
     
 
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/metadata', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesMetadata(StudyInstanceUID : str):
-    metadata=RetrieveMetadata(sql_queries.WADO_STUDIES_METADATA , StudyInstanceUID)
-    if len(metadata) > 0:
-        http_code = 200
-    else:
-        http_code = 400
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    if 'gzip' in request.headers.get('Accept-Encoding','').lower():
-        logging.debug("response will be gzipped")
-        content = gzip.compress(orjson.dumps(metadata),5)
-        http_response = Response(status = http_code , response=content, mimetype=mimetype , content_type=contentType )
-        http_response.headers['Content-length'] = len(content)
-        http_response.headers['Content-Encoding'] = 'gzip'
-    else:
-        http_response = Response(status = http_code , response=orjson.dumps(metadata), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _metadataResponse("STUDY", sql_queries.WADO_STUDIES_METADATA , StudyInstanceUID)
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/rendered', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesRendered(StudyInstanceUID : str):
-    pass
+    return _renderedResponse(sql_queries.WADO_STUDIES_METADATA , StudyInstanceUID)
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/series/<SeriesInstanceUID>', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesSeries(StudyInstanceUID : str , SeriesInstanceUID : str):
     # get the image sets 
-    sql_conn = sql_pool.get_connection()
-    cursor = sql_conn.cursor()
-    cursor.execute(sql_queries.WADO_INSTANCE_IN_SERIES , [SeriesInstanceUID])
-    results = cursor.fetchall()
-    cursor.close()
-    sql_conn.close()
+    fields , results = _executeQuery(sql_queries.WADO_INSTANCE_IN_SERIES , (SeriesInstanceUID,))
     resp_boundary = multipart_boundary()
     return instancesYield(results, resp_boundary) , { "Content-Type" : "multipart/related; type=\"application/dicom\"; boundary="+resp_boundary }
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/series/<SeriesInstanceUID>/rendered', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesSeriesRendered(StudyInstanceUID : str , SeriesInstanceUID : str):
-    pass
+    return _renderedResponse(sql_queries.WADO_SERIES_METADATA , SeriesInstanceUID , SeriesInstanceUID=SeriesInstanceUID)
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/series/<SeriesInstanceUID>/metadata', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesSeriesMetadata(StudyInstanceUID : str , SeriesInstanceUID : str):
-    metadata=RetrieveMetadata(sql_queries.WADO_SERIES_METADATA , SeriesInstanceUID)
-    if len(metadata) > 0:
-        http_code = 200
-    else:
-        http_code = 400
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-
-    if 'gzip' in request.headers.get('Accept-Encoding','').lower():
-        logging.debug("response will be gzipped")
-        content = gzip.compress(orjson.dumps(metadata),5)
-        http_response = Response(status = http_code , response=content, mimetype=mimetype , content_type=contentType )
-        http_response.headers['Content-length'] = len(content)
-        http_response.headers['Content-Encoding'] = 'gzip'
-    else:
-        http_response = Response(status = http_code , response=orjson.dumps(metadata), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _metadataResponse("SERIES", sql_queries.WADO_SERIES_METADATA , SeriesInstanceUID)
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/series/<SeriesInstanceUID>/instances/<InstanceUID>', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesSeriesInstance(StudyInstanceUID : str , SeriesInstanceUID : str , InstanceUID : str):
@@ -225,74 +226,44 @@ def RetrieveStudiesSeriesInstance(StudyInstanceUID : str , SeriesInstanceUID : s
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/series/<SeriesInstanceUID>/instances/<InstanceUID>/rendered', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesSeriesInstanceRendered(StudyInstanceUID : str , SeriesInstanceUID : str , InstanceUID : str):
-    sql_conn = sql_pool.get_connection()
-    cursor = sql_conn.cursor()
-    cursor.execute(sql_queries.WADO_INSTANCE_METADATA , (InstanceUID,))
-    results = cursor.fetchall()
-    cursor.close()
-    sql_conn.close()
-
-    for res in results:
-        datastore_id = res[0]
-        imageset_id = res[1] 
-        metadata = metadatacache.getMetadata(datastore_id=datastore_id , imageset_id=imageset_id)
-        assignToCache(metadata=metadata)
-        series_uid = next(iter(metadata["Study"]["Series"].keys()))
-        if InstanceUID in metadata["Study"]["Series"][series_uid]["Instances"].keys():
-            insDICOMizer = InstanceDICOMizer(ahi_client=ahi_client)
-            insDICOMizer.getFramePixels = getFramePixels
-            ds = insDICOMizer.DICOMize(InstanceUID, metadata ,first_frame_only=True )
-
-    mimetype = "image/jpeg"
-    contentType = "image/jpeg"
-    http_code = 200
-    new_image = ds.pixel_array.astype(float)
-    scaled_image = (numpy.maximum(new_image, 0) / new_image.max()) * 255.0
-    scaled_image = numpy.uint8(scaled_image)
-    final_image = Image.fromarray(scaled_image)
-    img_byte_arr = io.BytesIO()
-    final_image.save(img_byte_arr , "JPEG")
-    http_response = Response(status = http_code , response=img_byte_arr.getvalue(), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _renderedResponse(sql_queries.WADO_INSTANCE_METADATA , InstanceUID , SeriesInstanceUID=SeriesInstanceUID , InstanceUID=InstanceUID)
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/series/<SeriesInstanceUID>/instances/<InstanceUID>/metadata', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesSeriesInstanceMetadata(StudyInstanceUID : str , SeriesInstanceUID : str , InstanceUID : str):
-    metadata=RetrieveMetadata(sql_queries.WADO_INSTANCE_METADATA , InstanceUID)
-    if len(metadata) > 0:
-        http_code = 200
-    else:
-        http_code = 400
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-
-    if 'gzip' in request.headers.get('Accept-Encoding','').lower():
-        logging.debug("response will be gzipped")
-        content = gzip.compress(orjson.dumps(metadata),5)
-        http_response = Response(status = http_code , response=content, mimetype=mimetype , content_type=contentType )
-        http_response.headers['Content-length'] = len(content)
-        http_response.headers['Content-Encoding'] = 'gzip'
-    else:
-        http_response = Response(status = http_code , response=orjson.dumps(metadata), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _metadataResponse("INSTANCE", sql_queries.WADO_INSTANCE_METADATA , InstanceUID)
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/series/<SeriesInstanceUID>/instances/<InstanceUID>/frames/<Frames>', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesSeriesInstanceFrame(StudyInstanceUID : str , SeriesInstanceUID : str , InstanceUID : str , Frames : str):
-
-    frame_list = []
-    frame_list = [int(i) for i in Frames.split(",")]
-    frame_list = _RetrievePixelData(sql_queries.WADO_INSTANCE_METADATA , SeriesInstanceUID , InstanceUID , frame_list)
+    try:
+        frame_list = [int(i) for i in Frames.split(",")]
+    except ValueError:
+        return Response(status = 400 , response=orjson.dumps(f"Invalid frame list : {Frames}"), mimetype="text/json" , content_type="application/dicom+json")
+    frame_refs = _ResolveFrameReferences(sql_queries.WADO_INSTANCE_METADATA , SeriesInstanceUID , InstanceUID , frame_list)
+    if frame_refs is None:
+        return Response(status = 404 , response=orjson.dumps(f"Frames {Frames} of instance {InstanceUID} not found"), mimetype="text/json" , content_type="application/dicom+json")
+    # Frames are returned as stored when the client accepts their transfer syntax, otherwise they are decoded to Explicit VR Little Endian.
+    passthrough_transfer_syntax = _passthroughTransferSyntax(frame_refs[0][3], _acceptedTransferSyntaxes(request.headers.get('Accept','')))
+    response_transfer_syntax = passthrough_transfer_syntax if passthrough_transfer_syntax is not None else uid.ExplicitVRLittleEndian
+    resp_boundary = multipart_boundary()
     mimetype = "multipart/related"
-    contentType = 'multipart/related; type="application/octet-stream"; boundary=KOIN'
-    if 'gzip' in request.headers.get('Accept-Encoding','').lower():    
+    contentType = 'multipart/related; type="'+get_content_type(response_transfer_syntax)+'"; boundary='+resp_boundary
+    frames = framesYield(frame_refs, resp_boundary, passthrough_transfer_syntax)
+    if 'gzip' in request.headers.get('Accept-Encoding','').lower() and passthrough_transfer_syntax is None:    
         logging.debug("response will be gzipped")
-        content = gzip.compress(frame_list, 5)
-        http_response = Response(status = 200 , response=content, mimetype=mimetype , content_type=contentType )
-        http_response.headers['Content-length'] = len(content)
+        http_response = Response(status = 200 , response=gzipYield(frames, 5), mimetype=mimetype , content_type=contentType )
         http_response.headers['Content-Encoding'] = 'gzip'
     else:
-        http_response = Response(status = 200 , response=frame_list, mimetype=mimetype , content_type=contentType )
+        http_response = Response(status = 200 , response=frames, mimetype=mimetype , content_type=contentType )
     return http_response
 
+@app.route('/aetitle/studies/<StudyInstanceUID>/series/<SeriesInstanceUID>/instances/<InstanceUID>/frames/<Frames>/rendered', methods=['GET' , 'OPTIONS'])
+def RetrieveStudiesSeriesInstanceFrameRendered(StudyInstanceUID : str , SeriesInstanceUID : str , InstanceUID : str , Frames : str):
+    try:
+        frame_list = [int(i) for i in Frames.split(",")]
+    except ValueError:
+        return Response(status = 400 , response=orjson.dumps(f"Invalid frame list : {Frames}"), mimetype="text/json" , content_type="application/dicom+json")
+    return _renderedResponse(sql_queries.WADO_INSTANCE_METADATA , InstanceUID , SeriesInstanceUID=SeriesInstanceUID , InstanceUID=InstanceUID , frame_list=frame_list)
+
 @app.route('/aetitle/<BulkDataURIReference>', methods=['GET' , 'OPTIONS'])
 def RetrieveBulkDataURIReference(BulkDataURIReference : str):
     mimetype = "text/json"
@@ -301,33 +272,194 @@ def RetrieveBulkDataURIReference(BulkDataURIReference : str):
     return http_response
 
 
-def _executeQuery(query : str , query_parameters : array):
+def _qidoResponse(parameters : dict):
+    """Builds the response of a QIDO-RS query, from the QIDO cache when the same query was answered recently.
+    Pages of keyset paginated queries carry the token of the next page in the X-Continuation-Token header."""
+    cached = qido_cache.get(parameters) if qido_cache is not None else None
+    if cached is not None:
+        return _qidoHttpResponse(cached["content"] , cached["continuation_token"])
+    try:
+        query , query_parameters = _constructQuery(parameters)
+    except ValueError as err:
+        return Response(status = 400 , response=orjson.dumps(str(err)), mimetype="text/json" , content_type="application/dicom+json")
+    continuation_token = None
+    if _usesKeysetPagination(parameters):
+        # the page is bounded by the limit, it is fetched before the response to return the continuation token in its headers.
+        field_names, db_results = _executeQuery(query , query_parameters)
+        continuation_token = _nextContinuationToken(parameters , field_names , db_results)
+    else:
+        field_names, db_results = _streamQuery(query , query_parameters)
+    json_chunks = jsonArrayYield(_convertToJSON(field_names , db_results , parameters))
+    return _qidoHttpResponse(qidoResponseYield(json_chunks , parameters , continuation_token) , continuation_token)
+
+def _qidoHttpResponse(content , continuation_token : str):
+    http_response = Response(status = 200 , response=content, mimetype="text/json" , content_type="application/dicom+json" )
+    if continuation_token is not None:
+        http_response.headers['X-Continuation-Token'] = continuation_token
+        http_response.headers['Access-Control-Expose-Headers'] = 'X-Continuation-Token'
+    return http_response
+
+def qidoResponseYield(json_chunks , parameters : dict , continuation_token : str = None):
+    """Streams the JSON chunks, and stores the complete response in the QIDO cache once streamed, unless it is larger than the cache."""
+    if qido_cache is None:
+        yield from json_chunks
+        return
+    content = []
+    content_size = 0
+    for chunk in json_chunks:
+        if content is not None:
+            content.append(chunk)
+            content_size += len(chunk)
+            if content_size > qido_cache.cache.max_bytes:
+                content = None
+        yield chunk
+    if content is not None:
+        qido_cache.put(parameters , b"".join(content) , continuation_token)
+
+def _keysetColumn(level : str):
+    """Returns the indexed unique key the results of the level are paginated on, qualified with its table, and its column name."""
+    match level:
+        case "STUDY":
+            table = "study_table"
+        case "SERIES" | "STUDY.SERIES":
+            table = "series_table"
+        case _:
+            table = "instance_table"
+    return f"{tables[table]}.{table_unique_keys[table]}" , table_unique_keys[table]
+
+def _usesKeysetPagination(params : dict):
+    """Limited queries without an explicit order are paginated on the unique key of the level, instead of an offset which MySQL has to scan through."""
+    return int(params["limit"]) > 0 and len(params["orderbyfields"]) == 0
+
+def _parseContinuationToken(params : dict):
+    """Returns the key after which the page starts, None for the first page. Raises ValueError if the token is invalid or was issued for another query level."""
+    token = params.get("continuationtoken")
+    if token is None:
+        return None
+    try:
+        level , after = orjson.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except Exception:
+        raise ValueError(f"Invalid continuation token : {token}")
+    if level != params["queryLevel"] or type(after) is not int:
+        raise ValueError(f"Invalid continuation token : {token}")
+    return after
+
+def _nextContinuationToken(params : dict , field_names : list , db_results : list):
+    """Returns the token of the page following a full page of results, None after the last page."""
+    if len(db_results) < int(params["limit"]):
+        return None
+    key_index = field_names.index(_keysetColumn(params["queryLevel"])[1])
+    return base64.urlsafe_b64encode(orjson.dumps([params["queryLevel"] , db_results[-1][key_index]])).rstrip(b"=").decode()
+
+def _getConnection():
+    """Checks a connection out of the pool, recording the time waited for it."""
+    start = time.perf_counter()
     sql_conn = sql_pool.get_connection()
-    cursor = sql_conn.cursor()
-    cursor.execute("SET TRANSACTION ISOLATION LEVEL READ UNCOMMITTED")
-    cursor.execute(query, query_parameters)
-    db_results = cursor.fetchall()
-    field_names = [i[0] for i in cursor.description]
-    sql_conn.commit()
-    cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
-    cursor.close()
-    sql_conn.close()
+    database_stats.record("checkout" , time.perf_counter() - start)
+    return sql_conn
+
+def _preparedCursor(sql_conn , query : str):
+    """Returns the prepared cursor of the fixed query on the pooled connection, the statement being prepared on its first use only."""
+    cnx = getattr(sql_conn, "_cnx", sql_conn) # the pooled connection proxies are not reused, the connections they wrap are.
+    cursors = prepared_cursors.get(cnx)
+    if cursors is None or cursors["connection_id"] != cnx.connection_id: # the statements of a reconnected session are gone.
+        cursors = prepared_cursors[cnx] = { "connection_id" : cnx.connection_id }
+    cursor = cursors.get(query)
+    if cursor is None:
+        cursor = cursors[query] = cnx.cursor(prepared=True)
+    return cursor
+
+def _executeQuery(query : str , query_parameters : array):
+    """Executes the query in a single round trip : the isolation level and the autocommit are set once per pooled connection. The fixed queries of
+    sql_queries are executed as prepared statements."""
+    sql_conn = _getConnection()
+    try:
+        statement_name = PREPARED_STATEMENTS.get(query)
+        start = time.perf_counter()
+        if statement_name is not None:
+            cursor = _preparedCursor(sql_conn , query)
+            cursor.execute(query, query_parameters)
+            db_results = cursor.fetchall()
+        else:
+            cursor = sql_conn.cursor()
+            cursor.execute(query, query_parameters)
+            db_results = cursor.fetchall()
+            cursor.close()
+        database_stats.record(statement_name or "qido" , time.perf_counter() - start)
+        field_names = [i[0] for i in cursor.description]
+    finally:
+        sql_conn.close()
     return field_names , db_results
 
+def _streamQuery(query : str , query_parameters : array , batch_size : int = 1000):
+    """Executes the query on an unbuffered cursor. Returns the field names, and a generator of the rows fetched in batches as they are consumed,
+    which holds the connection until it is exhausted or closed."""
+    sql_conn = _getConnection()
+    cursor = sql_conn.cursor(buffered=False)
+    try:
+        start = time.perf_counter()
+        cursor.execute(query, query_parameters)
+        database_stats.record("qido_stream" , time.perf_counter() - start) # time to the first row.
+        field_names = [i[0] for i in cursor.description]
+    except:
+        cursor.close()
+        sql_conn.close()
+        raise
+    def rows():
+        exhausted = False
+        try:
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if len(batch) == 0:
+                    break
+                yield from batch
+            exhausted = True
+        finally:
+            if not exhausted: # the client went away : the unread rows have to be discarded before the connection is returned to the pool.
+                try:
+                    sql_conn.consume_results()
+                except Exception:
+                    pass
+            cursor.close()
+            sql_conn.close()
+    return field_names , rows()
+
 def instancesYield(results, boundary):
-    with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
-        futures = []
-        for res in results:
-            InstanceUID = res[0]  
-            futures.append(executor.submit(RetrieveInstance, sql_queries.WADO_INSTANCE_METADATA , InstanceUID))
-        wait(futures)
-        for future in concurrent.futures.as_completed(futures):  
-            yield( multipartEncapsulate(boundary=boundary, content_type= "application/dicom" , payload=future.result() ))
-        yield(bytes("--"+boundary+"--", 'utf-8'))
+    """Yields the instances as multipart parts in completion order. At most INSTANCE_FETCH_WORKERS instances are retrieved or waiting to be sent at any time,
+    and a new one is only started once a part has been handed to the server, so a slow client slows the retrieval down instead of growing the memory usage."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=INSTANCE_FETCH_WORKERS) as executor:
+        results = iter(results)
+        pending = set()
+        for res in itertools.islice(results, INSTANCE_FETCH_WORKERS):
+            pending.add(executor.submit(RetrieveInstance, sql_queries.WADO_INSTANCE_METADATA , res[0]))
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                payload = future.result()
+                if payload is not None:
+                    yield( multipartEncapsulate(boundary=boundary, content_type= "application/dicom" , payload=payload ))
+                for res in itertools.islice(results, 1):
+                    pending.add(executor.submit(RetrieveInstance, sql_queries.WADO_INSTANCE_METADATA , res[0]))
+    yield(bytes("--"+boundary+"--", 'utf-8'))
 
 def _convertToJSON(column_index , db_results , params: dict):
-    level = params["queryLevel"]
-    json_array = []
+    """Yields the DICOM JSON dict of each row, using the serialization plan compiled for the query shape."""
+    plan = _compileSerializationPlan(params["queryLevel"] , tuple(column_index) , tuple(params["includefield"]))
+    for result in db_results:
+        dicom_json = {}
+        for json_key , candidates in plan:
+            for index , converter in candidates:
+                try:
+                    dicom_json[json_key] = converter(result[index])
+                    break
+                except (ValueError , TypeError) as err: # the value cannot be represented with the VR of the tag : the tag is left out.
+                    pass
+        yield dicom_json
+
+@functools.lru_cache(maxsize=256)
+def _compileSerializationPlan(level : str , column_index : tuple , includefield : tuple):
+    """Returns the (json key, candidates) of the tags to serialize, in the order of the level tags then of the included fields. candidates are the (column position, value converter) tried in turn,
+    the included fields first as they override the default fields of the level."""
     match level:
         case "STUDY":
             tagDict = studyTagsTofields
@@ -341,41 +473,77 @@ def _convertToJSON(column_index , db_results , params: dict):
             tagDict = instanceTagsTofields
         case "STUDY.SERIES.INSTANCE":
             tagDict = instanceTagsTofields
-
-    for result in db_results:
-        ds = Dataset()
-        for tag in tagDict:
-            try:
-                index = column_index.index(tagDict[tag].lower())
-                tagvalue = _serializeValue(result[index])
-                if ( pydicom.datadict.dictionary_VR(tag) == "CS" ) and ( "/" in tagvalue):
-                    tagvalue = tagvalue.split("/")
-                ds.add(DataElement(tag, pydicom.datadict.dictionary_VR(tag) , tagvalue))
-            except BaseException as err:
-                pass
-
-        for tag in params["includefield"]:
-            try:
-                index = column_index.index(tagDict[tag].lower())
-                tagvalue = _serializeValue(result[index])
-                ds.add(DataElement(tag, pydicom.datadict.dictionary_VR(tag) , tagvalue))
-            except BaseException as err:
-                pass
-        #tag = "00081190"
-        #ds.add(DataElement(tag, pydicom.datadict.dictionary_VR(tag) , "http://10.10.34.42:8080/aetitle/studies/1.2.840.113619.2.30.1.1762295590.1623.978668949.886"))
-        json_array.append(ds.to_json_dict())
-
-
-    return json_array
+    columns = {}
+    for position , column in enumerate(column_index):
+        columns.setdefault(column , position)
+    candidates = {}
+    for tag in tagDict:
+        index = columns.get(tagDict[tag].lower())
+        if index is not None:
+            vr = pydicom.datadict.dictionary_VR(tag)
+            candidates.setdefault(tag , []).insert(0 , (index , _valueConverter(tag , vr , split_multiple = vr == "CS")))
+    for tag in includefield:
+        index = columns.get(tagDict[tag].lower()) if tag in tagDict else None
+        if index is not None:
+            candidates.setdefault(tag , []).insert(0 , (index , _valueConverter(tag , pydicom.datadict.dictionary_VR(tag) , split_multiple = False)))
+    return tuple( (f"{pydicom.tag.Tag(tag):08X}" , tuple(tag_candidates)) for tag , tag_candidates in candidates.items() )
+
+def _valueConverter(tag : str , vr : str , split_multiple : bool):
+    """Returns a function converting a column value to its DICOM JSON element. The common string, person name and integer values are converted directly,
+    after the same validation as pydicom, the other ones through pydicom. split_multiple : "/" separated values of aggregated columns are returned as multiple values."""
+    validation_mode = config.settings.reading_validation_mode
+    def pydicomElement(value):
+        return DataElement(tag , vr , value).to_json_dict(bulk_data_element_handler=None , bulk_data_threshold=1024)
+    def isPlainString(value):
+        return type(value) is str and "\\" not in value and value.strip() == value and value.isprintable()
+    if vr in ("IS" , "US" , "UL" , "SS" , "SL" , "UV" , "SV"):
+        def converter(value):
+            value = _serializeValue(value)
+            if value is None:
+                return { "vr" : vr }
+            if type(value) is int:
+                validate_value(vr , str(value) if vr == "IS" else value , validation_mode) # pydicom validates IS values as strings.
+                return { "vr" : vr , "Value" : [value] }
+            return pydicomElement(value)
+    elif vr == "PN":
+        def converter(value):
+            value = _serializeValue(value)
+            if value is None or value == "":
+                return { "vr" : vr }
+            if isPlainString(value) and "=" not in value:
+                validate_value(vr , value , validation_mode)
+                return { "vr" : vr , "Value" : [{ "Alphabetic" : value }] }
+            return pydicomElement(value)
+    elif vr in ("AE" , "AS" , "CS" , "DA" , "DT" , "LO" , "SH" , "TM" , "UI" , "UR" , "LT" , "ST" , "UC" , "UT"):
+        def converter(value):
+            value = _serializeValue(value)
+            if value is None or value == "":
+                return { "vr" : vr }
+            if split_multiple and "/" in value:
+                value = value.split("/")
+            if isPlainString(value):
+                validate_value(vr , value , validation_mode)
+                return { "vr" : vr , "Value" : [value] }
+            return pydicomElement(value)
+    else:
+        def converter(value):
+            return pydicomElement(_serializeValue(value))
+    return converter
 
 def _serializeValue(obj : any):
     if isinstance(obj, datetime.date):
         return obj.strftime('%Y%m%d')
-    if isinstance(obj , datetime.timedelta):
-        return obj.strftime('%H%M%S.%f')
+    if isinstance(obj , datetime.timedelta): # TIME columns are returned as the duration since midnight.
+        seconds , microseconds = divmod(round(obj.total_seconds() * 1000000) , 1000000)
+        minutes , seconds = divmod(seconds , 60)
+        hours , minutes = divmod(minutes , 60)
+        return f"{hours:02d}{minutes:02d}{seconds:02d}.{microseconds:06d}"
     return obj
 
-def _processParameters(level : str):
+def _processParameters(level : str , args = None):
+    """Parses the QIDO query parameters. args defaults to the query parameters of the current Flask request."""
+    if args is None:
+        args = request.args
 
     bypassOtherIncludeFields = False
     returnfields = []
@@ -384,9 +552,10 @@ def _processParameters(level : str):
     orderbyfields = []
     query_offset = 0
     query_limit = 0
-    for arg in request.args:
-        logging.info(f"Query parameter {arg} = {request.args.get(arg)}")
-        arg_value = request.args.get(arg)
+    continuation_token = None
+    for arg in args:
+        logging.info(f"Query parameter {arg} = {args.get(arg)}")
+        arg_value = args.get(arg)
         match arg:
             case "includefield":
                 if  arg_value == "all":
@@ -408,6 +577,8 @@ def _processParameters(level : str):
                 query_offset = arg_value
             case "orderby":
                 orderbyfields.append(arg_value)
+            case "continuationtoken":
+                continuation_token = arg_value
             case other :
                 match level:
                     case "STUDY":
@@ -439,7 +610,8 @@ def _processParameters(level : str):
         "includefield": returnfields,
         "wherefields": wherefields,
         "havingfields" : havingfields,
-        "orderbyfields": orderbyfields 
+        "orderbyfields": orderbyfields ,
+        "continuationtoken": continuation_token
     }
     return  return_obj
 
@@ -510,7 +682,14 @@ def _constructQuery(params : dict):
             tagDict = instanceTagsTofields
     where_prototype , where_params = ConstructQueryFilters(params=params["wherefields"], tagDict=tagDict)
     having_prototype , having_params = ConstructQueryFilters(params=params["havingfields"], tagDict=tagDict)
-    query_parameters = query_parameters + where_params + having_params
+    keyset_params = []
+    if _usesKeysetPagination(params):
+        keyset_column = _keysetColumn(level)[0]
+        after = _parseContinuationToken(params)
+        if after is not None:
+            where_prototype += f" AND {keyset_column} > %s " #nosec - bandit confused by string literal variales in query construction.
+            keyset_params.append(after)
+    query_parameters = query_parameters + where_params + keyset_params + having_params
 
     #Check if we need to add ORDER BY statement.
     orderby_prototype=""
@@ -539,7 +718,12 @@ def _constructQuery(params : dict):
             orderby_prototype=""
         else:
             orderby_prototype = orderby_prototype[:-1]
-    if int(params["limit"]) > 0:
+    if _usesKeysetPagination(params):
+        orderby_prototype = f" ORDER BY {keyset_column}"
+        # the offset only applies to the first page, the following ones start after the key of the continuation token.
+        offset = 0 if after is not None else int(params['offset'])
+        limit_offset = f" LIMIT {offset} , {int(params['limit'])}"
+    elif int(params["limit"]) > 0:
         limit_offset = f" LIMIT {str(params['offset'])} , {str(params['limit'])}"
     else:
         limit_offset = ""
@@ -591,45 +775,210 @@ def ConstructQueryFilters(params , tagDict):
             query_parameters.append(filter_params[2])
     return filter_prototype, query_parameters
 
-def _RetrievePixelData(query: str,  SeriesInstanceUID ,  InstanceUID : str , frame_list: list , multipart : bool = True): #right now this function only handles one frame per call... don't be fooled by frame_list being a list we will only use frame 0
-    try:
-        index = metadataCache.frame_index[InstanceUID+"_"+str(frame_list[0])]
-        frame = getFramePixels(datastore_id=index["DatastoreID"], imageset_id=index["ImageSetID"], imageframe_id=index["ImageFrameID"], client=ahi_client )
-        if multipart:
-            boundary = multipart_boundary()
-            payload = multipart_payload(uid.ExplicitVRLittleEndian, frame , boundary) #defaulting to ELE transfer syntax , the decoder has uncompressed the data. In theory we should comply to whatever is asked by the client...
-            return payload
-        else :
-            return frame        
-    except:
-        logging.debug(f"[_RetrievePixelData] - {InstanceUID} not in cache")
-    """Retieves a single DICOM object from AHI"""
-    sql_conn = sql_pool.get_connection()
-    cursor = sql_conn.cursor()
-    cursor.execute(query , (InstanceUID,))
-    results = cursor.fetchall()
-    cursor.close()
-    sql_conn.close()
+def _ResolveFrameReferences(query: str,  SeriesInstanceUID ,  InstanceUID : str , frame_list: list , results : list = None , read_through : bool = True):
+    """Returns the (datastore_id, imageset_id, imageframe_id, stored_transfer_syntax) of each requested frame number, in the requested order. None if a frame cannot be found.
+    The frames are resolved from the frame index, reading through to the frame table, and from the image set metadata otherwise.
+    results : the (datastore_id, imageset_id) rows of the query, when already fetched by the caller.
+    read_through : False when the caller already looked the instance up in the frame table."""
+    frame_refs = metadataCache.frame_index.getFrames(InstanceUID , frame_list , read_through=read_through)
+    if frame_refs is not None:
+        _prefetchFromIndex("frames" , InstanceUID , frame_refs)
+        return frame_refs
+    logging.debug(f"[_ResolveFrameReferences] - {InstanceUID} not in the frame index")
+    if results is None:
+        fields , results = _executeQuery(query , (InstanceUID,))
     for res in results:
         datastore_id = res[0]
         imageset_id = res[1]
         metadata = metadatacache.getMetadata(datastore_id= datastore_id , imageset_id= imageset_id)
-        assignToCache(metadata=metadata)
-        frame_id = None
         try:
-            frame_id = metadata["Study"]["Series"][SeriesInstanceUID]["Instances"][InstanceUID]["ImageFrames"][frame_list[0]-1]["ID"] #This only honors the 1st entry of the frame list...
-            
+            instance = metadata["Study"]["Series"][SeriesInstanceUID]["Instances"][InstanceUID]
+            stored_transfer_syntax = metadataCache.getStoredTransferSyntax(instance)
+            frame_refs = []
+            for frame_number in frame_list:
+                if frame_number < 1:
+                    raise IndexError(f"frame number {frame_number} is out of range")
+                frame_refs.append((datastore_id, imageset_id, instance["ImageFrames"][frame_number-1]["ID"], stored_transfer_syntax))
+            assignToCache(metadata , "frames" , InstanceUID , { frame_ref[2] for frame_ref in frame_refs })
+            return frame_refs
         except Exception as err:
             logging.error(err)
             continue
-        frame = getFramePixels(datastore_id=datastore_id, imageset_id=imageset_id , imageframe_id=frame_id, client=ahi_client )
-        if multipart:
-            boundary = multipart_boundary()
-            payload = multipart_payload(uid.ExplicitVRLittleEndian, frame , boundary) #defaulting to ELE transfer syntax , the decoder has uncompressed the data. In theory we should comply to whatever is asked by the client...
+    return None
 
-            return payload
-        else :
-            return frame
+def _loadFrameRows(InstanceUID : str):
+    """Frame index loader : the rows of the instance in the metadata-index frame table."""
+    fields , results = _executeQuery(sql_queries.WADO_INSTANCE_FRAMES , (InstanceUID,))
+    return results
+
+def framesYield(frame_refs : list, boundary : str, passthrough_transfer_syntax : str = None):
+    """Fetches and decodes the frames concurrently, and yields them as multipart parts in the requested order, as soon as each one is ready.
+    When passthrough_transfer_syntax is set, the frames are returned as stored, without decoding, labelled with that transfer syntax."""
+    if passthrough_transfer_syntax is not None:
+        fetch = getFrame
+        transfer_syntax = passthrough_transfer_syntax
+    else:
+        fetch = getFramePixels
+        transfer_syntax = uid.ExplicitVRLittleEndian #the decoder has uncompressed the data.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=FRAME_FETCH_WORKERS) as executor:
+        pending = deque()
+        frame_refs = iter(frame_refs)
+        for datastore_id, imageset_id, imageframe_id, stored_transfer_syntax in itertools.islice(frame_refs, FRAME_FETCH_WORKERS*2):
+            pending.append(executor.submit(fetch, datastore_id, imageset_id, imageframe_id, ahi_client))
+        while len(pending) > 0:
+            frame = pending.popleft().result()
+            for datastore_id, imageset_id, imageframe_id, stored_transfer_syntax in itertools.islice(frame_refs, 1):
+                pending.append(executor.submit(fetch, datastore_id, imageset_id, imageframe_id, ahi_client))
+            if frame is None:
+                logging.error("[framesYield] - A frame could not be retrieved, the response is truncated.")
+                return # the multipart response is left unterminated so that the client does not mistake it for a complete one.
+            yield multipart_part(transfer_syntax, frame , boundary)
+    yield ('--' + boundary + '--').encode()
+
+def _acceptedTransferSyntaxes(accept_header : str):
+    """Returns the set of transfer syntaxes accepted for frames in the Accept header. Contains "*" when the client accepts any transfer syntax."""
+    accepted = set()
+    for media_range in accept_header.split(","):
+        params = media_range.split(";")
+        media_type = params[0].strip().lower()
+        transfer_syntax = None
+        for param in params[1:]:
+            if "=" not in param:
+                continue
+            key , value = param.split("=", 1)
+            key = key.strip().lower()
+            value = value.strip().strip('"')
+            if key == "type" and media_type == "multipart/related":
+                media_type = value.lower()
+            elif key == "transfer-syntax":
+                transfer_syntax = value
+        if transfer_syntax is not None:
+            accepted.add(transfer_syntax)
+        elif media_type == "image/jph":
+            accepted.add(uid.HTJ2KLossless) # default transfer syntax of image/jph.
+    return accepted
+
+# Transfer syntaxes a stored HTJ2K codestream can be labelled with : a lossless codestream is valid for the lossless and the generic HTJ2K transfer syntaxes, an RPCL one also for the RPCL transfer syntax.
+HTJ2K_COMPATIBLE_TRANSFER_SYNTAXES = {
+    uid.HTJ2KLossless :         ( uid.HTJ2KLossless , uid.HTJ2K ),
+    uid.HTJ2KLosslessRPCL :     ( uid.HTJ2KLosslessRPCL , uid.HTJ2KLossless , uid.HTJ2K ),
+    uid.HTJ2K :                 ( uid.HTJ2K , ),
+}
+
+def _passthroughTransferSyntax(stored_transfer_syntax : str , accepted : set):
+    """Returns the transfer syntax to label the stored frames with if the client accepts them as stored, None if they need to be decoded."""
+    compatible = HTJ2K_COMPATIBLE_TRANSFER_SYNTAXES.get(stored_transfer_syntax)
+    if compatible is None:
+        return None
+    if "*" in accepted:
+        return stored_transfer_syntax
+    for transfer_syntax in compatible:
+        if transfer_syntax in accepted:
+            return transfer_syntax
+    return None
+
+def _renderedResponse(query : str , UID : str , SeriesInstanceUID : str = None , InstanceUID : str = None , frame_list : list = None):
+    """Builds the response of the WADO-RS rendered resources : a single image for one frame, a multipart response of the first frame of each instance otherwise."""
+    try:
+        rendering = {
+            "window" : renderer.parseWindow(request.args.get("window")),
+            "viewport" : renderer.parseViewport(request.args.get("viewport")),
+            "quality" : renderer.parseQuality(request.args.get("quality")),
+            "media_type" : renderer.acceptedMediaType(request.headers.get('Accept'))
+        }
+    except ValueError as err:
+        return Response(status = 400 , response=orjson.dumps(str(err)), mimetype="text/json" , content_type="application/dicom+json")
+    if rendering["media_type"] is None:
+        return Response(status = 406 , response=orjson.dumps(f"Supported media types : {list(renderer.RENDERED_MEDIA_TYPES.keys())}"), mimetype="text/json" , content_type="application/dicom+json")
+    targets = _ResolveRenderingTargets(query , UID , SeriesInstanceUID , InstanceUID , frame_list)
+    if targets is None or len(targets) == 0:
+        return Response(status = 404 , response=orjson.dumps(f"{UID} not found"), mimetype="text/json" , content_type="application/dicom+json")
+    if InstanceUID is not None and len(targets) == 1:
+        rendered = renderFrame(targets[0] , rendering)
+        if rendered is None:
+            return Response(status = 500 , response=orjson.dumps(f"{InstanceUID} could not be rendered"), mimetype="text/json" , content_type="application/dicom+json")
+        return Response(status = 200 , response=rendered, mimetype=rendering["media_type"] , content_type=rendering["media_type"] )
+    resp_boundary = multipart_boundary()
+    contentType = 'multipart/related; type="'+rendering["media_type"]+'"; boundary='+resp_boundary
+    return Response(status = 200 , response=renderedYield(targets, resp_boundary, rendering), mimetype="multipart/related" , content_type=contentType )
+
+def _ResolveRenderingTargets(query : str , UID : str , SeriesInstanceUID : str = None , InstanceUID : str = None , frame_list : list = None , results : list = None):
+    """Returns the (datastore_id, imageset_id, imageframe_id, instance_uid, frame_number, attributes) of the frames to render : the requested frames of the instance,
+    or the first frame of each instance of the series or study. None if a requested frame cannot be found.
+    results : the (datastore_id, imageset_id) rows of the query, when already fetched by the caller."""
+    if results is None:
+        fields , results = _executeQuery(query , (UID,))
+    targets = []
+    rendered_instances = set()
+    prefetched = []
+    for res in results:
+        datastore_id = res[0]
+        imageset_id = res[1]
+        metadata = metadatacache.getMetadata(datastore_id=datastore_id , imageset_id=imageset_id)
+        if metadata is None:
+            continue
+        prefetched.append(metadata)
+        for series_uid , series in metadata["Study"]["Series"].items():
+            if SeriesInstanceUID is not None and series_uid != SeriesInstanceUID:
+                continue
+            for instance_uid , instance in series["Instances"].items():
+                if (InstanceUID is not None and instance_uid != InstanceUID) or instance_uid in rendered_instances:
+                    continue
+                image_frames = instance.get("ImageFrames", [])
+                if len(image_frames) == 0: # non image instances, e.g. structured reports.
+                    continue
+                rendered_instances.add(instance_uid)
+                attributes = { **series["DICOM"] , **instance["DICOM"] }
+                for frame_number in (frame_list if frame_list is not None else [1]):
+                    if frame_number < 1 or frame_number > len(image_frames):
+                        logging.error(f"[_ResolveRenderingTargets] - frame {frame_number} of {instance_uid} is out of range")
+                        return None
+                    targets.append((datastore_id , imageset_id , image_frames[frame_number-1]["ID"] , instance_uid , frame_number , attributes))
+    for metadata in prefetched:
+        assignToCache(metadata , "rendered" , InstanceUID , { target[2] for target in targets })
+    return targets
+
+def renderFrame(target : tuple , rendering : dict):
+    """Returns the rendered image of the target frame, from the rendered cache when available. None if the frame cannot be retrieved or rendered."""
+    datastore_id , imageset_id , imageframe_id , instance_uid , frame_number , attributes = target
+    cache_key = f"{instance_uid}/{frame_number}/{rendering['window']}/{rendering['viewport']}/{rendering['quality']}/{rendering['media_type']}"
+    if rendered_cache is not None:
+        rendered = rendered_cache.get(cache_key)
+        if rendered is not None:
+            return rendered
+    decoded = getDecodedFrame(datastore_id , imageset_id , imageframe_id , ahi_client)
+    if decoded is None:
+        return None
+    try:
+        rendered = renderer.renderFrame(decoded , attributes , window=rendering["window"] , viewport=rendering["viewport"] , quality=rendering["quality"] , media_type=rendering["media_type"])
+    except Exception as err:
+        logging.error(f"[renderFrame] - {instance_uid} frame {frame_number} could not be rendered : {err}")
+        return None
+    if rendered_cache is not None:
+        rendered_cache.put(cache_key , rendered , len(rendered))
+    return rendered
+
+def renderedYield(targets : list , boundary : str , rendering : dict):
+    """Renders the frames concurrently and yields them as multipart parts in order. Frames that cannot be rendered are left out."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=FRAME_FETCH_WORKERS) as executor:
+        pending = deque()
+        targets = iter(targets)
+        for target in itertools.islice(targets, FRAME_FETCH_WORKERS*2):
+            pending.append(executor.submit(renderFrame, target, rendering))
+        while len(pending) > 0:
+            rendered = pending.popleft().result()
+            for target in itertools.islice(targets, 1):
+                pending.append(executor.submit(renderFrame, target, rendering))
+            if rendered is not None:
+                yield multipartEncapsulate(boundary=boundary , content_type=rendering["media_type"] , payload=rendered)
+    yield ('--' + boundary + '--').encode()
+
+def gzipYield(chunks, level : int):
+    """Gzip compresses a stream of byte chunks incrementally. Each chunk is flushed so that the client receives it without waiting for the next one."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31) # wbits=31 for the gzip container.
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
 
 def multipartEncapsulate(boundary : str, content_type: str,  payload : bytes):
     boundary = bytes("--"+boundary, 'utf-8')
@@ -663,6 +1012,10 @@ def multipart_payload(transfer_syntax, object_bytes , boundary):
     return bytes(multipart_frame)
 
 
+def multipart_part(transfer_syntax, object_bytes , boundary):
+    header = '--' + boundary + '\r\nContent-Type: ' + get_content_type(transfer_syntax) + '; transfer-syntax="' + transfer_syntax + '"\r\n\r\n'
+    return header.encode() + object_bytes + b'\r\n'
+
 def multipart_footer(boundary : str , payload : bytes):
     ft = '\r\n--' + boundary + '--'
     return payload+ft.encode()
@@ -686,6 +1039,9 @@ def get_content_type (transfer_syntax):
             uid.JPEG2000:                       "image/jp2",
             uid.JPEG2000MCLossless:             "image/jpx",
             uid.JPEG2000MC:                     "image/jpx",
+            uid.HTJ2KLossless:                  "image/jph",
+            uid.HTJ2KLosslessRPCL:              "image/jph",
+            uid.HTJ2K:                          "image/jph",
             uid.MPEG2MPML:                      "video/mpeg2",
             uid.MPEG2MPHL:                      "video/mpeg2",
             uid.MPEG4HP41:                      "video/mp4",
@@ -701,14 +1057,12 @@ def get_content_type (transfer_syntax):
     return cont_type
 
 
-def RetrieveMetadata(query, UID : str):
-    start = datetime.datetime.now()
-    fields , results = _executeQuery(query , (UID,) )
-    end = datetime.datetime.now()
-    ahi_metadatas = []
-    metadata_table = []
+def metadataYield(query, UID : str , results : list = None):
+    """Yields the DICOM JSON dict of each instance, as they are converted from the AHI metadata.
+    results : the (datastore_id, imageset_id) rows of the query, when already fetched by the caller."""
+    if results is None:
+        fields , results = _executeQuery(query , (UID,) )
     #Get the metadatas from the Cache or from AHI.
-    start = datetime.datetime.now()
     meta_fetch = []
     for res in results:
         datastore_id = res[0]
@@ -716,21 +1070,87 @@ def RetrieveMetadata(query, UID : str):
         meta_fetch.append((datastore_id,imageset_id,))
     with concurrent.futures.ThreadPoolExecutor(100) as executor:
         ahi_metadatas = executor.map(metadatacache.getMetadataViaTuple, meta_fetch)  
-    end = datetime.datetime.now()
     instance_array = set()
     for metadata in ahi_metadatas:
-        patient_dict = metadataCache.getJSONKeys(metadata["Patient"]["DICOM"])
-        study_dict = metadataCache.getJSONKeys(metadata["Study"]["DICOM"])
+        assignToCache(metadata , "metadata" , UID)
+        patient_dict , study_dict , series_dict = metadataCache.getJSONBlocks(metadata)
         seriesinstanceuid = next(iter(metadata["Study"]["Series"].keys()))
-        series_dict = metadataCache.getJSONKeys(metadata["Study"]["Series"][seriesinstanceuid]["DICOM"])
         iteration = iter(metadata["Study"]["Series"][seriesinstanceuid]["Instances"].keys())
         for instance in iteration:
             if not instance in instance_array:
                 instance_meta=metadataCache.getInstancedDict(instance_uid=instance, metadata=metadata, patient_dict=patient_dict , study_dict=study_dict , series_dict=series_dict)
                 instance_array.add(instance)
-                metadata_table.append(instance_meta)
-    return metadata_table
+                yield instance_meta
+
+def jsonArrayYield(items, chunk_size : int = 65536):
+    """Serializes the items as a JSON array, yielded in chunks of about chunk_size bytes."""
+    buffer = bytearray(b"[")
+    first = True
+    for item in items:
+        if not first:
+            buffer += b","
+        buffer += orjson.dumps(item)
+        first = False
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    buffer += b"]"
+    yield bytes(buffer)
+
+def _metadataResponse(level : str , query : str , UID : str):
+    """Builds the response of the WADO-RS metadata resources. The gzip representation of the response is cached and identified by an ETag,
+    so a repeated request is served without serialization nor compression, or with a 304 when the client already has it."""
+    mimetype = "text/json"
+    contentType = "application/dicom+json"
+    gzip_response = 'gzip' in request.headers.get('Accept-Encoding','').lower()
+    cache_key = f"{level}/{UID}"
+    cached = metadata_responses.get(cache_key) if metadata_responses is not None else None
+    if cached is not None:
+        if cached["etag"] in request.headers.get('If-None-Match',''):
+            http_response = Response(status = 304)
+        elif gzip_response:
+            http_response = Response(status = 200 , response=cached["content"], mimetype=mimetype , content_type=contentType )
+            http_response.headers['Content-length'] = len(cached["content"])
+            http_response.headers['Content-Encoding'] = 'gzip'
+        else:
+            http_response = Response(status = 200 , response=gzip.decompress(cached["content"]), mimetype=mimetype , content_type=contentType )
+        http_response.headers['ETag'] = cached["etag"]
+        return http_response
+    instances = metadataYield(query , UID)
+    first_instance = next(instances, None)
+    if first_instance is None:
+        return Response(status = 400 , response=orjson.dumps([]), mimetype=mimetype , content_type=contentType )
+    etag = f'W/"{uuid4().hex}"'
+    json_chunks = jsonArrayYield(itertools.chain([first_instance], instances))
+    http_response = Response(status = 200 , response=metadataResponseYield(json_chunks, cache_key, etag, gzip_response), mimetype=mimetype , content_type=contentType )
+    if gzip_response:
+        logging.debug("response will be gzipped")
+        http_response.headers['Content-Encoding'] = 'gzip'
+    if metadata_responses is not None:
+        http_response.headers['ETag'] = etag
+    return http_response
 
+def metadataResponseYield(json_chunks, cache_key : str , etag : str , gzip_response : bool):
+    """Streams the JSON chunks, gzip compressed if requested, and stores the complete compressed response in the cache once streamed."""
+    caching = metadata_responses is not None
+    compressor = zlib.compressobj(5, zlib.DEFLATED, 31) if caching or gzip_response else None
+    compressed = []
+    for chunk in json_chunks:
+        if compressor is None:
+            yield chunk
+            continue
+        compressed_chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if caching:
+            compressed.append(compressed_chunk)
+        yield compressed_chunk if gzip_response else chunk
+    if compressor is not None:
+        tail = compressor.flush()
+        if gzip_response:
+            yield tail
+        if caching:
+            compressed.append(tail)
+            content = b"".join(compressed)
+            metadata_responses.put(cache_key, {"etag" : etag , "content" : content}, len(content))
 
 def RetrieveInstance(query, UID : str):
     fields , results = _executeQuery(query , (UID,) )
@@ -739,9 +1159,9 @@ def RetrieveInstance(query, UID : str):
         datastore_id = res[0]
         imageset_id = res[1] 
         metadata = metadatacache.getMetadata(datastore_id=datastore_id , imageset_id=imageset_id)
-        assignToCache(metadata=metadata)
         series_uid = next(iter(metadata["Study"]["Series"].keys()))
         if UID in metadata["Study"]["Series"][series_uid]["Instances"].keys():
+            assignToCache(metadata , "instance" , UID , { frame["ID"] for frame in metadata["Study"]["Series"][series_uid]["Instances"][UID].get("ImageFrames", []) })
             insDICOMizer = InstanceDICOMizer(ahi_client=ahi_client)
             if metadata["Study"]["Series"][series_uid]["Instances"][UID]["DICOM"]["SOPClassUID"] == "1.2.840.10008.5.1.4.1.1.66.4": # <-- jpleger : 01/09/2025 - a bit hacky, just to support binary segmentation class... Need proper SOPClassUID conditions handling... I should normally also check the Segmentation format , BINARY , FRACTIONAL or LABELMAP. At the moment this only works for BINARY
                 insDICOMizer.getFramePixels = getFrame  #getFrame merely return the bytes array as received from AHI
@@ -779,46 +1199,109 @@ def genMetadata(fetch_files):
 
 
 def getFrame(datastore_id, imageset_id, imageframe_id , client = None ):
-    try:
-        frame_cache_file = open(f"./cache/{datastore_id}/{imageset_id}/{imageframe_id}.cache", 'rb')
-        frame = frame_cache_file.read()
-        frame_cache_file.close()
+    frame = None
+    if prefetch_policy is not None: # not set in the frame fetcher processes either : only the client requests are counted.
+        prefetch_policy.recordRequest(datastore_id, imageset_id, imageframe_id)
+    if frame_store is not None: # frame_store is not set in the frame fetcher processes, which only call this function for frames not cached yet.
+        frame = frame_store.read(datastore_id, imageset_id, imageframe_id)
+    if frame is not None:
         logging.debug(f"cache HIT    : {datastore_id}/{imageset_id}/{imageframe_id}")
+        cCleaner.recordAccess(datastore_id, imageset_id)
         return frame
-    except:
+    else:
         try:
             logging.debug(f"cache MISSED : {datastore_id}/{imageset_id}/{imageframe_id}")
             if client is None :
                 client = boto3.client('medical-imaging')
-            res = client.get_image_frame(
-                datastoreId=datastore_id,
-                imageSetId=imageset_id,
-                imageFrameInformation= {'imageFrameId' :imageframe_id})
-            return res['imageFrameBlob'].read()
+            if frame_registry is not None: # not set in the frame fetcher processes, which register their fetches in fetchAndStore.
+                return _fetchFrameOnce(datastore_id, imageset_id, imageframe_id, client)
+            return _fetchFrame(datastore_id, imageset_id, imageframe_id, client)
         except Exception as e:
             return None
 
+def _fetchFrameOnce(datastore_id, imageset_id, imageframe_id , client):
+    """Downloads the frame once for all the concurrent requests : joins the download in progress in the service or in a frame fetcher, and downloads
+    a frame queued for prefetch right away, storing it so that the frame fetcher skips it."""
+    key = f"{datastore_id}/{imageset_id}/{imageframe_id}"
+    future , owner = frame_registry.joinLocal(key)
+    if not owner:
+        return future.result()
+    frame = None
+    try:
+        inflight_owner , registered = frame_registry.begin(key, FOREGROUND)
+        if inflight_owner is not None:
+            if frame_registry.wait(key, FRAME_JOIN_TIMEOUT) and frame_store is not None:
+                frame = frame_store.read(datastore_id, imageset_id, imageframe_id)
+                if frame is not None:
+                    frame_registry.recordJoin()
+                    return frame
+            frame = _fetchFrame(datastore_id, imageset_id, imageframe_id, client) # the other download failed, or did not store the frame.
+            return frame
+        try:
+            if frame_store is not None: # a frame fetcher may have stored it since the cache was checked.
+                frame = frame_store.read(datastore_id, imageset_id, imageframe_id)
+                if frame is not None:
+                    return frame
+            frame = _fetchFrame(datastore_id, imageset_id, imageframe_id, client)
+            if frame is not None:
+                _promoteFrame(datastore_id, imageset_id, imageframe_id, frame)
+        finally:
+            if registered:
+                frame_registry.end(key)
+        return frame
+    finally:
+        frame_registry.resolveLocal(key, future, frame)
+
+def _promoteFrame(datastore_id, imageset_id, imageframe_id , frame):
+    """Stores a frame queued for prefetch and downloaded by a client request, so that the frame fetcher skips it."""
+    if frame_store is None or not _isQueuedOrCached(datastore_id, imageset_id, imageframe_id):
+        return
+    frame_store.write(datastore_id, imageset_id, imageframe_id, frame)
+    frameFetcher.cache_index.markCached(datastore_id+"/"+imageset_id, [(imageframe_id, len(frame))])
+    cCleaner.recordAccess(datastore_id, imageset_id, len(frame))
+    frame_registry.recordPromotion()
+
+def _fetchFrame(datastore_id, imageset_id, imageframe_id , client):
+    """Reads the frame from the shared frame backend, or downloads it from AHI and stores it there for the other service tasks."""
+    if frame_backend is None: # not set in the frame fetcher processes, which get the shared backend in fetchAndStore.
+        return _scheduledFetch(datastore_id, imageset_id, imageframe_id, client)
+    key = f"{datastore_id}/{imageset_id}/{imageframe_id}"
+    frame = frame_backend.get(key)
+    if frame is None:
+        frame = _scheduledFetch(datastore_id, imageset_id, imageframe_id, client)
+        if frame is not None:
+            frame_backend.put(key, frame)
+    return frame
+
+def _scheduledFetch(datastore_id, imageset_id, imageframe_id , client):
+    if ahi_scheduler is not None: # not set in the frame fetcher processes, which schedule their fetches in the background class.
+        return ahi_scheduler.run(FOREGROUND, _getImageFrame, client, datastore_id, imageset_id, imageframe_id)
+    return _getImageFrame(client, datastore_id, imageset_id, imageframe_id)
+
+def _getImageFrame(client, datastore_id, imageset_id, imageframe_id):
+    res = client.get_image_frame(
+        datastoreId=datastore_id,
+        imageSetId=imageset_id,
+        imageFrameInformation= {'imageFrameId' :imageframe_id})
+    return res['imageFrameBlob'].read()
+
 def getFramePixels(datastore_id, imageset_id, imageframe_id , client = None ):
+    decoded = getDecodedFrame(datastore_id, imageset_id, imageframe_id , client)
+    return decoded["pixels"] if decoded is not None else None
+
+def getDecodedFrame(datastore_id, imageset_id, imageframe_id , client = None ):
+    """Returns a dict with the pixels, rows, columns, bits and transfer_syntax of the decoded frame, or None if it cannot be retrieved or decoded."""
+    frame_key = f"{datastore_id}/{imageset_id}/{imageframe_id}"
+    if decoded_cache is not None:
+        decoded = decoded_cache.get(frame_key)
+        if decoded is not None:
+            return decoded
     try:
         b = getFrame(datastore_id, imageset_id, imageframe_id , client)
-        b = io.BytesIO(b)
-
-        if b.getvalue():
-            try:
-                d = decode(b)
-                return d.tobytes()
-            except Exception as e:
-                with Image.open(b) as img:
-                    output = io.BytesIO()
-                    img.save(output, format='JPEG')
-                    output.seek(0)
-                    return output.getvalue()
-        else:
-            with Image.open(b) as img:
-                output = io.BytesIO()
-                img.save(output, format='JPEG')
-                output.seek(0)
-                return output.getvalue()
+        decoded = decode_engine.decode(b)
+        if decoded_cache is not None:
+            decoded_cache.recordDecode(frame_key, **decoded)
+        return decoded
     except Exception as e:
         logging.error("[{__name__}] - Frame could not be decoded.")
         logging.error(f"{datastore_id}/{imageset_id}/{imageframe_id}")
@@ -826,16 +1309,56 @@ def getFramePixels(datastore_id, imageset_id, imageframe_id , client = None ):
         return None
 
 
-def assignToCache(metadata : object = None , frame_dict : object =None):
-    frames_dict = frameFetcher.getFramesToCache(metadata=metadata)
+def assignToCache(metadata : object , route : str , instance_uid : str = None , requested : set = ()):
+    """Queues to the frame fetchers the frames of the image set selected by the prefetch policy of the route.
+    instance_uid : the requested instance, if any. requested : the frame ids retrieved by the request itself."""
+    if prefetch_policy is None:
+        return
+    frames_dict = prefetch_policy.select(route , metadata , instance_uid , requested , known_frames=_queuedOrCachedFrames)
+    if len(frames_dict) == 0:
+        return
+    # marked as queued in the cache index in a single transaction, the frames queued meanwhile by another process are left to it.
+    claimed = set(frameFetcher.cache_index.claim(metadata["DatastoreID"]+"/"+metadata["ImageSetID"] , [ frame["imageframe_id"] for frame in frames_dict ]))
     ff_count = len(framefetchers)
     ff_selected = 0
     for frame in frames_dict:
-        framefetchers[ff_selected].addToCache(frame)
+        if frame["imageframe_id"] not in claimed:
+            continue
+        framefetchers[ff_selected].queue(frame)
         ff_selected+=1
         if ff_selected == ff_count:
             ff_selected=0
 
+def _prefetchFromIndex(route : str , instance_uid : str , frame_refs : list):
+    """Applies the prefetch policy of the route to frames resolved from the frame index, without the image set metadata : the metadata is
+    loaded and the policy applied in the background."""
+    if prefetch_policy is None or not prefetch_policy.isEnabled(route) or len(frame_refs) == 0:
+        return
+    datastore_id , imageset_id = frame_refs[0][0] , frame_refs[0][1]
+    pending_key = (imageset_id , instance_uid)
+    with prefetch_pending_lock:
+        if pending_key in prefetch_pending: # the concurrent requests for the frames of the instance prefetch once.
+            return
+        prefetch_pending.add(pending_key)
+    prefetch_executor.submit(_prefetchWithMetadata , datastore_id , imageset_id , route , instance_uid , { frame_ref[2] for frame_ref in frame_refs })
+
+def _prefetchWithMetadata(datastore_id : str , imageset_id : str , route : str , instance_uid : str , requested : set):
+    try:
+        metadata = metadatacache.getMetadata(datastore_id= datastore_id , imageset_id= imageset_id)
+        if metadata is not None:
+            assignToCache(metadata , route , instance_uid , requested)
+    except Exception as err:
+        logging.error(f"[_prefetchWithMetadata] - {datastore_id}/{imageset_id} prefetch failed : {err}")
+    finally:
+        with prefetch_pending_lock:
+            prefetch_pending.discard((imageset_id , instance_uid))
+
+def _isQueuedOrCached(datastore_id : str , imageset_id : str , imageframe_id : str):
+    return frameFetcher.cache_index.contains(datastore_id+"/"+imageset_id, imageframe_id)
+
+def _queuedOrCachedFrames(datastore_id : str , imageset_id : str , imageframe_ids : list):
+    return frameFetcher.cache_index.containing(datastore_id+"/"+imageset_id, imageframe_ids)
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     logging.getLogger('InstanceDICOMizer').setLevel(logging.CRITICAL)
@@ -861,10 +1384,153 @@ if __name__ == '__main__':
         logging.warning("No cache location provided, defaulting to "+os.curdir+"/cache/")
         cache_root = './cache'
         os.makedirs(cache_root,exist_ok=True)
+    try:
+        cache_engine = os.environ['FRAME_CACHE_ENGINE'].lower()
+    except:
+        cache_engine = "files"
+    try:
+        decoded_cache_size = int(os.environ['DECODED_CACHE_SIZE'])
+    except:
+        decoded_cache_size = 0 # in MB, 0 disables the decoded frame cache.
+    try:
+        decoded_cache_promote_after = int(os.environ['DECODED_CACHE_PROMOTE_AFTER'])
+    except:
+        decoded_cache_promote_after = 2
+    try:
+        decode_workers = int(os.environ['DECODE_WORKERS'])
+    except:
+        decode_workers = multiprocessing.cpu_count() # 0 decodes the frames in the request threads.
+    try:
+        metadata_cache_size = int(os.environ['METADATA_CACHE_SIZE'])
+    except:
+        metadata_cache_size = 2048 # in MB
+    try:
+        metadata_cache_ttl = int(os.environ['METADATA_CACHE_TTL'])
+    except:
+        metadata_cache_ttl = 3600 # in seconds
+    try:
+        metadata_response_cache_size = int(os.environ['METADATA_RESPONSE_CACHE_SIZE'])
+    except:
+        metadata_response_cache_size = 512 # in MB, 0 disables the metadata response cache.
+    try:
+        rendered_cache_size = int(os.environ['RENDERED_CACHE_SIZE'])
+    except:
+        rendered_cache_size = 256 # in MB, 0 disables the rendered image cache.
+    try:
+        qido_cache_size = int(os.environ['QIDO_CACHE_SIZE'])
+    except:
+        qido_cache_size = 64 # in MB, 0 disables the QIDO response cache.
+    try:
+        qido_cache_ttl = int(os.environ['QIDO_CACHE_TTL'])
+    except:
+        qido_cache_ttl = 30 # in seconds
+    try:
+        serving_mode = os.environ['SERVING_MODE'].lower()
+    except:
+        serving_mode = "threaded" # "asyncio" serves the routes with aiohttp, aiomysql and an asynchronous AHI client.
+    try:
+        async_executor_threads = int(os.environ['ASYNC_EXECUTOR_THREADS'])
+    except:
+        async_executor_threads = 32
+    try:
+        metadata_disk_cache = os.environ['METADATA_DISK_CACHE'].lower() != "false"
+    except:
+        metadata_disk_cache = True
+    prefetch_routes = {}
+    for route , default_policy in (("frames" , "neighbors") , ("metadata" , "none") , ("rendered" , "none") , ("instance" , "none")):
+        try:
+            prefetch_routes[route] = os.environ['PREFETCH_POLICY_'+route.upper()].lower()
+        except:
+            prefetch_routes[route] = default_policy
+        if prefetch_routes[route] not in PREFETCH_POLICIES:
+            config_good = False
+            logging.error(f"{prefetch_routes[route]} is not a valid prefetch policy for the {route} route. Use one of : {PREFETCH_POLICIES}")
+    try:
+        prefetch_request_budget = int(os.environ['PREFETCH_REQUEST_BUDGET'])
+    except:
+        prefetch_request_budget = 256 # in MB
+    try:
+        prefetch_global_budget = int(os.environ['PREFETCH_GLOBAL_BUDGET'])
+    except:
+        prefetch_global_budget = 2048 # in MB
+    try:
+        prefetch_neighbors = int(os.environ['PREFETCH_NEIGHBORS'])
+    except:
+        prefetch_neighbors = 8
+    try:
+        prefetch_ttl = int(os.environ['PREFETCH_TTL'])
+    except:
+        prefetch_ttl = 600 # in seconds
+    try:
+        ahi_max_concurrency = int(os.environ['AHI_MAX_CONCURRENCY'])
+    except:
+        ahi_max_concurrency = 64
+    try:
+        ahi_bandwidth = int(os.environ['AHI_BANDWIDTH'])
+    except:
+        ahi_bandwidth = 0 # in MB/s, 0 for unlimited.
+    try:
+        ahi_foreground_reserve = int(os.environ['AHI_FOREGROUND_RESERVE'])
+    except:
+        ahi_foreground_reserve = 8
+    try:
+        frame_index_size = int(os.environ['FRAME_INDEX_SIZE'])
+    except:
+        frame_index_size = 64 # in MB
+    try:
+        frame_index_read_through = os.environ['FRAME_INDEX_READ_THROUGH'].lower() == "true"
+    except:
+        frame_index_read_through = False # the frame table is only populated when the metadata-index is deployed with populate_frame_level, which is off by default.
+    try:
+        cache_backend_memory_size = int(os.environ['CACHE_BACKEND_MEMORY_SIZE'])
+    except:
+        cache_backend_memory_size = 1024 # in MB, per memory backend.
+    try:
+        cache_backend_ttl = int(os.environ['CACHE_BACKEND_TTL'])
+    except:
+        cache_backend_ttl = 86400 # in seconds
+    try:
+        cache_backend_timeout = int(os.environ['CACHE_BACKEND_TIMEOUT'])
+    except:
+        cache_backend_timeout = 500 # in ms
+    cache_backends = {}
+    # the local frames are already on disk in the frame store : the "disk" frame backend requires a folder shared by the service tasks.
+    for backend_name , default_spec , default_root , default_max_object_size in (("metadata" , "disk" if metadata_disk_cache else "none" , f"{cache_root}/metadata" , 64) , ("frame" , "none" , None , 16)):
+        try:
+            backend_spec = os.environ[backend_name.upper()+'_CACHE_BACKEND']
+        except:
+            backend_spec = default_spec
+        try:
+            backend_max_object_size = int(os.environ[backend_name.upper()+'_CACHE_BACKEND_MAX_OBJECT_SIZE'])
+        except:
+            backend_max_object_size = default_max_object_size # in MB
+        try:
+            cache_backends[backend_name] = getCacheBackend(backend_spec , backend_name , default_root=default_root , max_object_size_mb=backend_max_object_size , memory_size_mb=cache_backend_memory_size , ttl=cache_backend_ttl , timeout=cache_backend_timeout/1000)
+        except ValueError as err:
+            config_good = False
+            logging.error(f"{backend_spec} is not a valid {backend_name} cache backend : {err}. Use one of : {CACHE_BACKENDS}")
         
     if config_good == True:    
         ahi_client = boto3.client('medical-imaging', config=botocore.config.Config(max_pool_connections=100))
-        metadatacache = metadataCache(ahi_client)
+        frame_backend = cache_backends["frame"]
+        metadatacache = metadataCache(ahi_client , max_size_mb=metadata_cache_size , ttl=metadata_cache_ttl , blob_backend=cache_backends["metadata"])
+        metadataCache.frame_index = frameIndex(frame_index_size , loader=_loadFrameRows if frame_index_read_through else None)
+        if metadata_response_cache_size > 0:
+            metadata_responses = lruCache(max_bytes=metadata_response_cache_size*1024*1024 , ttl=metadata_cache_ttl , name="metadataResponseCache")
+        frame_store = frameStore.getFrameStore(cache_engine, cache_root)
+        if decoded_cache_size > 0:
+            decoded_cache = decodedFrameCache(decoded_cache_size , promote_after=decoded_cache_promote_after)
+        decode_engine = decodeEngine(workers=decode_workers)
+        if qido_cache_size > 0 and qido_cache_ttl > 0:
+            qido_cache = qidoCache(qido_cache_size , ttl=qido_cache_ttl)
+        if rendered_cache_size > 0:
+            rendered_cache = lruCache(max_bytes=rendered_cache_size*1024*1024 , name="renderedCache")
+        os.makedirs(cache_root, exist_ok=True)
+        frameFetcher.cache_index = cacheIndex(f"{cache_root}/{CACHE_INDEX_FILE}")
+        cCleaner = cacheCleaner(frameFetcher.cache_index , cache_root=cache_root , frame_store=frame_store)
+        ahi_scheduler = ahiScheduler(max_concurrency=ahi_max_concurrency , bandwidth_mbps=ahi_bandwidth , foreground_reserve=ahi_foreground_reserve)
+        frame_registry = frameRegistry()
+        prefetch_policy = prefetchPolicy(prefetch_routes , request_budget_mb=prefetch_request_budget , global_budget_mb=prefetch_global_budget , neighbors=prefetch_neighbors , ttl=prefetch_ttl)
         framefetchers: list[frameFetcher] = []
         cpu_count = multiprocessing.cpu_count()
         if cpu_count > 1:
@@ -873,13 +1539,17 @@ if __name__ == '__main__':
             spare = 0
         for ff_id in range(cpu_count-spare):
             logging.info(f"[Startup] - Forking FrameFetcher FF{ff_id}")
-            framefetchers.append(frameFetcher(f"FF{ff_id}",getFrame, cache_root)) #first fetcher also embedds the cache cleaner
-        cCleaner = cacheCleaner(framefetchers[0].cached_items , cache_root=cache_root)
+            framefetchers.append(frameFetcher(f"FF{ff_id}",getFrame, cache_root, cache_engine, cCleaner.cacheEvents, ahi_scheduler, frame_registry, frame_backend if frame_backend is not None and frame_backend.shared else None))
         db_secret = _getSecret(secret_arn)
         sql_pool = mysqlConnectionFactory.mysqlConnectionFactory(hostname=db_secret['host'], username=db_secret['username'], password=db_secret['password'], database=db_secret['dbname'], port=int(db_secret['port']), pool_size=100)
         logging.info("QIDO/WADO-RS service started.")
    
 
+        if serving_mode == "asyncio":
+            import asyncServer # aiohttp and aiomysql are only required by the asyncio serving mode.
+            asyncServer.serve(sys.modules[__name__] , db_secret , host="0.0.0.0" , port=int(port) , executor_threads=async_executor_threads) #nosec - binding all intefaces on purpose
+            exit(0)
+
         WSGIRequestHandler.protocol_version = "HTTP/2"
 
         serve(app, host="0.0.0.0", port=port, url_scheme='http', max_request_body_size=4294967296,  threads=100,  asyncore_use_poll=True) #nosec - binding all intefaces on purpose
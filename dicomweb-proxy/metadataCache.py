@@ -9,7 +9,8 @@ import datetime
 import botocore
 import time
 from pydicom import datadict
-import collections.abc
+from lruCache import lruCache
+from frameIndex import frameIndex
 
 
 
@@ -17,10 +18,23 @@ import collections.abc
 class metadataCache:
     logger = logging.getLogger(__name__)
     metadata_to_cache = orjson.loads("{}")
-    metadata_cache = orjson.loads("{}")
-    frame_index = orjson.loads("{}")
+    json_blocks = lruCache(max_bytes=64*1024*1024 , name="jsonBlocksCache") # image set key -> (id of the metadata, DICOM JSON blocks), see getJSONBlocks.
+    frame_index = frameIndex() # replaced at startup by the index sized and connected to the frame table per the configuration.
+    # The parsed python objects are several times larger than the JSON text they are loaded from. This factor is applied to the decompressed JSON size to account for it in the cache budget.
+    PARSED_SIZE_FACTOR = 4
+    AHI_DEFAULT_TRANSFER_SYNTAX = "1.2.840.10008.1.2.4.202"
 
-    def __init__(self , ahi_client : object = None):
+    def __init__(self , ahi_client : object = None , max_size_mb : int = 2048 , ttl : int = 3600 , blob_backend : object = None):
+        """
+        blob_backend : cacheBackend keeping the compressed metadata blobs as returned by AHI, stamped with the image set version. None to always fetch the metadata from AHI.
+        """
+        self.metadata_cache = lruCache(max_bytes=max_size_mb*1024*1024 , ttl=ttl , name="metadataCache")
+        self.blob_backend = blob_backend
+        self.stale_blobs = 0
+        self.inflight = {} # image set key -> Future of the AHI fetch in progress, used to coalesce concurrent requests for the same metadata.
+        self.inflight_lock = threading.Lock()
+        self.upstream_fetches = 0
+        self.coalesced = 0
         self.cacheQueue = deque()
         self.cacheProcessor = threading.Thread(target=self.getMetadata)
         if ahi_client == None:
@@ -42,31 +56,77 @@ class metadataCache:
                 executor.submit(self.fetchMetadata(item["datastore_id"] , item["imageset_id"]))
 
     def fetchMetadata(self, datastore_id : str , imageset_id : str ):
-        try:
-            # jpleger : 02/15/2023 - was not the best idea....
-            # grace_before_fetch = 0
-            # while (metadataCache.metadata_cache[f"{datastore_id}{imageset_id}"] == {}) and ( grace_before_fetch < 10 ): # 1 seconds grace period in case another workflow requests the same metadata pending for retrieval. 
-            #     time.sleep(0.1)
-            #     grace_before_fetch+=1
-            #    metadataCache.logger.debug(f"[{__name__}] - CACHE PENDING : {datastore_id}{imageset_id}")
-            metadata = metadataCache.metadata_cache[f"{datastore_id}{imageset_id}"]["metadata"]
+        cache_key = f"{datastore_id}{imageset_id}"
+        metadata = self.metadata_cache.get(cache_key)
+        if metadata is not None:
             metadataCache.logger.debug(f"[{__name__}] - CACHE HIT : {datastore_id}{imageset_id}")
             return metadata
-        except:
-            try:
-                metadataCache.metadata_cache[f"{datastore_id}{imageset_id}"] = {}
-                start = datetime.datetime.now()
-                metadata = self.ahi_client.get_image_set_metadata(datastoreId=datastore_id , imageSetId=imageset_id)["imageSetMetadataBlob"]
-                metadata = gzip.decompress(metadata.read())
-                metadata = orjson.loads(metadata)
-                metadataCache.metadata_cache[f"{datastore_id}{imageset_id}"] = {"metadata" : metadata , "dt" : datetime.datetime.now()} 
-                end = datetime.datetime.now()
-                metadataCache.logger.debug(f"[{__name__}] - CACHE MISSED : {datastore_id}{imageset_id} fetch : {end-start}")
-                return metadata
-            except Exception as AHIErr :
-                self.logger.error(f"[{__name__}] - {AHIErr}")
-                return None
-            
+        with self.inflight_lock:
+            future = self.inflight.get(cache_key)
+            if future is None:
+                # Re-check under the lock, the fetch may have completed since the first lookup.
+                if cache_key in self.metadata_cache:
+                    metadata = self.metadata_cache.get(cache_key)
+                    if metadata is not None:
+                        return metadata
+                future = concurrent.futures.Future()
+                self.inflight[cache_key] = future
+                self.upstream_fetches += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            metadataCache.logger.debug(f"[{__name__}] - CACHE PENDING : {datastore_id}{imageset_id}")
+            return future.result()
+        metadata = None
+        try:
+            metadata = self._fetchFromAHI(datastore_id, imageset_id)
+        finally:
+            with self.inflight_lock:
+                del self.inflight[cache_key]
+            future.set_result(metadata)
+        return metadata
+
+    def _fetchFromAHI(self, datastore_id : str , imageset_id : str ):
+        try:
+            start = datetime.datetime.now()
+            metadata = None
+            version_id = None
+            if self.blob_backend is not None:
+                version_id = self.ahi_client.get_image_set(datastoreId=datastore_id , imageSetId=imageset_id)["versionId"]
+                metadata = self._readBlob(datastore_id, imageset_id, version_id)
+            if metadata is None:
+                if version_id is None:
+                    metadata = self.ahi_client.get_image_set_metadata(datastoreId=datastore_id , imageSetId=imageset_id)["imageSetMetadataBlob"].read()
+                else:
+                    metadata = self.ahi_client.get_image_set_metadata(datastoreId=datastore_id , imageSetId=imageset_id , versionId=version_id)["imageSetMetadataBlob"].read()
+                    # the older version of the image set, if any, is overwritten.
+                    self.blob_backend.put(f"{datastore_id}/{imageset_id}.blob", version_id.encode() + b"\n" + metadata)
+            metadata = gzip.decompress(metadata)
+            metadata_size = len(metadata) * metadataCache.PARSED_SIZE_FACTOR
+            metadata = orjson.loads(metadata)
+            self.metadata_cache.put(f"{datastore_id}{imageset_id}" , metadata , metadata_size)
+            metadataCache.json_blocks.delete(f"{datastore_id}{imageset_id}")
+            end = datetime.datetime.now()
+            metadataCache.logger.debug(f"[{__name__}] - CACHE MISSED : {datastore_id}{imageset_id} fetch : {end-start}")
+            return metadata
+        except Exception as AHIErr :
+            self.logger.error(f"[{__name__}] - {AHIErr}")
+            return None
+
+    def _readBlob(self, datastore_id : str , imageset_id : str , version_id : str):
+        """Returns the compressed metadata blob of the version of the image set from the backend, None if the backend holds another version."""
+        blob = self.blob_backend.get(f"{datastore_id}/{imageset_id}.blob")
+        if blob is None:
+            return None
+        stored_version , _ , blob = blob.partition(b"\n")
+        if stored_version.decode() != version_id:
+            self.stale_blobs += 1
+            return None
+        metadataCache.logger.debug(f"[{__name__}] - BLOB CACHE HIT : {datastore_id}{imageset_id} version {version_id}")
+        return blob
+
     def getMetadata(self, datastore_id : str, imageset_id : str):
         metadata = self.fetchMetadata(datastore_id, imageset_id  )
         return metadata
@@ -77,6 +137,20 @@ class metadataCache:
         metadata = self.fetchMetadata(datastore_id, imageset_id  )
         return metadata
 
+    def getStats(self):
+        stats = self.metadata_cache.getStats()
+        with self.inflight_lock:
+            stats["upstream_fetches"] = self.upstream_fetches
+            stats["coalesced"] = self.coalesced
+            stats["inflight"] = len(self.inflight)
+            requests_on_miss = self.upstream_fetches + self.coalesced
+            stats["coalescing_rate"] = self.coalesced / requests_on_miss if requests_on_miss > 0 else 0.0
+        stats["json_blocks"] = metadataCache.json_blocks.getStats()
+        if self.blob_backend is not None:
+            stats["blob_backend"] = self.blob_backend.getStats()
+            stats["blob_backend"]["stale"] = self.stale_blobs
+        return stats
+
     @staticmethod 
     def metadataToDict(metadata : object ,  instance_uid : str = None):
         series_uid = next(iter(metadata["Study"]["Series"].keys()))
@@ -96,15 +170,8 @@ class metadataCache:
     def getInstancedDict(instance_uid : str, metadata: object = None, patient_dict: dict = None, study_dict: dict = None, series_dict : dict = None):
         complete_instance = dict()
         series_uid = next(iter(metadata["Study"]["Series"].keys()))
-        if patient_dict is None:
-            patient_block = metadata["Patient"]["DICOM"]
-            patient_dict = metadataCache.getJSONKeys(patient_block)
-        if study_dict is None:
-            study_block =  metadata["Study"]["DICOM"]   
-            study_dict = metadataCache.getJSONKeys(study_block)
-        if series_dict is None:
-            series_block = metadata["Study"]["Series"][series_uid]["DICOM"]
-            series_dict = metadataCache.getJSONKeys(series_block)
+        if patient_dict is None or study_dict is None or series_dict is None:
+            patient_dict , study_dict , series_dict = metadataCache.getJSONBlocks(metadata)
         instance_block = metadata["Study"]["Series"][series_uid]["Instances"][instance_uid]["DICOM"]
         instance_dict = metadataCache.getJSONKeys(instance_block)
         complete_instance.update(patient_dict)
@@ -113,12 +180,15 @@ class metadataCache:
         complete_instance.update(instance_dict)
         complete_instance = dict(sorted(complete_instance.items()))
         #Attempt to populate the frame index...
-        frame_number = 1
-        for frame in metadata["Study"]["Series"][series_uid]["Instances"][instance_uid]["ImageFrames"]:
-            metadataCache.frame_index[instance_uid+"_"+str(frame_number)] = { "DatastoreID" : metadata["DatastoreID"], "ImageSetID" : metadata["ImageSetID"] , "ImageFrameID" : frame["ID"] }
-            frame_number = frame_number + 1     
+        instance = metadata["Study"]["Series"][series_uid]["Instances"][instance_uid]
+        metadataCache.frame_index.put(instance_uid , metadata["DatastoreID"] , metadata["ImageSetID"] , [ frame["ID"] for frame in instance["ImageFrames"] ] , metadataCache.getStoredTransferSyntax(instance))
         return complete_instance
 
+    @staticmethod
+    def getStoredTransferSyntax(instance : object):
+        """Transfer syntax of the frames as stored by AHI and returned by GetImageFrame. Defaults to HTJ2K lossless with RPCL for the image sets without the information."""
+        return instance.get("StoredTransferSyntaxUID", metadataCache.AHI_DEFAULT_TRANSFER_SYNTAX)
+
     @staticmethod
     def getDICOMVRs(self,taglevel, vrlist):
         for theKey in taglevel:
@@ -133,32 +203,65 @@ class metadataCache:
         return hex_representation.upper()
 
     @staticmethod
-    def getJSONKeys(tagblock : object, depth : int = 0 ):
-        dicom_set = dict()
-        for key in tagblock.keys():
-            try:
-                tag = datadict.tag_for_keyword(key)
-                vr = datadict.dictionary_VR(key)
-            except Exception as err:
+    def buildKeywordTable():
+        """Precomputes, for each DICOM keyword of the pydicom dictionary, its 8 characters hex tag and the function converting a value to its DICOM JSON element."""
+        table = {}
+        for tag , ( vr , vm , name , retired , keyword ) in datadict.DicomDictionary.items():
+            if keyword == "":
                 continue
-            tab = ""
-            for x in range(depth):
-                tab = tab+"\t"
-            hex_tag = metadataCache.get8CharTag(hex(tag)) 
-            if vr == "IS" and isinstance( tagblock[key] , str):
-                tagblock[key] = int(tagblock[key])
-            if vr == "SQ":
-                depth=depth+1
-                element_array = []
-                for subelement in tagblock[key]:
-                    element_array.append(metadataCache.getJSONKeys(subelement, depth))
-                dicom_set[hex_tag] = { "vr" : vr , "Value" : element_array}
-            else:
-                if tagblock[key] is not None:
-                    if isinstance(tagblock[key] , collections.abc.Sequence) and not isinstance(tagblock[key],str):
-                        dicom_set[hex_tag] =  { "vr" : vr , "Value" : tagblock[key]}
-                    else:
-                        dicom_set[hex_tag] =  { "vr" : vr , "Value" : [tagblock[key]]}
-                else:
-                    dicom_set[hex_tag] =  { "vr" : vr }
-        return dicom_set
\ No newline at end of file
+            match vr:
+                case "SQ":
+                    converter = metadataCache._sequenceElement
+                case "IS":
+                    converter = metadataCache._integerStringElement
+                case _:
+                    converter = metadataCache._elementConverter(vr)
+            table[keyword] = ( f"{tag:08X}" , converter )
+        return table
+
+    @staticmethod
+    def _elementConverter(vr : str):
+        def convert(value):
+            if value is None:
+                return { "vr" : vr }
+            if isinstance(value, list):
+                return { "vr" : vr , "Value" : value }
+            return { "vr" : vr , "Value" : [value] }
+        return convert
+
+    @staticmethod
+    def _integerStringElement(value):
+        if value is None:
+            return { "vr" : "IS" }
+        if isinstance(value, str):
+            return { "vr" : "IS" , "Value" : [int(value)] }
+        if isinstance(value, list):
+            return { "vr" : "IS" , "Value" : value }
+        return { "vr" : "IS" , "Value" : [value] }
+
+    @staticmethod
+    def _sequenceElement(value):
+        if value is None:
+            return { "vr" : "SQ" }
+        return { "vr" : "SQ" , "Value" : [metadataCache.getJSONKeys(item) for item in value] }
+
+    @staticmethod
+    def getJSONKeys(tagblock : object):
+        table = metadataCache.keyword_table
+        return { entry[0] : entry[1](value) for key , value in tagblock.items() if (entry := table.get(key)) is not None } # keywords not in the dictionary are skipped.
+
+    @staticmethod
+    def getJSONBlocks(metadata : object):
+        """Returns the DICOM JSON dicts of the patient, study and series levels of the image set. They are converted once per cached metadata, and kept
+        in json_blocks within its own byte budget."""
+        cache_key = f"{metadata['DatastoreID']}{metadata['ImageSetID']}"
+        cached = metadataCache.json_blocks.get(cache_key)
+        if cached is not None and cached[0] == id(metadata):
+            return cached[1]
+        series_uid = next(iter(metadata["Study"]["Series"].keys()))
+        blocks = ( metadataCache.getJSONKeys(metadata["Patient"]["DICOM"]) , metadataCache.getJSONKeys(metadata["Study"]["DICOM"]) , metadataCache.getJSONKeys(metadata["Study"]["Series"][series_uid]["DICOM"]) )
+        metadataCache.json_blocks.put(cache_key , (id(metadata) , blocks) , len(orjson.dumps(blocks)) * metadataCache.PARSED_SIZE_FACTOR)
+        return blocks
+
+
+metadataCache.keyword_table = metadataCache.buildKeywordTable()
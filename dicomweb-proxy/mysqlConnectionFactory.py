@@ -16,7 +16,10 @@ class mysqlConnectionFactory(object):
         'client_flags': [ClientFlag.SSL],
         'ssl_ca': '',
         'db': database, 
-        'port': port
+        'port': port,
+        # the queries are read only : the isolation level is set once per pooled connection instead of around each query.
+        'init_command': "SET SESSION TRANSACTION ISOLATION LEVEL READ UNCOMMITTED",
+        'autocommit': True
     }
     try:   
       if pool_size is None:
@@ -24,7 +27,8 @@ class mysqlConnectionFactory(object):
       if pool_name is None:
         pool_name = "dicomweb-pool"
       mysql.connector.pooling.CNX_POOL_MAXSIZE = 200
-      cnxpool = mysql.connector.pooling.MySQLConnectionPool(pool_name = pool_name,pool_size = pool_size,**config)
+      # the session is not reset when a connection is returned to the pool, so that its isolation level and its prepared statements are kept.
+      cnxpool = mysql.connector.pooling.MySQLConnectionPool(pool_name = pool_name,pool_size = pool_size,pool_reset_session = False,**config)
     except mysql.connector.Error as err:
       if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
         print("Something is wrong with your user name or password")
@@ -0,0 +1,188 @@
+"""
+prefetchPolicy Module : Selects the frames of an image set to download in the background after a WADO-RS request, per the policy configured for its route.
+
+Policies :
+    none : nothing is prefetched.
+    series : all the frames of the series, in InstanceNumber order.
+    neighbors : the frames of the requested instance and of the instances around it in InstanceNumber order, nearest first.
+    middleout : all the frames of the series from the middle instance outwards, the order viewers load a stack in.
+
+The frame sizes are estimated from the instance attributes. Each request prefetches at most its byte budget, and the prefetched frames not requested
+yet are bounded by a global byte budget. A prefetched frame is a hit when it is requested, and is wasted when it was not requested within the ttl.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import time
+import itertools
+import threading
+import logging
+from collections import OrderedDict
+
+
+PREFETCH_POLICIES = ["none" , "series" , "neighbors" , "middleout"]
+SELECT_CHUNK = 256 # candidate frames checked against the cache at once.
+ESTIMATED_COMPRESSION_RATIO = 2 # of the HTJ2K lossless frames returned by AHI, used to estimate their size from the instance dimensions.
+
+
+def _instanceNumber(item):
+    number = item[1]["DICOM"].get("InstanceNumber")
+    try:
+        return (0 , int(number) , item[0])
+    except (TypeError , ValueError):
+        return (1 , 0 , item[0]) # instances without a number are ordered last, by uid.
+
+
+def _middleOut(items : list , center : int):
+    """Yields the items from the center outwards, alternating after and before it."""
+    if len(items) == 0:
+        return
+    yield items[center]
+    for distance in range(1, len(items)):
+        if center + distance < len(items):
+            yield items[center + distance]
+        if center - distance >= 0:
+            yield items[center - distance]
+        if center + distance >= len(items) and center - distance < 0:
+            return
+
+
+def estimateFrameSize(attributes : dict):
+    """Estimated size in bytes of a frame of the instance as returned by AHI."""
+    try:
+        rows = int(attributes.get("Rows", 512))
+        columns = int(attributes.get("Columns", 512))
+        bits = int(attributes.get("BitsAllocated", 16))
+        samples = int(attributes.get("SamplesPerPixel", 1))
+    except (TypeError , ValueError):
+        rows , columns , bits , samples = 512 , 512 , 16 , 1
+    return max(1, rows * columns * samples * ((bits + 7) // 8) // ESTIMATED_COMPRESSION_RATIO)
+
+
+class prefetchPolicy:
+
+    def __init__(self, route_policies : dict , request_budget_mb : int = 256 , global_budget_mb : int = 2048 , neighbors : int = 8 , ttl : int = 600):
+        """
+        route_policies : policy name per route. The routes not listed are not prefetched.
+        request_budget_mb : maximum estimated bytes prefetched per request.
+        global_budget_mb : maximum estimated bytes prefetched and not requested yet.
+        neighbors : number of instances prefetched on each side of the requested one by the neighbors policy.
+        ttl : time in seconds after which a prefetched frame not requested is counted as wasted, and released from the global budget.
+        """
+        self.logger = logging.getLogger(__name__)
+        for route , policy in route_policies.items():
+            if policy not in PREFETCH_POLICIES:
+                raise ValueError(f"unknown prefetch policy {policy} for the {route} route, expected one of {PREFETCH_POLICIES}")
+        self.route_policies = dict(route_policies)
+        self.request_budget = request_budget_mb*1024*1024
+        self.global_budget = global_budget_mb*1024*1024
+        self.neighbors = neighbors
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.outstanding = OrderedDict() # "datastore_id/imageset_id/imageframe_id" -> (estimated size, prefetch time), oldest first.
+        self.outstanding_bytes = 0
+        self.prefetched_frames = 0
+        self.prefetched_bytes = 0
+        self.hits = 0
+        self.hit_bytes = 0
+        self.wasted_frames = 0
+        self.wasted_bytes = 0
+        self.budget_skips = 0
+
+    def isEnabled(self, route : str):
+        return self.route_policies.get(route, "none") != "none"
+
+    def _orderedFrames(self, policy : str , metadata : dict , instance_uid : str = None):
+        """Yields the (imageframe_id, estimated size) of the frames to prefetch, in priority order."""
+        for series_uid , series in metadata["Study"]["Series"].items():
+            instances = sorted(series["Instances"].items() , key=_instanceNumber)
+            if policy == "series":
+                ordered = instances
+            else:
+                position = next(( index for index , item in enumerate(instances) if item[0] == instance_uid ), None)
+                if policy == "middleout" or position is None:
+                    position = len(instances) // 2
+                if policy == "neighbors":
+                    start = max(0, position - self.neighbors)
+                    ordered = _middleOut(instances[start:position + self.neighbors + 1] , position - start)
+                else:
+                    ordered = _middleOut(instances , position)
+            for uid , instance in ordered:
+                size = estimateFrameSize({ **series["DICOM"] , **instance["DICOM"] })
+                for frame in instance.get("ImageFrames", []):
+                    yield frame["ID"] , size
+
+    def _expire(self, now : float):
+        while len(self.outstanding) > 0:
+            key , (size , prefetched) = next(iter(self.outstanding.items()))
+            if now - prefetched < self.ttl:
+                break
+            self.outstanding.popitem(last=False)
+            self.outstanding_bytes -= size
+            self.wasted_frames += 1
+            self.wasted_bytes += size
+
+    def select(self, route : str , metadata : dict , instance_uid : str = None , requested : set = () , known_frames = None):
+        """Returns the frames of the image set to prefetch after a request on the route, as fetch queue items, within the budgets.
+        instance_uid : the requested instance, if any.
+        requested : the frame ids retrieved by the request itself, which are not prefetched.
+        known_frames : function of (datastore_id, imageset_id, imageframe_ids) returning the set of those already cached or queued, which are skipped.
+        It is called once per SELECT_CHUNK candidate frames, outside the policy lock."""
+        policy = self.route_policies.get(route, "none")
+        if policy == "none" or metadata is None:
+            return []
+        datastore_id = metadata["DatastoreID"]
+        imageset_id = metadata["ImageSetID"]
+        selected = []
+        request_bytes = 0
+        ordered = ( frame for frame in self._orderedFrames(policy , metadata , instance_uid) if frame[0] not in requested )
+        exhausted = False
+        while not exhausted:
+            candidates = list(itertools.islice(ordered , SELECT_CHUNK))
+            if len(candidates) == 0:
+                break
+            known = known_frames(datastore_id , imageset_id , [ imageframe_id for imageframe_id , size in candidates ]) if known_frames is not None else set()
+            with self.lock:
+                now = time.time()
+                self._expire(now)
+                for imageframe_id , size in candidates:
+                    key = f"{datastore_id}/{imageset_id}/{imageframe_id}"
+                    if imageframe_id in known or key in self.outstanding:
+                        continue
+                    if request_bytes + size > self.request_budget or self.outstanding_bytes + size > self.global_budget:
+                        self.budget_skips += 1
+                        exhausted = True
+                        break
+                    request_bytes += size
+                    self.outstanding[key] = (size , now)
+                    self.outstanding_bytes += size
+                    self.prefetched_frames += 1
+                    self.prefetched_bytes += size
+                    selected.append({ "status" : 0 , "datastore_id" : datastore_id , "imageset_id" : imageset_id , "imageframe_id" : imageframe_id })
+        return selected
+
+    def recordRequest(self, datastore_id : str , imageset_id : str , imageframe_id : str):
+        """Called for each frame requested by a client : counts a hit if the frame was prefetched."""
+        with self.lock:
+            entry = self.outstanding.pop(f"{datastore_id}/{imageset_id}/{imageframe_id}", None)
+            if entry is not None:
+                self.outstanding_bytes -= entry[0]
+                self.hits += 1
+                self.hit_bytes += entry[0]
+
+    def getStats(self):
+        with self.lock:
+            self._expire(time.time())
+            resolved = self.hits + self.wasted_frames
+            return {
+                "policies" : self.route_policies,
+                "prefetched_frames" : self.prefetched_frames,
+                "prefetched_bytes" : self.prefetched_bytes,
+                "outstanding_frames" : len(self.outstanding),
+                "outstanding_bytes" : self.outstanding_bytes,
+                "hits" : self.hits,
+                "hit_bytes" : self.hit_bytes,
+                "wasted_frames" : self.wasted_frames,
+                "wasted_bytes" : self.wasted_bytes,
+                "hit_rate" : round(self.hits / resolved, 4) if resolved > 0 else None,
+                "budget_skips" : self.budget_skips
+            }
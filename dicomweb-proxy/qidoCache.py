@@ -0,0 +1,72 @@
+"""
+qidoCache Module : Cache of the QIDO-RS responses, keyed on the normalized query parameters.
+
+Each response is tagged with the study it is scoped to, if any, so that a change to a study only invalidates the responses of that study
+and the searches which are not scoped to a study.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import logging
+import orjson
+from lruCache import lruCache
+
+
+class qidoCache:
+
+    def __init__(self, max_size_mb : int , ttl : int):
+        """
+        max_size_mb : memory budget of the cached responses, in MB.
+        ttl : time to live of the cached responses, in seconds.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.cache = lruCache(max_bytes=max_size_mb*1024*1024 , ttl=ttl , name="qidoCache")
+        self.invalidations = 0
+
+    @staticmethod
+    def getKey(parameters : dict):
+        """Normalizes the output of _processParameters : the order of the query parameters and of the included fields does not matter."""
+        normalized = {
+            "queryLevel" : parameters["queryLevel"],
+            "StudyInstanceUID" : parameters.get("StudyInstanceUID"),
+            "SeriesInstanceUID" : parameters.get("SeriesInstanceUID"),
+            "limit" : str(parameters["limit"]),
+            "offset" : str(parameters["offset"]),
+            "includefield" : sorted(set(parameters["includefield"])),
+            "wherefields" : parameters["wherefields"],
+            "havingfields" : parameters["havingfields"],
+            "orderbyfields" : parameters["orderbyfields"],
+            "continuationtoken" : parameters.get("continuationtoken")
+        }
+        return orjson.dumps(normalized , option=orjson.OPT_SORT_KEYS)
+
+    @staticmethod
+    def getStudyScope(parameters : dict):
+        """Returns the StudyInstanceUID the query is restricted to, None if the query can match any study."""
+        study_uid = parameters.get("StudyInstanceUID")
+        if study_uid is None:
+            study_uid = parameters["wherefields"].get("0020000D")
+        if study_uid is None or "*" in study_uid or "?" in study_uid or "," in study_uid:
+            return None
+        return study_uid
+
+    def get(self, parameters : dict):
+        """Returns a dict with the cached JSON response of the query and its continuation_token, or None."""
+        return self.cache.get(qidoCache.getKey(parameters))
+
+    def put(self, parameters : dict , content : bytes , continuation_token : str = None):
+        self.cache.put(qidoCache.getKey(parameters) , {"study" : qidoCache.getStudyScope(parameters) , "content" : content , "continuation_token" : continuation_token} , len(content))
+
+    def invalidateStudy(self, study_uid : str):
+        """Removes the responses scoped to the study, and the responses of the queries not scoped to a study which may include it. Returns the number of responses removed."""
+        removed = self.cache.deleteWhere(lambda key , entry: entry["study"] is None or entry["study"] == study_uid)
+        self.invalidations += 1
+        self.logger.debug(f"Study {study_uid} invalidated , {removed} responses removed.")
+        return removed
+
+    def clear(self):
+        self.cache.clear()
+
+    def getStats(self):
+        stats = self.cache.getStats()
+        stats["invalidations"] = self.invalidations
+        return stats
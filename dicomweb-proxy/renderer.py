@@ -0,0 +1,166 @@
+"""
+renderer Module : Renders decoded frames to consumer images for the WADO-RS rendered resources.
+
+The stored values are mapped to 8 bit display values with a lookup table combining the modality rescale and the VOI window, computed once per
+bit depth and window, so the per pixel work is an integer table lookup.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import io
+import functools
+import numpy
+from PIL import Image
+from pydicom import uid
+
+
+RENDERED_MEDIA_TYPES = {
+    "image/jpeg" : "JPEG",
+    "image/png" : "PNG",
+    "image/gif" : "GIF",
+}
+WINDOW_FUNCTIONS = ["linear" , "linear-exact" , "sigmoid"]
+
+
+def parseWindow(window : str):
+    """Parses the window query parameter : center,width[,function]. Returns None when absent, raises ValueError when invalid."""
+    if window is None:
+        return None
+    values = window.split(",")
+    if len(values) not in (2, 3):
+        raise ValueError(f"invalid window : {window}")
+    function = values[2].strip().lower() if len(values) == 3 else "linear"
+    if function not in WINDOW_FUNCTIONS:
+        raise ValueError(f"unsupported window function : {function}")
+    center , width = float(values[0]) , float(values[1])
+    if width <= 0:
+        raise ValueError(f"invalid window width : {width}")
+    return (center , width , function)
+
+
+def parseViewport(viewport : str):
+    """Parses the viewport query parameter : vw,vh. Returns None when absent, raises ValueError when invalid."""
+    if viewport is None:
+        return None
+    values = viewport.split(",")
+    if len(values) < 2:
+        raise ValueError(f"invalid viewport : {viewport}")
+    width , height = int(values[0]) , int(values[1])
+    if width <= 0 or height <= 0:
+        raise ValueError(f"invalid viewport : {viewport}")
+    return (width , height)
+
+
+def parseQuality(quality : str):
+    if quality is None:
+        return 90
+    quality = int(quality)
+    if quality < 1 or quality > 100:
+        raise ValueError(f"invalid quality : {quality}")
+    return quality
+
+
+def acceptedMediaType(accept_header : str):
+    """Returns the first rendered media type accepted by the client, image/jpeg when any is accepted, None when none is supported."""
+    if accept_header is None or accept_header.strip() == "":
+        return "image/jpeg"
+    for media_range in accept_header.split(","):
+        media_type = media_range.split(";")[0].strip().lower()
+        if media_type in RENDERED_MEDIA_TYPES:
+            return media_type
+        if media_type in ("*/*" , "image/*"):
+            return "image/jpeg"
+    return None
+
+
+def _firstValue(value , default = None):
+    if value is None:
+        return default
+    if isinstance(value , (list , tuple)):
+        return _firstValue(value[0], default) if len(value) > 0 else default
+    if isinstance(value , str):
+        value = value.split("\\")[0].strip()
+        return float(value) if value != "" else default
+    return value
+
+
+@functools.lru_cache(maxsize=64)
+def _windowLUT(bits : int , signed : bool , slope : float , intercept : float , center : float , width : float , function : str , invert : bool):
+    """Lookup table mapping each stored value, indexed by its unsigned bit pattern, to its 8 bit display value."""
+    if signed:
+        stored = numpy.arange(-(1 << (bits-1)), 1 << (bits-1), dtype=numpy.float64)
+    else:
+        stored = numpy.arange(0, 1 << bits, dtype=numpy.float64)
+    x = stored * slope + intercept
+    match function:
+        case "linear-exact":
+            y = (x - center) / width + 0.5
+        case "sigmoid":
+            y = 1.0 / (1.0 + numpy.exp(-4.0 * (x - center) / width))
+        case _:
+            if width > 1:
+                y = (x - (center - 0.5)) / (width - 1) + 0.5
+            else:
+                y = (x > center - 0.5).astype(numpy.float64)
+    lut = numpy.rint(numpy.clip(y, 0.0, 1.0) * 255.0).astype(numpy.uint8)
+    if invert:
+        lut = 255 - lut
+    if signed:
+        # stored values run from the most negative one, which is the half way bit pattern.
+        lut = numpy.concatenate((lut[1 << (bits-1):], lut[:1 << (bits-1)]))
+    return lut
+
+
+def _toImage(decoded : dict , attributes : dict , window : tuple):
+    if decoded["transfer_syntax"] == uid.JPEGBaseline8Bit: # frames openjpeg could not decode are already converted to JPEG.
+        return Image.open(io.BytesIO(decoded["pixels"]))
+    rows , columns , bits = decoded["rows"] , decoded["columns"] , decoded["bits"]
+    samples = int(_firstValue(attributes.get("SamplesPerPixel"), 1))
+    unsigned_type = numpy.uint8 if bits == 8 else numpy.uint16
+    stored = numpy.frombuffer(decoded["pixels"], dtype=unsigned_type)
+    if samples > 1:
+        stored = stored.reshape(rows, columns, samples)
+        if bits > 8:
+            stored = (stored >> (int(_firstValue(attributes.get("BitsStored"), bits)) - 8)).astype(numpy.uint8)
+        return Image.fromarray(stored[:, :, :3], "RGB")
+    stored = stored.reshape(rows, columns)
+    signed = int(_firstValue(attributes.get("PixelRepresentation"), 0)) == 1
+    slope = float(_firstValue(attributes.get("RescaleSlope"), 1.0))
+    intercept = float(_firstValue(attributes.get("RescaleIntercept"), 0.0))
+    if window is None:
+        center = _firstValue(attributes.get("WindowCenter"))
+        width = _firstValue(attributes.get("WindowWidth"))
+        if center is not None and width is not None and float(width) > 0:
+            window = (float(center) , float(width) , "linear")
+        else: # no window in the metadata : the full range of the frame is displayed.
+            values = stored.view(numpy.int8 if bits == 8 else numpy.int16) if signed else stored
+            low , high = int(values.min()) * slope + intercept , int(values.max()) * slope + intercept
+            low , high = min(low, high) , max(low, high)
+            window = ((low + high) / 2 , high - low + 1 , "linear-exact")
+    invert = attributes.get("PhotometricInterpretation") == "MONOCHROME1"
+    lut = _windowLUT(bits, signed, slope, intercept, window[0], window[1], window[2], invert)
+    return Image.fromarray(lut[stored], "L")
+
+
+def renderFrame(decoded : dict , attributes : dict , window : tuple = None , viewport : tuple = None , quality : int = 90 , media_type : str = "image/jpeg"):
+    """
+    Renders a decoded frame and returns the encoded image bytes.
+    decoded : dict with the pixels, rows, columns, bits and transfer_syntax of the frame, as returned by the decode engine.
+    attributes : DICOM attributes of the instance, by keyword, for the rescale, window and photometric interpretation.
+    window : (center, width, function) overriding the window of the instance.
+    viewport : (width, height) the image is scaled to fit in, keeping its aspect ratio.
+    """
+    img = _toImage(decoded , attributes , window)
+    if viewport is not None:
+        scale = min(viewport[0] / img.width , viewport[1] / img.height)
+        size = (max(1, round(img.width * scale)) , max(1, round(img.height * scale)))
+        if size != img.size:
+            img = img.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+    output = io.BytesIO()
+    image_format = RENDERED_MEDIA_TYPES[media_type]
+    if image_format == "JPEG":
+        if img.mode not in ("L" , "RGB"):
+            img = img.convert("RGB")
+        img.save(output, format=image_format, quality=quality)
+    else:
+        img.save(output, format=image_format)
+    return output.getvalue()
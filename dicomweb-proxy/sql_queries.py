@@ -11,6 +11,8 @@ WADO_SERIES_METADATA = "SELECT i.datastoreid , i.imagesetid from imageset i, ser
 WADO_INSTANCE_METADATA = "SELECT distinct i.datastoreid , i.imagesetid from imageset i INNER JOIN instance on i.series_pkey = instance.series_pkey and instance.SOPInstanceUID = %s "
 
 
+WADO_INSTANCE_FRAMES = "SELECT i.datastoreid , i.imagesetid , f.framenumber , f.frameid from frame f INNER JOIN instance on f.instance_pkey = instance.instance_pkey INNER JOIN imageset i on f.imageset_pkey = i.imageset_pkey WHERE instance.sopinstanceuid = %s ORDER BY f.imageset_pkey DESC , f.framenumber"
+
 WADO_INSTANCE_IN_SERIES = "select i.sopinstanceuid from instance i , series s where i.series_pkey = s.series_pkey and s.seriesinstanceuid = %s"
 
 QIDO_STUDY =    {
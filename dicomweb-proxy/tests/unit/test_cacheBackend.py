@@ -0,0 +1,171 @@
+"""
+Tests of the redis cache backend : the consistent hash ring, and the skipping of the servers which do not respond.
+
+The servers are small in process fakes of the Redis protocol, answering GET, SET and DEL.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import sys
+import socket
+import socketserver
+import threading
+import pickle
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import cacheBackend
+from cacheBackend import redisCacheBackend
+
+
+class fakeRedisHandler(socketserver.StreamRequestHandler):
+
+    def readCommand(self):
+        line = self.rfile.readline()
+        if not line.startswith(b"*"):
+            return None
+        arguments = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            arguments.append(self.rfile.read(length + 2)[:-2])
+        return arguments
+
+    def handle(self):
+        store = self.server.store
+        while (command := self.readCommand()) is not None:
+            name = command[0].upper()
+            if name == b"HELLO":
+                reply = b"%1\r\n$5\r\nproto\r\n:3\r\n"
+            elif name == b"GET":
+                value = store.get(command[1])
+                reply = b"_\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value) , value)
+            elif name == b"SET":
+                store[command[1]] = command[2]
+                reply = b"+OK\r\n"
+            elif name == b"DEL":
+                reply = b":%d\r\n" % (1 if store.pop(command[1], None) is not None else 0)
+            else:
+                reply = b"+OK\r\n"
+            self.wfile.write(reply)
+
+
+class fakeRedisServer(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1" , 0) , fakeRedisHandler)
+        self.store = {}
+        self.port = self.server_address[1]
+
+
+def unusedPort():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1" , 0))
+        return probe.getsockname()[1]
+
+
+@pytest.fixture
+def servers():
+    started = [ fakeRedisServer() for _ in range(2) ]
+    for server in started:
+        threading.Thread(target=server.serve_forever , daemon=True).start()
+    yield started
+    for server in started:
+        server.shutdown()
+        server.server_close()
+
+
+def nodesOf(servers):
+    return [ ("127.0.0.1" , server.port , 0) for server in servers ]
+
+
+def test_ring_spreads_the_keys_over_the_servers():
+    backend = redisCacheBackend("frames" , 1024 , [ ("cache-1" , 6379 , 0) , ("cache-2" , 6379 , 0) , ("cache-3" , 6379 , 0) ])
+    counts = [0 , 0 , 0]
+    for index in range(3000):
+        counts[backend.nodeFor(f"imageset/{index}")] += 1
+    assert all( 700 < count < 1300 for count in counts )
+    assert backend.nodeFor("imageset/42") == backend.nodeFor("imageset/42")
+
+
+def test_adding_a_server_only_moves_keys_to_it():
+    nodes = [ ("cache-1" , 6379 , 0) , ("cache-2" , 6379 , 0) ]
+    before = redisCacheBackend("frames" , 1024 , nodes)
+    after = redisCacheBackend("frames" , 1024 , nodes + [ ("cache-3" , 6379 , 0) ])
+    moved = 0
+    for index in range(3000):
+        key = f"imageset/{index}"
+        if before.nodeFor(key) != after.nodeFor(key):
+            assert after.nodeFor(key) == 2
+            moved += 1
+    assert 0 < moved < 1500
+
+
+def test_values_are_stored_on_the_server_of_the_key(servers):
+    backend = redisCacheBackend("frames" , 1024 , nodesOf(servers))
+    for index in range(20):
+        assert backend.put(f"imageset/{index}" , b"frame %d" % index)
+    for index in range(20):
+        key = f"imageset/{index}"
+        assert backend.get(key) == b"frame %d" % index
+        assert servers[backend.nodeFor(key)].store[(backend.prefix + key).encode()] == b"frame %d" % index
+    backend.delete("imageset/0")
+    assert backend.get("imageset/0") is None
+    stats = backend.getStats()
+    assert stats["puts"] == 20 and stats["hits"] == 20 and stats["misses"] == 1 and stats["errors"] == 0
+
+
+def test_a_server_down_is_skipped(servers):
+    nodes = nodesOf(servers) + [ ("127.0.0.1" , unusedPort() , 0) ]
+    backend = redisCacheBackend("frames" , 1024 , nodes , timeout=0.2)
+    key = next( f"imageset/{index}" for index in range(1000) if backend.nodeFor(f"imageset/{index}") == 2 )
+    # the first call fails on the server down : a cache miss, and the server is skipped from then on.
+    assert backend.get(key) is None
+    assert backend.getStats()["errors"] == 1
+    assert backend.getStats()["servers_down"] == 1
+    assert backend.nodeFor(key) in (0 , 1)
+    assert backend.put(key , b"frame")
+    assert backend.get(key) == b"frame"
+    assert backend.getStats()["errors"] == 1
+
+
+def test_all_servers_down_is_a_miss():
+    backend = redisCacheBackend("frames" , 1024 , [ ("127.0.0.1" , unusedPort() , 0) ] , timeout=0.2)
+    assert backend.get("imageset/0") is None
+    assert backend.nodeFor("imageset/0") is None
+    with pytest.raises(ConnectionError):
+        backend._call("imageset/0" , lambda client , server_key : client.get(server_key))
+    assert not backend.put("imageset/0" , b"frame")
+    assert backend.getStats()["errors"] == 2
+
+
+def test_oversized_values_are_not_stored(servers):
+    backend = redisCacheBackend("frames" , 16 , nodesOf(servers))
+    assert not backend.put("imageset/0" , b"x"*17)
+    assert backend.getStats()["oversized"] == 1
+    assert all( len(server.store) == 0 for server in servers )
+
+
+def test_the_backends_are_picklable(servers , tmp_path):
+    backend = pickle.loads(pickle.dumps(redisCacheBackend("frames" , 1024 , nodesOf(servers))))
+    assert backend.put("imageset/0" , b"frame")
+    assert backend.get("imageset/0") == b"frame"
+    disk = pickle.loads(pickle.dumps(cacheBackend.getCacheBackend("disk" , "frames" , default_root=str(tmp_path))))
+    assert disk.put("imageset/0" , b"frame")
+    assert disk.get("imageset/0") == b"frame"
+
+
+def test_the_statistics_count_the_concurrent_lookups():
+    backend = cacheBackend.getCacheBackend("memory" , "frames")
+    backend.put("imageset/0" , b"frame")
+    def lookups():
+        for index in range(2000):
+            backend.get(f"imageset/{index % 2}")
+    threads = [ threading.Thread(target=lookups) for _ in range(8) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = backend.getStats()
+    assert stats["hits"] == 8000 and stats["misses"] == 8000
@@ -0,0 +1,39 @@
+"""
+Tests of the read through of the frame index to the metadata-index frame table.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import frameIndex
+
+
+FRAME_IDS = [ f"{index:032x}" for index in range(3) ]
+
+
+def test_frames_are_read_through_once():
+    lookups = []
+    def loader(instance_uid):
+        lookups.append(instance_uid)
+        return [ ("datastore" , "imageset" , number + 1 , frame_id) for number , frame_id in enumerate(FRAME_IDS) ]
+    index = frameIndex.frameIndex(loader=loader)
+    assert index.getFrames("1.2.3" , [3 , 1]) == [ ("datastore" , "imageset" , FRAME_IDS[2] , None) , ("datastore" , "imageset" , FRAME_IDS[0] , None) ]
+    assert index.getFrames("1.2.3" , [2]) == [ ("datastore" , "imageset" , FRAME_IDS[1] , None) ]
+    assert lookups == ["1.2.3"]
+
+
+def test_instances_missing_from_the_frame_table_are_not_looked_up_again(monkeypatch):
+    lookups = []
+    def loader(instance_uid):
+        lookups.append(instance_uid)
+        return []
+    index = frameIndex.frameIndex(loader=loader)
+    assert index.getFrames("1.2.3" , [1]) is None
+    assert index.getFrames("1.2.3" , [1]) is None
+    assert lookups == ["1.2.3"]
+    assert index.getStats()["load_misses"] == 1 and index.getStats()["skipped_loads"] == 1
+    monkeypatch.setattr(frameIndex , "MISS_TTL" , 0)
+    assert index.getFrames("1.2.4" , [1]) is None
+    assert index.getFrames("1.2.4" , [1]) is None
+    assert lookups == ["1.2.3" , "1.2.4" , "1.2.4"]
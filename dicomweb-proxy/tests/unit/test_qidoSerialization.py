@@ -0,0 +1,41 @@
+"""
+Tests of the database rows to DICOM JSON conversion of the QIDO-RS responses, done with the compiled serialization plan.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import sys
+import datetime
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import main
+
+
+STUDY_PARAMETERS = { "queryLevel" : "STUDY" , "includefield" : [] }
+
+
+def convert(columns , row , params = STUDY_PARAMETERS):
+    return list(main._convertToJSON(columns , [row] , params))[0]
+
+
+def test_date_and_time_columns():
+    study = convert(["studyinstanceuid" , "studydate" , "studytime"] , ("1.2.3" , datetime.date(2020 , 1 , 2) , datetime.timedelta(hours=10 , minutes=5 , seconds=7 , microseconds=250)))
+    assert study["0020000D"] == { "vr" : "UI" , "Value" : ["1.2.3"] }
+    assert study["00080020"] == { "vr" : "DA" , "Value" : ["20200102"] }
+    assert study["00080030"] == { "vr" : "TM" , "Value" : ["100507.000250"] }
+
+
+def test_midnight_time_column():
+    study = convert(["studyinstanceuid" , "studytime"] , ("1.2.3" , datetime.timedelta(0)))
+    assert study["00080030"] == { "vr" : "TM" , "Value" : ["000000.000000"] }
+
+
+def test_null_string_columns_are_empty_elements():
+    study = convert(["studyinstanceuid" , "modalitiesinstudy" , "studydescription" , "studytime"] , ("1.2.3" , None , None , None))
+    assert study["00080061"] == { "vr" : "CS" }
+    assert study["00081030"] == { "vr" : "LO" }
+    assert study["00080030"] == { "vr" : "TM" }
+
+
+def test_aggregated_modalities_are_multiple_values():
+    study = convert(["studyinstanceuid" , "modalitiesinstudy"] , ("1.2.3" , "CT/MR"))
+    assert study["00080061"] == { "vr" : "CS" , "Value" : ["CT" , "MR"] }